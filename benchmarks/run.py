@@ -0,0 +1,195 @@
+"""
+Benchmark the extract pipeline using synthetic view output
+
+    python -m benchmarks.run --rows 100000 --columns 10 --output after.json
+    python -m benchmarks.run --compare before.json after.json
+
+Benchmarks:
+
+* extract: CtableExtractor.extract end to end
+* convert: CtableExtractor.couch_rows_to_sql_rows
+* combine: ctable.util.combine_rows
+* write: SqlBackend.write_rows
+
+The SQL benchmarks run against SQLite by default. Use --sql-url to run against PostgreSQL
+e.g. --sql-url postgresql://postgres@localhost/ctable_bench
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+from datetime import datetime
+from timeit import default_timer
+
+BENCHMARKS = ('extract', 'convert', 'combine', 'write')
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'testsettings')
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, kilobytes on Linux
+    return rss / 1024 if sys.platform == 'darwin' else rss
+
+
+class BenchmarkRunner(object):
+
+    def __init__(self, args):
+        from benchmarks import synthetic
+        from ctable.backends import SqlBackend
+        from ctable.base import CtableExtractor
+
+        self.args = args
+        self.mapping = synthetic.make_mapping(args.columns, args.key_width, args.fan_out)
+        self.view_rows = synthetic.make_view_rows(args.rows, args.columns, args.key_width)
+        self.backend = SqlBackend(args.sql_url)
+        self.extractor = CtableExtractor(synthetic.make_couch_db(self.view_rows), self.backend)
+
+    def clear(self):
+        with self.backend:
+            self.backend.clear_all_data(self.mapping)
+
+    def run(self, name):
+        self.clear()
+        try:
+            return getattr(self, 'bench_%s' % name)()
+        finally:
+            self.clear()
+
+    def _result(self, seconds, rows, **extra):
+        result = {
+            'seconds': seconds,
+            'rows': rows,
+            'rows_per_sec': rows / seconds if seconds else None,
+            'peak_rss_kb': peak_rss_kb(),
+        }
+        result.update(extra)
+        return result
+
+    def bench_extract(self):
+        from ctable.stats import ExtractStats
+        stats = ExtractStats()
+        start = default_timer()
+        self.extractor.extract(self.mapping, pipelined=self.args.pipelined, stats=stats)
+        seconds = default_timer() - start
+        return self._result(seconds, stats.rows_read, rows_written=stats.rows_written, timings=stats.timings)
+
+    def bench_convert(self):
+        start = default_timer()
+        count = 0
+        for _ in self.extractor.couch_rows_to_sql_rows(self.view_rows, self.mapping):
+            count += 1
+        return self._result(default_timer() - start, len(self.view_rows), rows_out=count)
+
+    def _sql_rows(self):
+        return list(self.extractor.couch_rows_to_sql_rows(self.view_rows, self.mapping))
+
+    def bench_combine(self):
+        from ctable.util import combine_rows
+        sql_rows = self._sql_rows()
+        start = default_timer()
+        combined = sum(1 for _ in combine_rows(sql_rows, self.mapping))
+        return self._result(default_timer() - start, len(sql_rows), rows_out=combined)
+
+    def bench_write(self):
+        from ctable.util import combine_rows
+        rows = list(combine_rows(self._sql_rows(), self.mapping))
+        with self.backend:
+            self.backend.init_mapping(self.mapping)
+            start = default_timer()
+            self.backend.write_rows(rows, self.mapping)
+            seconds = default_timer() - start
+        return self._result(seconds, len(rows))
+
+
+def run_benchmarks(args):
+    setup_django()
+    import sqlalchemy
+    runner = BenchmarkRunner(args)
+
+    results = {}
+    for name in args.benchmarks:
+        runs = [runner.run(name) for _ in range(args.repeat)]
+        best = min(runs, key=lambda r: r['seconds'])
+        results[name] = best
+        print '%-8s %10d rows %8.3fs %12.0f rows/s  peak RSS %d KB' % (
+            name, best['rows'], best['seconds'], best['rows_per_sec'] or 0, best['peak_rss_kb']
+        )
+        if 'timings' in best:
+            print '         ' + '  '.join('%s=%.3fs' % item for item in sorted(best['timings'].items()))
+
+    return {
+        'created': datetime.utcnow().isoformat(),
+        'config': {
+            'rows': args.rows,
+            'columns': args.columns,
+            'key_width': args.key_width,
+            'fan_out': args.fan_out,
+            'pipelined': args.pipelined,
+            'repeat': args.repeat,
+            'sql': sqlalchemy.engine.url.make_url(args.sql_url).drivername,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sqlalchemy': sqlalchemy.__version__,
+        },
+        'results': results,
+    }
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    if before['config'] != after['config']:
+        print 'Warning: the benchmarks were run with different configurations'
+
+    print '%-8s %14s %14s %8s' % ('', 'before rows/s', 'after rows/s', 'change')
+    for name in BENCHMARKS:
+        old = before['results'].get(name)
+        new = after['results'].get(name)
+        if not (old and new and old['rows_per_sec'] and new['rows_per_sec']):
+            continue
+        change = (new['rows_per_sec'] - old['rows_per_sec']) * 100 / old['rows_per_sec']
+        print '%-8s %14.0f %14.0f %+7.1f%%' % (name, old['rows_per_sec'], new['rows_per_sec'], change)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000, help='Number of view rows')
+    parser.add_argument('--columns', type=int, default=10, help='Number of value columns')
+    parser.add_argument('--key-width', type=int, default=2, help='Number of key columns')
+    parser.add_argument('--fan-out', type=int, default=1, help='Number of match_keys per value column')
+    parser.add_argument('--pipelined', action='store_true', help='Use a pipelined extract')
+    parser.add_argument('--repeat', type=int, default=3, help='Run each benchmark this many times and keep the best')
+    parser.add_argument('--sql-url', default='sqlite:///:memory:')
+    parser.add_argument('--benchmark', dest='benchmarks', action='append', choices=BENCHMARKS,
+                        help='Benchmark to run. Can be repeated. Defaults to all.')
+    parser.add_argument('--output', help='Save the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='Compare two saved results instead of running the benchmarks')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    args.benchmarks = args.benchmarks or list(BENCHMARKS)
+    report = run_benchmarks(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Synthetic CouchDB view output and mappings for benchmarking the extract pipeline.
+
+Each SQL row is made up of one view row per value column. View keys are:
+
+    [group_0 ... group_N, indicator_name]
+
+and the values are reduce results like {"sum": 1, "count": 1}.
+"""
+import itertools
+from fakecouch import FakeCouchDb
+from ctable.models import SqlExtractMapping, ColumnDef, KeyMatcher, NOT_EQUAL
+
+VIEW = 'benchmark/view'
+DOMAIN = 'benchmark'
+VIEW_PARAMS = {'reduce': True, 'group': True, 'startkey': [], 'endkey': [{}]}
+
+
+def make_mapping(columns=10, key_width=2, fan_out=1, name='synthetic'):
+    """
+    :param columns: number of value columns
+    :param key_width: number of key columns (taken from the start of the view key)
+    :param fan_out: number of KeyMatchers per value column. The first matches the indicator
+                    name and the rest never exclude a row so every matcher is evaluated.
+    """
+    column_defs = [
+        ColumnDef(name='group_%d' % i, data_type='string', value_source='key', value_index=i)
+        for i in range(key_width)
+    ]
+    for c in range(columns):
+        matchers = [KeyMatcher(index=key_width, value='indicator_%d' % c)]
+        matchers.extend(
+            KeyMatcher(index=i % key_width, operator=NOT_EQUAL, value='never_%d' % i)
+            for i in range(fan_out - 1)
+        )
+        column_defs.append(ColumnDef(name='indicator_%d' % c, data_type='integer', value_source='value',
+                                     value_attribute='sum', match_keys=matchers))
+
+    return SqlExtractMapping(domains=[DOMAIN], name=name, couch_view=VIEW, columns=column_defs)
+
+
+def iter_view_rows(rows, columns=10, key_width=2):
+    """
+    Generate `rows` view rows in key order
+    """
+    groups_per_position = max(int(round((rows / float(columns)) ** (1.0 / key_width))), 1) + 1
+    group_keys = itertools.product(*[
+        ['g%d_%06d' % (position, i) for i in range(groups_per_position)]
+        for position in range(key_width)
+    ])
+
+    count = 0
+    for group_key in group_keys:
+        for c in range(columns):
+            if count >= rows:
+                return
+            yield {'key': list(group_key) + ['indicator_%d' % c], 'value': {'sum': count % 100, 'count': 1}}
+            count += 1
+
+
+def make_view_rows(rows, columns=10, key_width=2):
+    return list(iter_view_rows(rows, columns, key_width))
+
+
+def make_couch_db(view_rows):
+    """
+    :return: FakeCouchDb that returns the rows for the query made by CtableExtractor.extract
+             for mappings from make_mapping
+    """
+    db = FakeCouchDb()
+    db.add_view(VIEW, [(VIEW_PARAMS, view_rows)])
+    return db
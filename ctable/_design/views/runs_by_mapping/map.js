@@ -0,0 +1,5 @@
+function (doc) {
+    if (doc.doc_type === 'ExtractRun') {
+        emit([doc.mapping_id, doc.started], doc._rev);
+    }
+}
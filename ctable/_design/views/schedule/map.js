@@ -1,6 +1,7 @@
 function (doc) {
     if (doc.doc_type === 'SqlExtractMapping') {
         var status = doc.active ? 'active' : 'inactive';
-        emit([status, doc.schedule_type, doc.schedule_day, doc.schedule_hour], null)
+        emit([status, doc.schedule_type, doc.schedule_day, doc.schedule_hour],
+             [doc.database || null, doc.backend || null]);
     }
 }
\ No newline at end of file
@@ -1,10 +1,29 @@
+import array
+import csv
+import datetime
+import gzip
+import json
 import logging
+import os
+import shutil
 import six
 import sqlalchemy
 import alembic
 import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from dimagi.utils.chunked import chunked
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.translation import ugettext as _
 from django.conf import settings
+from .instrumentation import get_instrumentation
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
 
 logger = logging.getLogger(__name__)
 
@@ -22,11 +41,105 @@ class ColumnTypeException(CompatibilityException):
     pass
 
 
+def check_table_columns(table_columns, mapping):
+    """
+    Compare the columns of an existing table with those of the mapping.
+
+    :param table_columns: dict of column name to (is primary key, data type) where the data type
+                          is one of the ColumnDef data types or None if it isn't one of them
+    :return: dict of errors and warnings
+    """
+    errors = []
+    warnings = []
+    mapping_columns = dict([(c.name, c) for c in mapping.columns])
+    for name, (primary_key, data_type) in table_columns.items():
+        if name not in mapping_columns:
+            if primary_key:
+                errors.append(_('Key column exists in table but not in mapping: %s' % name))
+            else:
+                warnings.append(_('Column exists in table but not in mapping: %(column)s') % {'column': name})
+
+    for col in mapping.key_columns:
+        if col not in table_columns:
+            errors.append(_('Key column exists in mapping but not in table: %(column)s') % {'column': col})
+
+    for name, column in mapping_columns.items():
+        if name in table_columns and table_columns[name][1] != column.data_type:
+            errors.append(_('Column types do not match: %(column)s') % {'column': name})
+
+    return {'errors': errors, 'warnings': warnings}
+
+
+def group_upsert_rows(rows, key_columns):
+    """
+    Group rows by the set of columns they contain so that each group can be upserted with a single
+    multi-row INSERT ... ON CONFLICT statement leaving the columns which are missing from a row
+    untouched. A single statement can't update the same row twice so a new set of groups is
+    started as soon as a key is repeated.
+
+    :return: generator of dicts of column names to rows
+    """
+    groups = {}
+    seen_keys = set()
+    for row_dict in rows:
+        row_key = tuple([row_dict[k] for k in key_columns])
+        if row_key in seen_keys:
+            yield groups
+            groups = {}
+            seen_keys = set()
+
+        seen_keys.add(row_key)
+        groups.setdefault(tuple(sorted(row_dict)), []).append(row_dict)
+
+    if groups:
+        yield groups
+
+
+def upsert_sql(quote, table_name, columns, key_columns, values):
+    """
+    :param quote: function to quote identifiers
+    :param values: placeholders for each row e.g. '(?, ?)'
+    """
+    update_columns = [c for c in columns if c not in key_columns]
+    if update_columns:
+        conflict_action = 'DO UPDATE SET %s' % ', '.join(
+            ['{0} = EXCLUDED.{0}'.format(quote(c)) for c in update_columns]
+        )
+    else:
+        conflict_action = 'DO NOTHING'
+
+    return 'INSERT INTO %s (%s) VALUES %s ON CONFLICT (%s) %s' % (
+        quote(table_name),
+        ', '.join([quote(c) for c in columns]),
+        ', '.join(values),
+        ', '.join([quote(k) for k in key_columns]),
+        conflict_action
+    )
+
+
 class CtableBackend(object):
 
-    def write_rows(self, rows, extract_mapping):
+    def write_rows(self, rows, extract_mapping, on_commit=None):
+        """
+        :param on_commit: function called after each commit once all the rows taken from
+                          `rows` so far are committed. Only backends which commit as they
+                          go need to call it.
+        """
         raise NotImplementedError()
 
+    def copy_rows(self, rows, extract_mapping):
+        """
+        Bulk load rows. Backends without a faster bulk load path just write the rows.
+        """
+        self.write_rows(rows, extract_mapping)
+
+    def rebuild_rows(self, rows, extract_mapping):
+        """
+        Replace all the data for the mapping with the rows.
+        """
+        self.clear_all_data(extract_mapping)
+        self.write_rows(rows, extract_mapping)
+
     def __enter__(self):
         pass
 
@@ -36,79 +149,257 @@ class CtableBackend(object):
     def check_mapping(self, mapping):
         pass
 
+    def init_mapping(self, mapping):
+        """
+        Create or update the storage for the mapping before any rows are written.
+        """
+        pass
+
     def clear_all_data(self, mapping):
         pass
 
 
+class CsvRowStream(object):
+    """
+    File like object that lazily formats rows as CSV for use with COPY ... FROM STDIN
+    """
+
+    def __init__(self, rows, columns):
+        self.rows = iter(rows)
+        self.columns = columns
+        self.buffer = ''
+
+    def read(self, size=-1):
+        lines = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            try:
+                line = self.format_row(next(self.rows))
+            except StopIteration:
+                break
+            lines.append(line)
+            length += len(line)
+
+        data = ''.join(lines)
+        if size < 0:
+            self.buffer = ''
+            return data
+
+        self.buffer = data[size:]
+        return data[:size]
+
+    def format_row(self, row_dict):
+        return ','.join([self.format_value(row_dict.get(c)) for c in self.columns]) + '\n'
+
+    def format_value(self, value):
+        if value is None:
+            return ''
+        elif isinstance(value, (datetime.date, datetime.datetime)):
+            return value.isoformat()
+        elif isinstance(value, six.integer_types):
+            return str(value)
+        elif isinstance(value, six.text_type):
+            value = value.encode('utf-8')
+        else:
+            value = str(value)
+        return '"%s"' % value.replace('"', '""')
+
+
+class TransactionBatch(object):
+    """
+    Group writes into transactions that are committed every `commit_every` rows or
+    every `commit_interval` seconds, whichever comes first.
+    """
+
+    def __init__(self, connection, commit_every, commit_interval, on_commit=None):
+        self.connection = connection
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.on_commit = on_commit
+        self.transaction = None
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.transaction.commit()
+        else:
+            self.transaction.rollback()
+
+    def begin(self):
+        self.transaction = self.connection.begin()
+        self.rows = 0
+        self.started = time.time()
+
+    def add(self, num_rows):
+        self.rows += num_rows
+        if self.rows >= self.commit_every or time.time() - self.started >= self.commit_interval:
+            logger.debug("Committing %d rows", self.rows)
+            self.transaction.commit()
+            if self.on_commit:
+                self.on_commit()
+            self.begin()
+
+
+class TimedLock(object):
+    """
+    Lock which records the time spent waiting for it as 'lock_wait'
+    """
+
+    def __init__(self, lock, table_name):
+        self.lock = lock
+        self.table_name = table_name
+
+    def __enter__(self):
+        with get_instrumentation().timer('lock_wait', table=self.table_name):
+            self.lock.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.lock.release()
+
+
+def create_engine(url):
+    """
+    Create an engine using the pool settings from Django settings. SQLite doesn't use a
+    connection pool so the pool settings are ignored.
+    """
+    kwargs = {}
+    if not sqlalchemy.engine.url.make_url(url).drivername.startswith('sqlite'):
+        kwargs = dict(
+            pool_size=getattr(settings, 'CTABLE_SQL_POOL_SIZE', 5),
+            max_overflow=getattr(settings, 'CTABLE_SQL_POOL_MAX_OVERFLOW', 10),
+            pool_recycle=getattr(settings, 'CTABLE_SQL_POOL_RECYCLE', 3600),
+        )
+    return sqlalchemy.create_engine(url, **kwargs)
+
+
 class SqlBackend(CtableBackend):
     """
     Write rows to a database specified by URL
+
+    The backend can be shared between threads. Each thread gets its own connection from
+    the pool when it enters the backend and nested `with backend:` blocks reuse it.
     """
     lock_lock = threading.Lock()
     lock_dict = {}
 
-    def __init__(self, url_or_connection=None):
+    def __init__(self, url_or_connection=None, batch_size=None, commit_every=None, commit_interval=None):
         if not url_or_connection:
             url_or_connection = settings.SQL_REPORTING_DATABASE_URL
 
         if isinstance(url_or_connection, six.string_types):
-            self.base_connection = sqlalchemy.create_engine(url_or_connection)
+            self.base_connection = create_engine(url_or_connection)
         else:
             self.base_connection = url_or_connection
 
+        self.batch_size = batch_size or getattr(settings, 'CTABLE_UPSERT_BATCH_SIZE', 250)
+        self.commit_every = commit_every or getattr(settings, 'CTABLE_COMMIT_EVERY', 10000)
+        self.commit_interval = commit_interval or getattr(settings, 'CTABLE_COMMIT_INTERVAL', 30)
+        self._local = threading.local()
+
     def __enter__(self):
-        self.connection = self.base_connection.connect()  # "forks" the SqlAlchemy connection
-        self._metadata = None  # force metadata refresh
-        self._op = None
-        return self  # TODO: A safe context manager so this can be called many times
+        depth = getattr(self._local, 'depth', 0)
+        if not depth:
+            self._local.connection = self.base_connection.connect()  # "forks" the SqlAlchemy connection
+            self._local.metadata = None  # force metadata refresh
+            self._local.tables = {}  # another process may have changed the tables since the last block
+            self._local.op = None
+        self._local.depth = depth + 1
+        return self
 
     def __exit__(self, type, value, traceback):
-        self.connection.close()
+        self._local.depth -= 1
+        if not self._local.depth:
+            self._local.connection.close()
+            self._local.connection = None
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            raise Exception("SqlBackend must be used as a context manager before accessing the connection")
+        return connection
 
     def _get_lock(self, table_name):
         with self.lock_lock:
             if table_name not in self.lock_dict:
                 self.lock_dict[table_name] = threading.Lock()
 
-        return self.lock_dict[table_name]
+        return TimedLock(self.lock_dict[table_name], table_name)
 
     def get_metadata(self, table_name=None):
         def table_filter(name, metadata):
             return not table_name or name == table_name
 
-        if not hasattr(self, '_metadata') or self._metadata is None:
-            self._metadata = sqlalchemy.MetaData()
-            self._metadata.bind = self.connection
-            self._metadata.reflect(only=table_filter)
-        return self._metadata
+        if getattr(self._local, 'metadata', None) is None:
+            self._local.metadata = sqlalchemy.MetaData()
+            self._local.metadata.bind = self.connection
+            self._local.metadata.reflect(only=table_filter)
+        return self._local.metadata
 
     def reset_meta(self):
-        self._metadata = None
+        self._local.metadata = None
 
     def table(self, table_name):
         metadata = self.get_metadata(table_name)
         return sqlalchemy.Table(table_name, metadata, autoload=True, autoload_with=self.connection)
 
+    def get_table(self, extract_mapping):
+        """
+        Get the reflected table for the mapping, creating or updating the table if necessary.
+
+        Tables are cached by name along with the mapping revision and columns until the outermost
+        `with` block exits so that the table is only reflected again when the mapping or the table
+        changes.
+        """
+        table_name = extract_mapping.table_name
+        signature = (
+            getattr(extract_mapping, '_rev', None),
+            tuple([(c.name, c.data_type) for c in extract_mapping.columns])
+        )
+        cached = self._local.tables.get(table_name)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        self.init_table(table_name, extract_mapping.columns)
+        table = self.table(table_name)
+        self._local.tables[table_name] = (signature, table)
+        return table
+
+    def init_mapping(self, mapping):
+        self.get_table(mapping)
+
+    def invalidate_table(self, table_name):
+        getattr(self._local, 'tables', {}).pop(table_name, None)
+
     @property
     def op(self):
-        if not hasattr(self, '_op') or self._op is None:
+        if getattr(self._local, 'op', None) is None:
             ctx = alembic.migration.MigrationContext.configure(self.connection)
-            self._op = alembic.operations.Operations(ctx)
-        return self._op
+            self._local.op = alembic.operations.Operations(ctx)
+        return self._local.op
 
     def init_table(self, table_name, column_defs):
         with self._get_lock(table_name):
             if not table_name in self.get_metadata(table_name).tables:
                 logger.info('Creating new reporting table: %s', table_name)
                 columns = [c.sql_column for c in column_defs]
-                self.op.create_table(table_name, *columns)
-                owner = getattr(settings, 'SQL_REPORTING_OBJECT_OWNER', None)
-                if owner:
-                    self.op.execute('ALTER TABLE "%s" OWNER TO %s' % (table_name, owner))
+                with get_instrumentation().timer('ddl', table=table_name, op='create_table'):
+                    self.op.create_table(table_name, *columns)
+                self.set_owner(table_name)
                 self.reset_meta()
+                self.invalidate_table(table_name)
             else:
                 self.make_table_compatible(table_name, column_defs)
 
+    def set_owner(self, table_name):
+        owner = getattr(settings, 'SQL_REPORTING_OBJECT_OWNER', None)
+        if owner:
+            self.op.execute('ALTER TABLE "%s" OWNER TO %s' % (table_name, owner))
+
     def make_table_compatible(self, table_name, column_defs):
         if not table_name in self.get_metadata(table_name).tables:
             raise Exception("Table does not exist", table_name)
@@ -117,9 +408,11 @@ class SqlBackend(CtableBackend):
         for column in column_defs:
             if not column.name in existing_columns:
                 logger.info('Adding column to reporting table: %s.%s', table_name, column.name)
-                self.op.add_column(table_name, column.sql_column)
+                with get_instrumentation().timer('ddl', table=table_name, op='add_column'):
+                    self.op.add_column(table_name, column.sql_column)
                 existing_columns[column.name] = column.sql_column
                 self.reset_meta()
+                self.invalidate_table(table_name)
             else:
                 current_ty = existing_columns[column.name].type
                 if not isinstance(current_ty, BASE_TYPE_MAP[column.data_type]):
@@ -129,34 +422,242 @@ class SqlBackend(CtableBackend):
         table_name = mapping.table_name
         with self._get_lock(table_name):
             if table_name in self.get_metadata(table_name).tables:
-                self.op.drop_table(table_name)
+                with get_instrumentation().timer('ddl', table=table_name, op='drop_table'):
+                    self.op.drop_table(table_name)
                 self.reset_meta()
+            self.invalidate_table(table_name)
 
     def check_mapping(self, mapping):
-        errors = []
-        warnings = []
-        if mapping.table_name in self.get_metadata(mapping.table_name).tables:
-            table = self.table(mapping.table_name)
-            table_columns = dict([(c.name, c) for c in table.columns])
-            mapping_columns = dict([(c.name, c) for c in mapping.columns])
-            for name, column in table_columns.items():
-                if name not in mapping_columns:
-                    if column.primary_key:
-                        errors.append(_('Key column exists in table but not in mapping: %s' % name))
-                    else:
-                        warnings.append(_('Column exists in table but not in mapping: %(column)s') % {'column': name})
-
-            for col in mapping.key_columns:
-                if col not in table_columns:
-                    errors.append(_('Key column exists in mapping but not in table: %(column)s') % {'column': col})
-
-            for name, column in mapping_columns.items():
-                if name in table_columns:
-                    current_ty = table_columns[name].type
-                    if not isinstance(current_ty, BASE_TYPE_MAP[column.data_type]):
-                        errors.append(_('Column types do not match: %(column)s') % {'column': name})
-
-        return {'errors': errors, 'warnings': warnings}
+        if mapping.table_name not in self.get_metadata(mapping.table_name).tables:
+            return {'errors': [], 'warnings': []}
+
+        def data_type(column):
+            for name, sql_type in BASE_TYPE_MAP.items():
+                if isinstance(column.type, sql_type):
+                    return name
+
+        table = self.table(mapping.table_name)
+        return check_table_columns(
+            dict([(c.name, (c.primary_key, data_type(c))) for c in table.columns]),
+            mapping
+        )
+
+    @property
+    def supports_bulk_upsert(self):
+        """
+        INSERT ... ON CONFLICT is only available from PostgreSQL 9.5
+        """
+        dialect = self.connection.dialect
+        version = dialect.server_version_info or ()
+        return dialect.name == 'postgresql' and version >= (9, 5)
+
+    @contextmanager
+    def savepoint(self):
+        """
+        PostgreSQL aborts the whole transaction when a statement fails so statements that
+        may fail are run inside a SAVEPOINT. Other databases only discard the failed statement.
+        """
+        if self.connection.dialect.name == 'postgresql' and self.connection.in_transaction():
+            with self.connection.begin_nested():
+                yield
+        else:
+            yield
+
+    def quote(self, name):
+        return self.connection.dialect.identifier_preparer.quote_identifier(name)
+
+    def bulk_upsert(self, table_name, rows, key_columns):
+        """
+        Upsert a list of rows using multi-row INSERT ... ON CONFLICT DO UPDATE statements.
+
+        Columns which are missing from a row are left untouched, the same as with the row by row
+        upsert. See group_upsert_rows.
+        """
+        for groups in group_upsert_rows(rows, key_columns):
+            self._flush_upsert_groups(table_name, groups, key_columns)
+
+    def _flush_upsert_groups(self, table_name, groups, key_columns):
+        for columns, rows in groups.items():
+            try:
+                with self.savepoint():
+                    self._upsert_group(table_name, columns, rows, key_columns)
+            except (sqlalchemy.exc.DataError, sqlalchemy.exc.IntegrityError):
+                if len(rows) == 1:
+                    logger.exception("Unable to write row to %s: %s", table_name, rows[0])
+                else:
+                    # find the bad row(s) and write the rest
+                    for row_dict in rows:
+                        self._flush_upsert_groups(table_name, {columns: [row_dict]}, key_columns)
+
+    def _upsert_group(self, table_name, columns, rows, key_columns):
+        params = {}
+        values = []
+        for i, row_dict in enumerate(rows):
+            placeholders = []
+            for j, column in enumerate(columns):
+                param = 'p_%d_%d' % (i, j)
+                params[param] = row_dict[column]
+                placeholders.append(':%s' % param)
+            values.append('(%s)' % ', '.join(placeholders))
+
+        statement = upsert_sql(self.quote, table_name, columns, key_columns, values)
+        with get_instrumentation().timer('sql_execute', table=table_name, op='bulk_upsert'):
+            self.connection.execute(sqlalchemy.text(statement), **params)
+
+    def copy_rows(self, rows, extract_mapping):
+        """
+        Stream the rows into a temporary staging table using COPY and then merge them into the
+        target table with a single INSERT ... SELECT ... ON CONFLICT statement.
+
+        Rows for the same key are merged in the order they were received taking the last value
+        that is not NULL for each column. Unlike the upsert path a NULL value never overwrites
+        existing data.
+        """
+        if not self.supports_bulk_upsert:
+            return self.write_rows(rows, extract_mapping)
+
+        table_name = extract_mapping.table_name
+        key_columns = extract_mapping.key_columns
+        columns = [c.name for c in extract_mapping.columns]
+        staging_table = '%s_staging' % table_name
+
+        self.get_table(extract_mapping)
+        try:
+            with self.connection.begin():
+                self.copy_to_staging_table(rows, staging_table, table_name, columns)
+                self.merge_staging_table(staging_table, table_name, columns, key_columns)
+                self.connection.execute('DROP TABLE %s' % self.quote(staging_table))
+        except (sqlalchemy.exc.SQLAlchemyError, self.connection.dialect.dbapi.Error):
+            # the table may have been changed by another process
+            self.invalidate_table(table_name)
+            raise
+
+    def copy_to_staging_table(self, rows, staging_table, table_name, columns):
+        """
+        Create a temporary table with the same columns as `table_name` and COPY the rows into it.
+        Must be called inside a transaction.
+        """
+        self.connection.execute('CREATE TEMPORARY TABLE %s (LIKE %s, "_ctable_seq" BIGSERIAL) ON COMMIT DROP' % (
+            self.quote(staging_table), self.quote(table_name)
+        ))
+
+        cursor = self.connection.connection.cursor()
+        try:
+            copy = "COPY %s (%s) FROM STDIN WITH (FORMAT csv, ENCODING 'UTF8')" % (
+                self.quote(staging_table),
+                ', '.join([self.quote(c) for c in columns])
+            )
+            with get_instrumentation().timer('sql_execute', table=table_name, op='copy'):
+                cursor.copy_expert(copy, CsvRowStream(rows, columns))
+            logger.debug("Copied %d rows into %s", cursor.rowcount, staging_table)
+        finally:
+            cursor.close()
+
+    def select_staging_rows(self, staging_table, key_columns, update_columns):
+        """
+        SELECT statement that combines the rows in the staging table by key taking the
+        last value that is not NULL for each column.
+        """
+        select_columns = [self.quote(k) for k in key_columns]
+        for column in update_columns:
+            select_columns.append(
+                '(array_agg({0} ORDER BY "_ctable_seq" DESC) FILTER (WHERE {0} IS NOT NULL))[1]'.format(
+                    self.quote(column)
+                ))
+
+        return 'SELECT %s FROM %s GROUP BY %s' % (
+            ', '.join(select_columns),
+            self.quote(staging_table),
+            ', '.join([self.quote(k) for k in key_columns])
+        )
+
+    def merge_staging_table(self, staging_table, table_name, columns, key_columns):
+        update_columns = [c for c in columns if c not in key_columns]
+        if update_columns:
+            conflict_action = 'DO UPDATE SET %s' % ', '.join(
+                ['{0} = COALESCE(EXCLUDED.{0}, {1}.{0})'.format(self.quote(c), self.quote(table_name))
+                 for c in update_columns]
+            )
+        else:
+            conflict_action = 'DO NOTHING'
+
+        with get_instrumentation().timer('sql_execute', table=table_name, op='merge'):
+            self.connection.execute('INSERT INTO %s (%s) %s ON CONFLICT (%s) %s' % (
+                self.quote(table_name),
+                ', '.join([self.quote(c) for c in key_columns + update_columns]),
+                self.select_staging_rows(staging_table, key_columns, update_columns),
+                ', '.join([self.quote(k) for k in key_columns]),
+                conflict_action
+            ))
+
+    def rebuild_rows(self, rows, extract_mapping):
+        """
+        Load the rows into a new table and swap it in place of the existing table so that
+        readers never see a partially loaded table.
+
+        With PostgreSQL 9.5+ the rows are copied into a staging table and inserted into the
+        new table in a single statement. The primary key is only added once the data is
+        loaded. Everything happens in a single transaction.
+
+        Other databases upsert the rows into the new table and swap the tables at the end.
+        """
+        table_name = extract_mapping.table_name
+        new_table = '%s__new' % table_name
+        with self._get_lock(table_name):
+            try:
+                if self.supports_bulk_upsert:
+                    with self.connection.begin():
+                        self._load_new_table(rows, new_table, extract_mapping)
+                        self._swap_tables(new_table, table_name)
+                else:
+                    self.connection.execute('DROP TABLE IF EXISTS %s' % self.quote(new_table))
+                    self.op.create_table(new_table, *[c.sql_column for c in extract_mapping.columns])
+                    self.set_owner(new_table)
+                    self.reset_meta()
+                    self._write_rows(self.table(new_table), rows, extract_mapping.key_columns)
+                    with self.connection.begin():
+                        self._swap_tables(new_table, table_name)
+            finally:
+                self.reset_meta()
+                self.invalidate_table(table_name)
+
+    def _load_new_table(self, rows, new_table, extract_mapping):
+        key_columns = extract_mapping.key_columns
+        columns = [c.name for c in extract_mapping.columns]
+        update_columns = [c for c in columns if c not in key_columns]
+        staging_table = '%s_staging' % new_table
+
+        self.connection.execute('DROP TABLE IF EXISTS %s' % self.quote(new_table))
+        self.op.create_table(new_table, *[
+            sqlalchemy.Column(c.name, c.sql_type, nullable=(not c.is_key_column))
+            for c in extract_mapping.columns
+        ])
+        self.set_owner(new_table)
+
+        self.copy_to_staging_table(rows, staging_table, new_table, columns)
+        self.connection.execute('INSERT INTO %s (%s) %s' % (
+            self.quote(new_table),
+            ', '.join([self.quote(c) for c in key_columns + update_columns]),
+            self.select_staging_rows(staging_table, key_columns, update_columns),
+        ))
+        self.connection.execute('DROP TABLE %s' % self.quote(staging_table))
+
+        self.connection.execute('ALTER TABLE %s ADD CONSTRAINT %s PRIMARY KEY (%s)' % (
+            self.quote(new_table),
+            self.quote('%s_pkey' % new_table),
+            ', '.join([self.quote(k) for k in key_columns])
+        ))
+
+    def _swap_tables(self, new_table, table_name):
+        logger.info('Replacing reporting table %s with %s', table_name, new_table)
+        with get_instrumentation().timer('ddl', table=table_name, op='swap_tables'):
+            self.connection.execute('DROP TABLE IF EXISTS %s' % self.quote(table_name))
+            self.connection.execute('ALTER TABLE %s RENAME TO %s' % (self.quote(new_table), self.quote(table_name)))
+            if self.connection.dialect.name == 'postgresql':
+                # keep the default constraint name so that later rebuilds don't clash with it
+                self.connection.execute('ALTER INDEX %s RENAME TO %s' % (
+                    self.quote('%s_pkey' % new_table), self.quote('%s_pkey' % table_name)
+                ))
 
     def upsert(self, table, row_dict, key_columns):
 
@@ -164,8 +665,10 @@ class SqlBackend(CtableBackend):
         # The latter may crash, while the former may overwrite data (which should be fine if whatever is
         # racing against this is importing from the same source... if not you are busted anyhow
         try:
-            insert = table.insert().values(**row_dict)
-            self.connection.execute(insert)
+            with self.savepoint():
+                insert = table.insert().values(**row_dict)
+                with get_instrumentation().timer('sql_execute', table=table.name, op='insert'):
+                    self.connection.execute(insert)
         except sqlalchemy.exc.IntegrityError:
             update = table.update()
             for k in key_columns:
@@ -175,29 +678,677 @@ class SqlBackend(CtableBackend):
             if row_dict:
                 # if there are any values to update
                 update = update.values(**row_dict)
-                self.connection.execute(update)
+                with get_instrumentation().timer('sql_execute', table=table.name, op='update'):
+                    self.connection.execute(update)
 
-    def write_rows(self, rows, extract_mapping):
+    def write_rows(self, rows, extract_mapping, on_commit=None):
         table_name = extract_mapping.table_name
-        columns = extract_mapping.columns
         key_columns = extract_mapping.key_columns
 
-        self.init_table(table_name, columns)
-        for row_dict in rows:
-            logger.debug(".")
-            self.upsert(self.table(table_name), row_dict, key_columns)
+        table = self.get_table(extract_mapping)
+        try:
+            self._write_rows(table, rows, key_columns, on_commit=on_commit)
+        except sqlalchemy.exc.SQLAlchemyError:
+            # the table may have been changed by another process
+            self.invalidate_table(table_name)
+            raise
+
+    def _write_rows(self, table, rows, key_columns, on_commit=None):
+        table_name = table.name
+        with TransactionBatch(self.connection, self.commit_every, self.commit_interval, on_commit) as batch:
+            if self.supports_bulk_upsert:
+                for chunk in chunked(rows, self.batch_size):
+                    logger.debug("Upserting %d rows", len(chunk))
+                    self.bulk_upsert(table_name, chunk, key_columns)
+                    batch.add(len(chunk))
+            else:
+                for row_dict in rows:
+                    logger.debug(".")
+                    try:
+                        with self.savepoint():
+                            self.upsert(table, row_dict, key_columns)
+                    except (sqlalchemy.exc.DataError, sqlalchemy.exc.IntegrityError):
+                        logger.exception("Unable to write row to %s: %s", table_name, row_dict)
+                    batch.add(1)
+
+
+class _ColumnArray(object):
+    """
+    Values of a single column. Integers and dates (as ordinals) are kept in typed arrays with a
+    separate null mask. Other types are kept in a list.
+    """
+
+    def __init__(self, column):
+        self.name = column.name
+        self.data_type = column.data_type
+        self.max_length = column.max_length or 255 if column.data_type == 'string' else None
+        if self.data_type in ('integer', 'date'):
+            self.values = array.array('l')
+            self.nulls = bytearray()
+        else:
+            self.values = []
+            self.nulls = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def validate(self, value):
+        """
+        :raise ValueError: if SQL wouldn't accept the value
+        """
+        if value is None:
+            return
+        if self.data_type == 'integer':
+            if not -2 ** 31 <= int(value) < 2 ** 31:
+                raise ValueError('Integer out of range: %s' % value)
+        elif self.data_type == 'string' and isinstance(value, six.string_types) and len(value) > self.max_length:
+            raise ValueError('Value too long for %s: %s' % (self.name, value))
+
+    def _pack(self, value):
+        if value is None:
+            return 0
+        return value.toordinal() if self.data_type == 'date' else int(value)
+
+    def append(self, value):
+        if self.nulls is None:
+            self.values.append(value)
+        else:
+            self.values.append(self._pack(value))
+            self.nulls.append(value is None)
+
+    def set(self, index, value):
+        if self.nulls is None:
+            self.values[index] = value
+        else:
+            self.values[index] = self._pack(value)
+            self.nulls[index] = value is None
+
+    def get(self, index):
+        if self.nulls is None:
+            return self.values[index]
+        if self.nulls[index]:
+            return None
+        value = self.values[index]
+        return datetime.date.fromordinal(value) if self.data_type == 'date' else value
+
+
+class InMemoryTable(object):
+    """
+    Rows of a single table stored by column. Rows are upserted on the key columns.
+
+    At most `max_rows` rows are kept. Once the table is full further rows are dropped unless
+    `ring` is True in which case the oldest rows are replaced.
+    """
+
+    def __init__(self, mapping, max_rows, ring=False):
+        self.table_name = mapping.table_name
+        self.key_columns = mapping.key_columns
+        self.columns = [_ColumnArray(c) for c in mapping.columns]
+        self.max_rows = max_rows
+        self.ring = ring
+        self.index = {}  # key -> row position
+        self.keys = []  # row position -> key
+        self.next_position = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def upsert(self, row_dict):
+        key = tuple([row_dict.get(k) for k in self.key_columns])
+        position = self.index.get(key)
+        try:
+            for column in self.columns:
+                if column.name in row_dict:
+                    column.validate(row_dict[column.name])
+        except (TypeError, ValueError):
+            logger.exception("Unable to write row to %s: %s", self.table_name, row_dict)
+            self.rejected += 1
+            return
+
+        if position is not None:
+            for column in self.columns:
+                if column.name in row_dict:
+                    column.set(position, row_dict[column.name])
+        elif len(self.keys) < self.max_rows:
+            self.index[key] = len(self.keys)
+            self.keys.append(key)
+            for column in self.columns:
+                column.append(row_dict.get(column.name))
+        elif self.ring and self.max_rows:
+            position = self.next_position
+            del self.index[self.keys[position]]
+            self.index[key] = position
+            self.keys[position] = key
+            for column in self.columns:
+                column.set(position, row_dict.get(column.name))
+            self.next_position = (position + 1) % self.max_rows
+            self.dropped += 1
+        else:
+            self.dropped += 1
+
+    def iter_rows(self):
+        """
+        :return: the rows as lists of values in the order they were first written
+        """
+        count = len(self.keys)
+        for i in range(count):
+            position = (self.next_position + i) % count
+            yield [column.get(position) for column in self.columns]
+
+    @property
+    def data(self):
+        return {
+            'table_name': self.table_name,
+            'columns': [c.name for c in self.columns],
+            'rows': list(self.iter_rows()),
+            'dropped': self.dropped,
+            'rejected': self.rejected,
+        }
 
 
 class InMemoryBackend(CtableBackend):
-    data = {}
+    """
+    Keep the rows in memory e.g. to preview an extract. Values are stored as SQL would store them:
+    missing values are None and rows with the same key are combined.
+
+    :param max_rows: maximum number of rows kept for each table. Defaults to the
+                     CTABLE_MEMORY_BACKEND_MAX_ROWS setting.
+    :param ring: keep the latest `max_rows` rows instead of the first
+    """
+
+    def __init__(self, max_rows=None, ring=False):
+        if max_rows is None:
+            max_rows = getattr(settings, 'CTABLE_MEMORY_BACKEND_MAX_ROWS', 10000)
+        self.max_rows = max_rows
+        self.ring = ring
+        self.tables = {}
+        self.last_table = None
+
+    def write_rows(self, rows, extract_mapping, on_commit=None):
+        table = self.get_table(extract_mapping)
+        for row_dict in rows:
+            table.upsert(row_dict)
+
+    def get_table(self, mapping):
+        table_name = mapping.table_name
+        table = self.tables.get(table_name)
+        if table is None:
+            table = self.tables[table_name] = InMemoryTable(mapping, self.max_rows, ring=self.ring)
+        self.last_table = table_name
+        return table
+
+    def clear_all_data(self, mapping):
+        self.tables.pop(mapping.table_name, None)
+
+    @property
+    def data(self):
+        """
+        The table written to last as a dict of table_name, columns and rows
+        """
+        table = self.tables.get(self.last_table)
+        return table.data if table is not None else {}
+
+
+class _CsvFileWriter(object):
+    extension = 'csv.gz'
+
+    def __init__(self, path, columns):
+        self.file = open(path, 'wb')
+        self.gzip = gzip.GzipFile(fileobj=self.file, mode='wb')
+        self.writer = csv.writer(self.gzip)
+        self.columns = columns
+        self.writer.writerow([c.name for c in columns])
+
+    def write(self, row_dict):
+        self.writer.writerow([self.format_value(row_dict.get(c.name)) for c in self.columns])
+
+    def format_value(self, value):
+        if value is None:
+            return ''
+        elif isinstance(value, (datetime.date, datetime.datetime)):
+            return value.isoformat()
+        elif isinstance(value, six.text_type):
+            return value.encode('utf-8')
+        return value
+
+    @property
+    def size(self):
+        return self.file.tell()
+
+    def close(self):
+        self.gzip.close()
+        self.file.close()
+
+
+class _ParquetFileWriter(object):
+    """
+    Buffers up to `row_group_size` rows by column and writes each buffer as a row group
+    """
+    extension = 'parquet'
+
+    def __init__(self, path, columns, row_group_size):
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.path = path
+        self.columns = columns
+        self.row_group_size = row_group_size
+        self.schema = pyarrow.schema([
+            pyarrow.field(c.name, self.arrow_type(c), nullable=not c.is_key_column) for c in columns
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='snappy')
+        self.buffer = dict((c.name, []) for c in columns)
+        self.buffered = 0
+        self.size = 0
+
+    def arrow_type(self, column):
+        return {
+            'string': self.pyarrow.string(),
+            'integer': self.pyarrow.int32(),
+            'date': self.pyarrow.date32(),
+            'datetime': self.pyarrow.timestamp('us'),
+        }[column.data_type]
+
+    def write(self, row_dict):
+        for name, values in self.buffer.items():
+            values.append(row_dict.get(name))
+        self.buffered += 1
+        if self.buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffered:
+            arrays = [self.pyarrow.array(self.buffer[c.name], type=self.arrow_type(c)) for c in self.columns]
+            self.writer.write_table(self.pyarrow.Table.from_arrays(arrays, schema=self.schema))
+            self.buffer = dict((c.name, []) for c in self.columns)
+            self.buffered = 0
+            self.size = os.path.getsize(self.path)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class FileBackend(CtableBackend):
+    """
+    Write the rows to compressed files for loading into another database. Each call to
+    write_rows is an export of the rows for a table which is written to
+    `<directory>/<table name>/` as one or more files and a manifest listing them:
+
+    * `<export>-00001.csv.gz` (or `.parquet`): the rows. A new file is started after
+      `max_rows` rows or once the file reaches `max_bytes`.
+    * `<export>.manifest.json`: the files with their row counts, the key columns and
+      the schema of the table. It is written once all the files are complete.
+
+    Rows aren't combined with those of previous exports so they should be upserted on the
+    key columns when they are loaded. The manifest for a rebuild has `replace` set to show
+    that the existing data should be replaced.
+
+    CSV files are gzipped and have a header row. Parquet files need pyarrow.
+    """
+
+    def __init__(self, directory=None, format=None, max_rows=None, max_bytes=None, row_group_size=None):
+        self.directory = directory or getattr(settings, 'CTABLE_FILE_BACKEND_DIR', 'ctable_exports')
+        self.format = format or getattr(settings, 'CTABLE_FILE_BACKEND_FORMAT', 'csv')
+        if self.format not in ('csv', 'parquet'):
+            raise ValueError('Unknown file format: %s' % self.format)
+        self.max_rows = max_rows or getattr(settings, 'CTABLE_FILE_BACKEND_MAX_ROWS', 1000000)
+        self.max_bytes = max_bytes or getattr(settings, 'CTABLE_FILE_BACKEND_MAX_BYTES', 256 * 1024 * 1024)
+        self.row_group_size = row_group_size or getattr(settings, 'CTABLE_FILE_BACKEND_ROW_GROUP_SIZE', 10000)
+
+    def write_rows(self, rows, extract_mapping, on_commit=None):
+        self.export_rows(rows, extract_mapping)
+
+    def rebuild_rows(self, rows, extract_mapping):
+        self.export_rows(rows, extract_mapping, replace=True)
+
+    def export_rows(self, rows, extract_mapping, replace=False):
+        """
+        :return: path of the manifest
+        """
+        table_dir = self.table_dir(extract_mapping)
+        if not os.path.isdir(table_dir):
+            os.makedirs(table_dir)
+        export = '%s-%s' % (datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'), uuid.uuid4().hex[:8])
+        columns = extract_mapping.columns
+
+        files = []
+        writer = None
+        path = None
+        try:
+            with get_instrumentation().timer('file_export', table=extract_mapping.table_name):
+                for row_dict in rows:
+                    if writer is None:
+                        path = os.path.join(table_dir, '%s-%05d.%s.part' % (
+                            export, len(files) + 1, self.extension))
+                        writer = self.get_writer(path, columns)
+                        files.append({'path': os.path.basename(path)[:-len('.part')], 'rows': 0})
+                    writer.write(row_dict)
+                    files[-1]['rows'] += 1
+                    if files[-1]['rows'] >= self.max_rows or writer.size >= self.max_bytes:
+                        self._close(writer, path)
+                        writer = None
+                if writer is not None:
+                    self._close(writer, path)
+                    writer = None
+        except Exception:
+            if writer is not None:
+                writer.close()
+            for f in files:
+                for name in (f['path'], f['path'] + '.part'):
+                    if os.path.exists(os.path.join(table_dir, name)):
+                        os.remove(os.path.join(table_dir, name))
+            raise
+
+        manifest_path = os.path.join(table_dir, '%s.manifest.json' % export)
+        with open(manifest_path + '.part', 'w') as f:
+            json.dump(self.get_manifest(extract_mapping, files, replace), f, indent=2)
+        os.rename(manifest_path + '.part', manifest_path)
+        return manifest_path
+
+    @property
+    def extension(self):
+        return _ParquetFileWriter.extension if self.format == 'parquet' else _CsvFileWriter.extension
+
+    def get_writer(self, path, columns):
+        if self.format == 'parquet':
+            return _ParquetFileWriter(path, columns, self.row_group_size)
+        return _CsvFileWriter(path, columns)
 
-    def write_rows(self, rows, extract_mapping):
+    def _close(self, writer, path):
+        writer.close()
+        os.rename(path, path[:-len('.part')])
+
+    def get_manifest(self, mapping, files, replace=False):
+        return {
+            'table_name': mapping.table_name,
+            'format': self.format,
+            'created': datetime.datetime.utcnow().isoformat(),
+            'replace': replace,
+            'key_columns': mapping.key_columns,
+            'columns': [{
+                'name': c.name,
+                'type': str(sqlalchemy.types.to_instance(c.sql_type)),
+                'nullable': not c.is_key_column,
+            } for c in mapping.columns],
+            'files': files,
+            'rows': sum(f['rows'] for f in files),
+        }
+
+    def table_dir(self, mapping):
+        return os.path.join(self.directory, mapping.table_name)
+
+    def check_mapping(self, mapping):
+        errors = []
+        if self.format == 'parquet':
+            try:
+                import pyarrow
+            except ImportError:
+                errors.append(_('pyarrow is required to write Parquet files'))
+        return {'errors': errors, 'warnings': []}
+
+    def clear_all_data(self, mapping):
+        table_dir = self.table_dir(mapping)
+        if os.path.isdir(table_dir):
+            shutil.rmtree(table_dir)
+
+
+DUCKDB_TYPE_MAP = {
+    'VARCHAR': 'string',
+    'INTEGER': 'integer',
+    'BIGINT': 'integer',
+    'DATE': 'date',
+    'TIMESTAMP': 'datetime',
+}
+
+
+def _duckdb_value(value):
+    """
+    Older versions of duckdb can't bind dates so they are passed as strings which DuckDB casts
+    to the column type.
+    """
+    if isinstance(value, datetime.date):
+        return str(value)
+    return value
+
+
+class _DuckDbTransactions(object):
+    """
+    Adapts a DuckDB connection to the begin / commit / rollback interface used by TransactionBatch
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def begin(self):
+        self.connection.begin()
+        return self
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+
+class DuckDbBackend(CtableBackend):
+    """
+    Write the rows to a table in an embedded DuckDB database file. Requires the duckdb package.
+
+    Tables are created and updated from the mapping's columns and rows are upserted on the key
+    columns in batches of CTABLE_UPSERT_BATCH_SIZE rows. Each batch reads the existing rows with
+    the same keys, deletes them and inserts them again merged with the new values. Rows which
+    DuckDB rejects fail the extract since a failed statement aborts the whole transaction.
+
+    The tables have no primary key since older versions of DuckDB can't delete and insert the same
+    key in one transaction. The backend keeps the keys unique instead by only letting one thread
+    write to each table at a time.
+
+    The file is opened when a connection is first used inside a ``with`` block and closed again
+    when the last block exits. DuckDB only allows one process to open the file for writing so
+    extracts to the same file must not run in more than one worker process at a time.
+    """
+
+    def __init__(self, path=None, batch_size=None, commit_every=None, commit_interval=None):
+        if duckdb is None:
+            raise ImproperlyConfigured('DuckDbBackend requires the duckdb package')
+        self.path = path or getattr(settings, 'CTABLE_DUCKDB_PATH', 'ctable.duckdb')
+        self.batch_size = batch_size or getattr(settings, 'CTABLE_UPSERT_BATCH_SIZE', 250)
+        self.commit_every = commit_every or getattr(settings, 'CTABLE_COMMIT_EVERY', 10000)
+        self.commit_interval = commit_interval or getattr(settings, 'CTABLE_COMMIT_INTERVAL', 30)
+        self.database = None
+        self.database_users = 0
+        self.database_lock = threading.Lock()
+        self.table_locks = {}
+        self._local = threading.local()
+
+    def __enter__(self):
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._local.depth -= 1
+        if not self._local.depth:
+            connection = getattr(self._local, 'connection', None)
+            if connection is not None:
+                self._local.connection = None
+                connection.close()
+                self._release_database()
+
+    @property
+    def connection(self):
+        """
+        The database is only opened for writing when a connection is first needed so that
+        contexts which only read (e.g. check_mapping) don't take the write lock on the file.
+        """
+        if not getattr(self._local, 'depth', 0):
+            raise Exception("DuckDbBackend must be used as a context manager before accessing the connection")
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            with self.database_lock:
+                if self.database is None:
+                    self.database = duckdb.connect(self.path)
+                self.database_users += 1
+                # each thread needs its own connection to the database
+                connection = self._local.connection = self.database.cursor()
+        return connection
+
+    def _release_database(self):
+        with self.database_lock:
+            self.database_users -= 1
+            if not self.database_users:
+                # release the lock on the file so that other processes can open it
+                self.database.close()
+                self.database = None
+
+    def _get_lock(self, table_name):
+        with self.database_lock:
+            if table_name not in self.table_locks:
+                self.table_locks[table_name] = threading.Lock()
+
+        return TimedLock(self.table_locks[table_name], table_name)
+
+    def quote(self, name):
+        return '"%s"' % name.replace('"', '""')
+
+    def get_columns(self, table_name, connection=None):
+        """
+        :return: dict of column name to (is primary key, data type) or None if the table doesn't exist
+        """
+        connection = connection or self.connection
+        connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?", [table_name])
+        if not connection.fetchone()[0]:
+            return None
+
+        columns = {}
+        connection.execute("PRAGMA table_info('%s')" % table_name.replace("'", "''"))
+        for cid, name, type_name, notnull, default, pk in connection.fetchall():
+            columns[name] = (bool(pk), DUCKDB_TYPE_MAP.get(type_name.split('(')[0].upper()))
+        return columns
+
+    def column_sql(self, column):
+        return '%s %s%s' % (
+            self.quote(column.name),
+            sqlalchemy.types.to_instance(column.sql_type),
+            ' NOT NULL' if column.is_key_column else ''
+        )
+
+    def init_mapping(self, mapping):
+        self.init_table(mapping.table_name, mapping.columns)
+
+    def init_table(self, table_name, column_defs):
+        existing_columns = self.get_columns(table_name)
+        if existing_columns is None:
+            logger.info('Creating new reporting table: %s', table_name)
+            with get_instrumentation().timer('ddl', table=table_name, op='create_table'):
+                self.connection.execute('CREATE TABLE %s (%s)' % (
+                    self.quote(table_name),
+                    ', '.join([self.column_sql(c) for c in column_defs])
+                ))
+            return
+
+        for column in column_defs:
+            if column.name not in existing_columns:
+                logger.info('Adding column to reporting table: %s.%s', table_name, column.name)
+                with get_instrumentation().timer('ddl', table=table_name, op='add_column'):
+                    self.connection.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                        self.quote(table_name), self.column_sql(column)
+                    ))
+            elif existing_columns[column.name][1] != column.data_type:
+                raise ColumnTypeException("Column types don't match", table_name, column.name)
+
+    def check_mapping(self, mapping):
+        table_columns = self._read_columns(mapping.table_name)
+        if table_columns is None:
+            return {'errors': [], 'warnings': []}
+        return check_table_columns(table_columns, mapping)
+
+    def _read_columns(self, table_name):
+        if getattr(self._local, 'connection', None) is not None:
+            return self.get_columns(table_name)
+
+        with self.database_lock:
+            if self.database is not None:
+                connection = self.database.cursor()
+            elif os.path.exists(self.path):
+                connection = duckdb.connect(self.path, read_only=True)
+            else:
+                return None
+            try:
+                return self.get_columns(table_name, connection)
+            finally:
+                connection.close()
+
+    def write_rows(self, rows, extract_mapping, on_commit=None):
+        with self, self._get_lock(extract_mapping.table_name):
+            self.init_mapping(extract_mapping)
+            transactions = _DuckDbTransactions(self.connection)
+            with TransactionBatch(transactions, self.commit_every, self.commit_interval, on_commit) as batch:
+                self._write_rows(rows, extract_mapping, batch)
+
+    def rebuild_rows(self, rows, extract_mapping):
+        """
+        Replace the table and load the rows in a single transaction
+        """
         table_name = extract_mapping.table_name
-        columns = [c.name for c in extract_mapping.columns]
+        with self, self._get_lock(table_name):
+            self.connection.begin()
+            try:
+                with get_instrumentation().timer('ddl', table=table_name, op='drop_table'):
+                    self.connection.execute('DROP TABLE IF EXISTS %s' % self.quote(table_name))
+                self.init_mapping(extract_mapping)
+                self._write_rows(rows, extract_mapping)
+            except Exception:
+                self.connection.rollback()
+                raise
+            self.connection.commit()
 
-        if not self.data:
-            self.data = {'table_name': table_name, 'columns': columns, 'rows': []}
+    def _write_rows(self, rows, extract_mapping, batch=None):
+        table_name = extract_mapping.table_name
+        key_columns = extract_mapping.key_columns
+        for chunk in chunked(rows, self.batch_size):
+            self._upsert_rows(table_name, chunk, key_columns)
+            if batch:
+                batch.add(len(chunk))
 
+    def _upsert_rows(self, table_name, rows, key_columns):
+        """
+        Replace the rows with the same keys as `rows`. Columns which are missing from a row keep
+        their existing values.
+        """
+        def row_key(row_dict):
+            return tuple([_duckdb_value(row_dict[k]) for k in key_columns])
+
+        merged = OrderedDict()
         for row_dict in rows:
-            row_arr = [row_dict[c] if c in row_dict else '' for c in columns]
-            self.data['rows'].append(row_arr)
+            merged.setdefault(row_key(row_dict), {}).update(row_dict)
+
+        table = self.quote(table_name)
+        key_sql = '(%s)' % ' AND '.join(['%s = ?' % self.quote(k) for k in key_columns])
+        where = ' OR '.join([key_sql] * len(merged))
+        key_params = [value for key in merged for value in key]
+        with get_instrumentation().timer('sql_execute', table=table_name, op='bulk_upsert'):
+            self.connection.execute('SELECT * FROM %s WHERE %s' % (table, where), key_params)
+            columns = [d[0] for d in self.connection.description]
+            existing = self.connection.fetchall()
+            for values in existing:
+                row_dict = dict(zip(columns, values))
+                row_dict.update(merged[row_key(row_dict)])
+                merged[row_key(row_dict)] = row_dict
+            if existing:
+                self.connection.execute('DELETE FROM %s WHERE %s' % (table, where), key_params)
+
+            placeholders = '(%s)' % ', '.join(['?'] * len(columns))
+            self.connection.execute('INSERT INTO %s (%s) VALUES %s' % (
+                table,
+                ', '.join([self.quote(c) for c in columns]),
+                ', '.join([placeholders] * len(merged))
+            ), [_duckdb_value(row_dict.get(c)) for row_dict in merged.values() for c in columns])
+
+    def clear_all_data(self, mapping):
+        table_name = mapping.table_name
+        with self:
+            with get_instrumentation().timer('ddl', table=table_name, op='drop_table'):
+                self.connection.execute('DROP TABLE IF EXISTS %s' % self.quote(table_name))
@@ -1,81 +1,508 @@
+from collections import namedtuple
 import functools
-from couchdbkit import ResourceNotFound
-from .models import SqlExtractMapping, ColumnDef, KeyMatcher
+import multiprocessing
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+import json
+from couchdbkit import Consumer, Database, ResourceConflict, ResourceNotFound
+from django.conf import settings
+from .models import SqlExtractMapping, ColumnDef, KeyMatcher, ExtractState, LOAD_MODE_COPY, LOAD_MODE_UPSERT
+from .pipeline import read_ahead, write_behind
+from .progress import as_reporter, WRITING
+from .plan import get_plan
+from .cache import mapping_cache
+from .converters import date_converter_stats
+from .instrumentation import get_instrumentation
+from .stats import FETCH, CONVERT, COMBINE, WRITE
 from couchdbkit.ext.django.loading import get_db
-from datetime import datetime, timedelta
+from datetime import datetime, time, timedelta
+from timeit import default_timer
+from dimagi.utils.modules import to_function
 import logging
+from restkit.conn import Connection
+from socketpool import ConnectionPool
 
 logger = logging.getLogger("ctable")
 
 fluff_view = 'fluff/generic'
 
+KeyRange = namedtuple('KeyRange', 'startkey endkey inclusive_end')
+"""Range of view keys to extract. The endkey is excluded unless inclusive_end is True."""
+
+_grain_pool = None  # (pid, size, ThreadPool)
+_grain_pool_lock = threading.Lock()
+
+
+def get_grain_pool(size):
+    """
+    Get the thread pool shared by all the Fluff diffs processed in this process. A new pool is
+    created if the size changes or the process has been forked since the pool was created.
+    """
+    global _grain_pool
+    pid = os.getpid()
+    with _grain_pool_lock:
+        if _grain_pool is None or _grain_pool[:2] != (pid, size):
+            if _grain_pool is not None and _grain_pool[0] == pid:
+                _grain_pool[2].close()
+            _grain_pool = (pid, size, ThreadPool(size))
+        return _grain_pool[2]
+
+
+class RowCounter(object):
+    """
+    Count rows as they are iterated over without holding on to them.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, rows):
+        for row in rows:
+            self.count += 1
+            yield row
+
+
+class KeyCheckpointer(object):
+    """
+    Track how far through the view the committed SQL rows go for mappings whose rows are
+    ordered by key (see SqlExtractMapping.couch_key_ordered) so that an extract can be resumed.
+
+    The view rows are grouped by the elements of the key that make up the SQL key. When the
+    backend commits, every SQL row for the groups up to the checkpoint has been written so
+    an extract can resume after that group without skipping or splitting a SQL row.
+    """
+
+    def __init__(self, mapping, callback):
+        self.key_size = len(mapping.couch_key_prefix or []) + len(mapping.key_columns)
+        self.key_columns = mapping.key_columns
+        self.callback = callback
+        self.current_group = None
+        self.last_row = None
+        self.safe_group = None
+        self.saved_group = None
+
+    def read(self, couch_rows):
+        """
+        Wrap the view rows before they are converted
+        """
+        for row in couch_rows:
+            self.current_group = row['key'][:self.key_size]
+            yield row
+
+    def converted(self, sql_rows):
+        """
+        Wrap the converted rows before they are combined. The combined row for a SQL key is
+        passed on as soon as the first row of the next SQL key arrives so at that point the
+        view rows up to the group of the previous row are done.
+        """
+        for sql_row in sql_rows:
+            sql_key = tuple([sql_row[k] for k in self.key_columns])
+            if self.last_row is not None and self.last_row[0] != sql_key:
+                self.safe_group = self.last_row[1]
+            self.last_row = (sql_key, self.current_group)
+            yield sql_row
+
+    def on_commit(self):
+        if self.safe_group is not None and self.safe_group != self.saved_group:
+            self.callback(self.safe_group)
+            self.saved_group = self.safe_group
+
+
+def _extract_shard(args):
+    """
+    Extract a single shard in a worker process. The worker opens its own CouchDB and SQL
+    connections rather than sharing the ones inherited from the parent process.
+    """
+    from ctable.util import create_backend
+    db_uri, mapping_json, key_range, load_mode = args
+    mapping = SqlExtractMapping.wrap(mapping_json)
+    mapping.database = None  # db_uri already points at the mapping's database
+    db = Database(db_uri, pool=ConnectionPool(factory=Connection))
+    extractor = CtableExtractor(db, create_backend(mapping.backend))
+    return extractor.extract(mapping, key_range=key_range, load_mode=load_mode, pipelined=False)
+
 
 class CtableExtractor(object):
     def __init__(self, couch_db, backend):
         self.db = couch_db
         self.backend = backend
 
-        from ctable.util import combine_rows
+        from ctable.util import combine_rows, combine_sorted_rows
         self.combine_rows = combine_rows
+        self.combine_sorted_rows = combine_sorted_rows
 
-    def extract(self, mapping, limit=None, date_range=None, status_callback=None):
+    def extract(self, mapping, limit=None, date_range=None, status_callback=None, load_mode=None,
+                pipelined=None, key_range=None, rebuild=False, page_size=None, stats=None, resume_key=None,
+                checkpoint=None):
         """
         Extract data from a CouchDb view into SQL
+
+        :param load_mode: Override the mapping's load_mode e.g. LOAD_MODE_COPY
+        :param pipelined: Read from CouchDB and write to SQL in background threads so that
+                          fetching, converting and writing overlap. Defaults to the
+                          CTABLE_PIPELINED_EXTRACT setting.
+        :param key_range: KeyRange to extract instead of the range given by the mapping
+                          and date_range. See get_shards.
+        :param rebuild: Replace all the existing data with the extracted rows. The data is
+                        loaded into a new table which replaces the existing one once the
+                        extract completes. The whole view is extracted and `limit` can't
+                        be used.
+        :param page_size: Read the view in pages of this many rows instead of in a single
+                          request. Defaults to the CTABLE_VIEW_PAGE_SIZE setting. The total
+                          number of rows isn't known up front when paging.
+        :param stats: ExtractStats to record the row counts and stage timings in
+        :param status_callback: ProgressReporter or a function called with the total and current
+                                number of rows. Progress is reported every CTABLE_PROGRESS_INTERVAL
+                                seconds.
+        :param checkpoint: function called with the view key group (the elements of the view key
+                           that make up the SQL key) up to which the rows have been committed.
+                           See supports_checkpoints.
+        :param resume_key: resume an extract after a view key group given to `checkpoint`
         """
-        startkey, endkey = self.get_couch_keys(mapping, date_range=date_range)
+        if rebuild:
+            if limit:
+                raise ValueError("Can't rebuild %s with a limit" % mapping.name)
+            # anything outside the date range would be lost when the table is replaced
+            date_range = -1
+
+        started = default_timer()
+        progress = as_reporter(status_callback)
+        checkpointer = None
+        if checkpoint:
+            if self.supports_checkpoints(mapping, load_mode=load_mode, rebuild=rebuild):
+                checkpointer = KeyCheckpointer(mapping, checkpoint)
+                # rows have to be committed in the same thread that tracks them
+                pipelined = False
+            else:
+                logger.warning("Checkpoints aren't supported for %s", mapping.name)
+        if pipelined is None:
+            pipelined = getattr(settings, 'CTABLE_PIPELINED_EXTRACT', False)
+        page_size = page_size or getattr(settings, 'CTABLE_VIEW_PAGE_SIZE', None)
 
         db = get_db(mapping.database) if mapping.database else self.db
 
-        kwargs = mapping.couch_view_params
-        if mapping.couch_group_level:
-            kwargs['group_level'] = mapping.couch_group_level
-        result = self.get_couch_rows(mapping.couch_view, startkey, endkey, db=db, limit=limit, **kwargs)
+        kwargs = self.get_view_params(mapping)
+        if key_range:
+            startkey, endkey = key_range.startkey, key_range.endkey
+            if not key_range.inclusive_end:
+                kwargs['inclusive_end'] = False
+        else:
+            startkey, endkey = self.get_couch_keys(mapping, date_range=date_range)
+        if resume_key is not None:
+            logger.info("Resuming %s after %s", mapping.name, resume_key)
+            startkey = list(resume_key) + [{}]
+
+        if progress:
+            progress.report()
+
+        if page_size:
+            couch_rows = self.iter_couch_rows(mapping.couch_view, startkey, endkey, page_size, db=db,
+                                              limit=limit, prefetch=pipelined, stats=stats, **kwargs)
+            total_rows = None
+        else:
+            result = self.get_couch_rows(mapping.couch_view, startkey, endkey, db=db, limit=limit, **kwargs)
+            # the view is requested when the result is first used
+            get_total = lambda: result.total_rows
+            with get_instrumentation().timer('view_request', view=mapping.couch_view):
+                total_rows = stats.timed_setup(FETCH, get_total) if stats else get_total()
+            couch_rows = result
+            if pipelined and total_rows:
+                couch_rows = read_ahead(result, maxsize=self.pipeline_queue_size)
+
+        couch_counter = RowCounter()
+        sql_counter = RowCounter()
+        if total_rows != 0:
+            if total_rows:
+                logger.info("Total rows: %d", total_rows)
+
+            if progress:
+                progress.set_total(total_rows)
+
+            if stats:
+                couch_rows = stats.timed(FETCH, couch_rows)
+            if checkpointer:
+                couch_rows = checkpointer.read(couch_rows)
+            rows = self.couch_rows_to_sql_rows(couch_counter(couch_rows), mapping,
+                                               status_callback=progress.update if progress else None)
+            if checkpointer:
+                rows = checkpointer.converted(rows)
+            if stats:
+                rows = stats.timed(CONVERT, rows, upstream=FETCH)
+            if limit:
+                rows = sql_counter(rows)
+
+            munged_rows = self.combine_mapping_rows(rows, mapping, chunksize=(limit or 250))
+            if progress:
+                # writing starts as soon as the backend gets the first rows
+                munged_rows = progress.track(munged_rows, WRITING)
+            if stats:
+                munged_rows = stats.count_written(stats.timed(COMBINE, munged_rows, upstream=CONVERT))
+            if pipelined:
+                write = functools.partial(self.write_rows_to_sql, extract_mapping=mapping, load_mode=load_mode,
+                                          rebuild=rebuild)
+                write = functools.partial(write_behind, write, munged_rows, maxsize=self.pipeline_queue_size)
+            else:
+                write = functools.partial(self.write_rows_to_sql, munged_rows, mapping, load_mode=load_mode,
+                                          rebuild=rebuild, on_commit=checkpointer.on_commit if checkpointer else None)
+            if stats:
+                stats.timed_call(WRITE, COMBINE, write)
+            else:
+                write()
+        elif rebuild:
+            self.write_rows_to_sql([], mapping, rebuild=True)
+
+        if stats:
+            stats.rows_read += couch_counter.count
+            if not page_size:
+                stats.record_batch(FETCH, couch_counter.count)
+
+        instrumentation = get_instrumentation()
+        instrumentation.timing('extract', default_timer() - started, table=mapping.table_name)
+        instrumentation.count('rows_read', couch_counter.count, table=mapping.table_name)
+
+        if progress:
+            progress.finish()
+
+        logger.debug("Date converter cache: %s", date_converter_stats())
+        return couch_counter.count, sql_counter.count
+
+    def extract_incremental(self, mapping, status_callback=None, load_mode=None, stats=None):
+        """
+        Extract only the view keys affected by documents that changed since the last run.
+        The first run does a full extract and records the current sequence of the database.
 
-        total_rows = result.total_rows
-        rows_with_value = 0
-        if total_rows > 0:
-            logger.info("Total rows: %d", total_rows)
+        The view key prefixes for each change are given by the mapping's changes_key_function
+        and are re-queried in the same way as the grains for a Fluff diff.
+        """
+        state = ExtractState.for_mapping(mapping)
+        db = get_db(mapping.database) if mapping.database else self.db
+        progress = as_reporter(status_callback)
+
+        if state.changes_seq is None:
+            # get the sequence before extracting so that changes made during the extract
+            # are included in the next run
+            seq = db.info()['update_seq']
+            result = self.extract(mapping, status_callback=progress, load_mode=load_mode, stats=stats)
+        else:
+            if progress:
+                progress.report()
+            grains, seq = self.get_changed_grains(mapping, db, state.changes_seq)
+            logger.info("Re-extracting %d key prefixes for %s", len(grains), mapping.name)
+            recalculate = functools.partial(self.recalculate_grains, grains, mapping.database,
+                                            couch_view=mapping.couch_view, **self.get_view_params(mapping))
+            couch_rows = stats.timed_call(FETCH, None, recalculate) if stats else recalculate()
+            if progress:
+                progress.set_total(len(couch_rows))
+            sql_rows = self.couch_rows_to_sql_rows(couch_rows, mapping,
+                                                   status_callback=progress.update if progress else None)
+            if stats:
+                sql_rows = stats.timed(CONVERT, sql_rows)
+            munged_rows = self.combine_mapping_rows(sql_rows, mapping)
+            if progress:
+                munged_rows = progress.track(munged_rows, WRITING)
+            if stats:
+                munged_rows = stats.count_written(stats.timed(COMBINE, munged_rows, upstream=CONVERT))
+                stats.rows_read += len(couch_rows)
+
+            write = functools.partial(self.write_rows_to_sql, munged_rows, mapping, load_mode=load_mode)
+            if stats:
+                stats.timed_call(WRITE, COMBINE, write)
+            else:
+                write()
+            if progress:
+                progress.finish()
+            result = len(couch_rows), 0
+
+        state.changes_seq = seq
+        state.save()
+        return result
 
-            if status_callback:
-                status_callback = functools.partial(status_callback, total_rows)
+    def get_changed_grains(self, mapping, db, since):
+        """
+        :return: tuple of the distinct view key prefixes affected by the changes since `since`
+                 and the last sequence read from the _changes feed
+        """
+        key_function = to_function(mapping.changes_key_function, failhard=True)
+        grains = []
+        seen = set()
+        seq = since
+        for change in self.get_changes(db, since):
+            seq = change['seq']
+            for grain in key_function(mapping, change):
+                grain_id = json.dumps(grain)
+                if grain_id not in seen:
+                    seen.add(grain_id)
+                    grains.append(list(grain))
+        return grains, seq
+
+    def get_changes(self, db, since):
+        batch_size = getattr(settings, 'CTABLE_CHANGES_BATCH_SIZE', 1000)
+        consumer = Consumer(db)
+        while True:
+            result = consumer.fetch(since=since, limit=batch_size, include_docs=True)
+            for change in result['results']:
+                yield change
+
+            since = result['last_seq']
+            if len(result['results']) < batch_size:
+                break
+
+    def extract_sharded(self, mapping, shards, processes=None, date_range=None, load_mode=None):
+        """
+        Split the mapping's key space into shards (see get_shards) and extract each shard
+        in a separate worker process.
 
-            rows = self.couch_rows_to_sql_rows(result, mapping, status_callback=status_callback)
-            if limit:
-                rows = list(rows)
-                rows_with_value = len(rows)
+        Daemonic processes such as celery workers using the prefork pool can't start worker
+        processes so the shards are extracted in threads instead. process_extract runs each shard
+        in a separate celery task (see ctable.tasks.start_sharded_extract) rather than using this.
 
-            munged_rows = self.combine_rows(rows, mapping, chunksize=(limit or 250))
-            self.write_rows_to_sql(munged_rows, mapping)
+        :param shards: Maximum number of shards to split the extract into
+        :param processes: Number of worker processes. Defaults to one per shard. With a
+                          single process the shards are extracted serially in this process.
+        """
+        key_ranges = self.get_shards(mapping, shards, date_range=date_range)
+        logger.info("Extracting %s in %d shards", mapping.name, len(key_ranges))
 
+        # create the table up front so that the workers don't race to create it
+        with self.backend:
+            self.backend.init_mapping(mapping)
+
+        processes = min(processes or len(key_ranges), len(key_ranges))
+        if processes == 1:
+            results = [self.extract(mapping, load_mode=load_mode, key_range=key_range)
+                       for key_range in key_ranges]
+        else:
+            db = get_db(mapping.database) if mapping.database else self.db
+            args = [(db.uri, mapping.to_json(), key_range, load_mode) for key_range in key_ranges]
+            if multiprocessing.current_process().daemon:
+                pool = ThreadPool(processes)
+            else:
+                pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_extract_shard, args, chunksize=1)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        total_rows = sum(r[0] for r in results)
+        rows_with_value = sum(r[1] for r in results)
         return total_rows, rows_with_value
 
+    def get_shards(self, mapping, shards, date_range=None):
+        """
+        Split the key range of the mapping into at most `shards` KeyRanges on the first key
+        element after the key prefix. When a date range is being used the range is split
+        into whole days, otherwise the boundaries are sampled from the distinct values of the
+        key element in the view.
+
+        The key element must be mapped to a key column so that all the view rows for a
+        row in SQL fall in the same shard. If it isn't the whole range is returned as a
+        single shard.
+        """
+        startkey, endkey = self.get_couch_keys(mapping, date_range=date_range)
+        whole_range = [KeyRange(startkey, endkey, True)]
+
+        index = len(mapping.couch_key_prefix)
+        column = None
+        for c in mapping.columns:
+            if c.is_key_column and c.value_source == 'key' and c.value_index == index:
+                column = c
+        if shards <= 1 or not column:
+            return whole_range
+
+        window = self.get_date_window(mapping, date_range=date_range)
+        if window:
+            start, end = window
+            day = datetime.combine(start.date(), time()) + timedelta(days=1)
+            candidates = []
+            while day < end:
+                candidates.append(day.strftime(mapping.couch_date_format))
+                day += timedelta(days=1)
+        else:
+            kwargs = dict(mapping.couch_view_params)
+            if not kwargs.get('reduce', True):
+                logger.warning("Can't sample shard boundaries for views that aren't reduced")
+                return whole_range
+
+            db = get_db(mapping.database) if mapping.database else self.db
+            kwargs['group_level'] = index + 1
+            result = self.get_couch_rows(mapping.couch_view, startkey, endkey, db=db, **kwargs)
+            values = [row['key'][index] for row in result if len(row['key']) > index]
+            # only split between values that give different values in SQL
+            candidates = [
+                value for previous, value in zip(values, values[1:])
+                if column.convert_type(value) != column.convert_type(previous)
+            ]
+
+        num_shards = min(shards, len(candidates) + 1)
+        boundaries = [candidates[(i * len(candidates)) // num_shards] for i in range(1, num_shards)]
+
+        prefix = list(mapping.couch_key_prefix)
+        keys = [startkey] + [prefix + [b] for b in boundaries] + [endkey]
+        return [
+            KeyRange(keys[i], keys[i + 1], i == len(keys) - 2)
+            for i in range(len(keys) - 1)
+        ]
+
+    def combine_mapping_rows(self, rows, mapping, chunksize=250):
+        """
+        Combine the rows for each SQL row. If the view returns the rows for each SQL row
+        consecutively they are combined as they stream past, otherwise in chunks.
+        """
+        if mapping.couch_key_ordered:
+            return self.combine_sorted_rows(rows, mapping)
+        return self.combine_rows(rows, mapping, chunksize=chunksize)
+
+    def get_view_params(self, mapping):
+        kwargs = dict(mapping.couch_view_params)
+        if mapping.couch_group_level:
+            kwargs['group_level'] = mapping.couch_group_level
+        return kwargs
+
+    @property
+    def pipeline_queue_size(self):
+        return getattr(settings, 'CTABLE_PIPELINE_QUEUE_SIZE', 10)
+
     def process_fluff_diff(self, diff, backend_name):
         """
         Given a Fluff diff, update the data in SQL to reflect the changes. This will
         query CouchDB in order to re-calculate all the grains that have changed.
         """
-        mapping = self.get_fluff_extract_mapping(diff, backend_name)
-        grains = self.get_fluff_grains(diff)
-        couch_rows = self.recalculate_grains(grains, diff['database'])
-        sql_rows = self.couch_rows_to_sql_rows(couch_rows, mapping)
-        munged_rows = self.combine_rows(sql_rows, mapping)
-        self.write_rows_to_sql(munged_rows, mapping)
+        with get_instrumentation().timer('fluff_diff', doc_type=diff['doc_type']):
+            mapping = self.get_fluff_extract_mapping(diff, backend_name)
+            grains = self.get_fluff_grains(diff)
+            couch_rows = self.recalculate_grains(grains, diff['database'])
+            sql_rows = self.couch_rows_to_sql_rows(couch_rows, mapping)
+            munged_rows = self.combine_rows(sql_rows, mapping)
+            self.write_rows_to_sql(munged_rows, mapping, load_mode=LOAD_MODE_UPSERT)
 
     def get_couch_keys(self, extract_mapping, date_range=None):
         startkey = list(extract_mapping.couch_key_prefix)
         endkey = list(extract_mapping.couch_key_prefix)
         date_format = extract_mapping.couch_date_format
-        if not date_range:
-            date_range = extract_mapping.couch_date_range
 
-        if date_range > 0 and date_format:
-            end = datetime.utcnow()
+        window = self.get_date_window(extract_mapping, date_range=date_range)
+        if window:
+            start, end = window
             endkey += [end.strftime(date_format)]
-            start = end - timedelta(days=date_range)
             startkey += [start.strftime(date_format)]
         endkey += [{}]
         return startkey, endkey
 
+    def get_date_window(self, extract_mapping, date_range=None):
+        """
+        :return: (start, end) datetimes to extract or None if the mapping isn't limited to a date range
+        """
+        if not date_range:
+            date_range = extract_mapping.couch_date_range
+
+        if date_range > 0 and extract_mapping.couch_date_format:
+            end = datetime.utcnow()
+            return end - timedelta(days=date_range), end
+
     def get_couch_rows(self, couch_view, startkey, endkey, db=None, **kwargs):
         db = db or self.db
 
@@ -91,9 +518,69 @@ class CtableExtractor(object):
             **kwargs)
         return result
 
-    def write_rows_to_sql(self, rows, extract_mapping):
+    def iter_couch_rows(self, couch_view, startkey, endkey, page_size, db=None, limit=None, prefetch=False,
+                        stats=None, **kwargs):
+        """
+        Lazily read the rows from a view in pages of `page_size` rows so that memory use doesn't
+        depend on the size of the view. Each page is requested with one extra row which gives the
+        startkey (and startkey_docid for map views) of the next page.
+
+        :param prefetch: Fetch the next page in a background thread while the current page is
+                         being processed.
+        :param stats: ExtractStats to record the page sizes in
+        """
+        instrumentation = get_instrumentation()
+
+        def pages():
+            page_startkey = startkey
+            docid = None
+            remaining = limit
+            while True:
+                page_limit = min(page_size, remaining) if remaining else page_size
+                params = dict(kwargs)
+                if docid is not None:
+                    params['startkey_docid'] = docid
+                with instrumentation.timer('view_page', view=couch_view):
+                    rows = list(self.get_couch_rows(couch_view, page_startkey, endkey, db=db,
+                                                    limit=page_limit + 1, **params))
+                instrumentation.count('view_rows', len(rows), view=couch_view)
+                if stats:
+                    stats.record_batch(FETCH, len(rows))
+                for row in rows[:page_limit]:
+                    yield row
+
+                if remaining:
+                    remaining -= len(rows[:page_limit])
+                if len(rows) <= page_limit or remaining == 0:
+                    break
+
+                next_row = rows[page_limit]
+                page_startkey = next_row['key']
+                docid = next_row.get('id')
+
+        if prefetch:
+            return read_ahead(pages(), maxsize=1, chunksize=page_size)
+        return pages()
+
+    def write_rows_to_sql(self, rows, extract_mapping, load_mode=None, rebuild=False, on_commit=None):
+        load_mode = load_mode or extract_mapping.load_mode
         with self.backend:
-            self.backend.write_rows(rows, extract_mapping)
+            if rebuild:
+                self.backend.rebuild_rows(rows, extract_mapping)
+            elif load_mode == LOAD_MODE_COPY:
+                self.backend.copy_rows(rows, extract_mapping)
+            elif on_commit:
+                self.backend.write_rows(rows, extract_mapping, on_commit=on_commit)
+            else:
+                self.backend.write_rows(rows, extract_mapping)
+
+    def supports_checkpoints(self, mapping, load_mode=None, rebuild=False):
+        """
+        Extracts can only be resumed if the rows for each SQL row are consecutive in the view and
+        are upserted in batches. Rebuilds and COPY loads are committed in a single transaction.
+        """
+        load_mode = load_mode or mapping.load_mode
+        return mapping.couch_key_ordered and not rebuild and load_mode == LOAD_MODE_UPSERT
 
     def couch_rows_to_sql_rows(self, couch_rows, mapping, status_callback=None):
         """
@@ -105,23 +592,32 @@ class CtableExtractor(object):
         OR
         * All columns in the mapping must match the row.
         """
-        num_cols = len(mapping.columns)
+        convert_row = get_plan(mapping).convert_row
+        instrumentation = get_instrumentation()
+        timed = instrumentation.enabled
+        elapsed = 0.0
         count = 0
         for crow in couch_rows:
-            sql_row = {}
-            non_key_match = False
-            for mc in mapping.columns:
-                if mc.matches(crow['key'], crow['value']):
-                    sql_row[mc.name] = mc.get_value(crow['key'], crow['value'])
-                    non_key_match = non_key_match or not mc.is_key_column
+            if timed:
+                start = default_timer()
+                sql_row = convert_row(crow['key'], crow['value'])
+                elapsed += default_timer() - start
+            else:
+                sql_row = convert_row(crow['key'], crow['value'])
 
             count += 1
-            if status_callback and (count % 100) == 0:
+            if timed and (count % 1000) == 0:
+                instrumentation.timing('convert_1k_rows', elapsed, table=mapping.table_name)
+                elapsed = 0.0
+            if status_callback and (count == 1 or (count % 100) == 0):
                 status_callback(count)
 
-            if non_key_match or len(sql_row) == num_cols:
+            if sql_row is not None:
                 yield sql_row
 
+        if status_callback:
+            status_callback(count)
+
     def get_fluff_grains(self, diff):
         """
         Get the list of grains that have changed as a result of this Fluff diff.
@@ -141,13 +637,36 @@ class CtableExtractor(object):
         view is emitting data as follows:
 
             [doc_type, group1... groupN, calc_name, emitter_name, emitter_value] = 1
+
+        Mappings are kept in the process level mapping cache so CouchDB is only queried
+        when the cached mapping expires or new columns need to be saved. A mapping which
+        doesn't need new columns is the cached instance so it must not be modified.
         """
         mapping_id = 'CtableFluffMapping_%s' % diff['doc_type']
-        save = False
         try:
-            mapping = SqlExtractMapping.get(mapping_id)
+            return self._update_fluff_extract_mapping(mapping_id, diff, backend_name)
+        except ResourceConflict:
+            # the cached mapping is out of date so reload it and try again
+            mapping_cache.invalidate(mapping_id)
+            return self._update_fluff_extract_mapping(mapping_id, diff, backend_name)
+
+    def _update_fluff_extract_mapping(self, mapping_id, diff, backend_name):
+        try:
+            cached = mapping_cache.get(mapping_id, SqlExtractMapping.get)
         except ResourceNotFound:
-            save = True
+            cached = None
+
+        column_names = cached.column_names if cached else frozenset()
+        num_groups = len(diff['group_names'])
+        indicator_names = ['{0}_{1}'.format(indicator['calculator'], indicator['emitter'])
+                           for indicator in diff['all_indicators']]
+        if cached and column_names.issuperset(diff['group_names']) and 'date' in column_names \
+                and column_names.issuperset(indicator_names):
+            return cached.mapping
+
+        if cached:
+            mapping = cached.copy()
+        else:
             mapping = SqlExtractMapping(_id=mapping_id,
                                         backend=backend_name,
                                         database=diff['database'],
@@ -157,32 +676,29 @@ class CtableExtractor(object):
                                         active=False,
                                         auto_generated=True)
 
+        column_names = set(column_names)
         for i, group in enumerate(diff['group_names']):
-            if not any(x.name == group for x in mapping.columns):
-                save = True
+            if group not in column_names:
+                column_names.add(group)
                 type_map = diff.get('group_type_map') or {}
                 mapping.columns.append(ColumnDef(name=group,
                                                  data_type=type_map.get(group, 'string'),
                                                  value_source='key',
                                                  value_index=1 + i))
 
-        num_groups = len(diff['group_names'])
-        if not any(x.name == 'date' for x in mapping.columns):
-            save = True
+        if 'date' not in column_names:
+            column_names.add('date')
             mapping.columns.append(ColumnDef(name='date',
                                              data_type='date',
                                              date_format="%Y-%m-%d",
                                              value_source='key',
                                              value_index=3 + num_groups))
 
-        existing_columns = [x.name for x in mapping.columns]
-        for indicator in diff['all_indicators']:
-            calc_name = indicator['calculator']
-            emitter_name = indicator['emitter']
-            name = '{0}_{1}'.format(calc_name, emitter_name)
-            if name not in existing_columns:
-                save = True
-                existing_columns.append(name)
+        for indicator, name in zip(diff['all_indicators'], indicator_names):
+            if name not in column_names:
+                column_names.add(name)
+                calc_name = indicator['calculator']
+                emitter_name = indicator['emitter']
                 mapping.columns.append(ColumnDef(name=name,
                                                  data_type='integer',
                                                  value_source='value',
@@ -192,23 +708,35 @@ class CtableExtractor(object):
                                                      KeyMatcher(index=2 + num_groups, value=emitter_name)
                                                  ]))
 
-        if save:
-            key_columns = [c for c in mapping.columns if c.is_key_column]
-            non_key_columns = [c for c in mapping.columns if not c.is_key_column]
-            mapping.columns = key_columns + sorted(non_key_columns, key=lambda c: c.name)
-
-            mapping.save()
+        key_columns = [c for c in mapping.columns if c.is_key_column]
+        non_key_columns = [c for c in mapping.columns if not c.is_key_column]
+        mapping.columns = key_columns + sorted(non_key_columns, key=lambda c: c.name)
 
+        mapping.save()
+        if not cached:
+            # saving only refreshes mappings that are already cached
+            mapping_cache.set(mapping)
         return mapping
 
-    def recalculate_grains(self, grains, database):
+    def recalculate_grains(self, grains, database, couch_view=fluff_view, **kwargs):
         """
-        Query CouchDB to get the updated value for the grains.
+        Query CouchDB to get the updated value for the grains. The grains are queried concurrently
+        (up to CTABLE_GRAIN_CONCURRENCY requests at a time) and the rows are returned in the same
+        order as the grains.
         """
-        result = []
-        for grain in grains:
-            result.extend(self.get_couch_rows(fluff_view, grain, grain + [{}], db=get_db(database)))
-        return result
+        db = get_db(database) if database else self.db
+        grains = list(grains)
+
+        def get_rows(grain):
+            return list(self.get_couch_rows(couch_view, grain, grain + [{}], db=db, **kwargs))
+
+        concurrency = getattr(settings, 'CTABLE_GRAIN_CONCURRENCY', 4)
+        if concurrency > 1 and len(grains) > 1:
+            grain_rows = get_grain_pool(concurrency).map(get_rows, grains)
+        else:
+            grain_rows = [get_rows(grain) for grain in grains]
+
+        return [row for rows in grain_rows for row in rows]
 
     def clear_all_data(self, mapping):
         with self.backend:
@@ -0,0 +1,106 @@
+import copy
+import threading
+import time
+from django.conf import settings
+
+
+def _rev_number(rev):
+    try:
+        return int(rev.split('-', 1)[0])
+    except (AttributeError, ValueError):
+        return None
+
+
+def _copy_mapping(mapping):
+    return type(mapping).wrap(copy.deepcopy(mapping.to_json()))
+
+
+class CachedMapping(object):
+    """
+    A cached mapping along with the state derived from its columns.
+    """
+    __slots__ = ('mapping', 'rev', 'column_names', 'expires')
+
+    def __init__(self, mapping, expires):
+        self.mapping = mapping
+        self.rev = mapping._rev
+        self.column_names = frozenset(c.name for c in mapping.columns)
+        self.expires = expires
+
+    def copy(self):
+        """
+        :return: a copy of the mapping which can be modified without affecting the cache
+        """
+        return _copy_mapping(self.mapping)
+
+
+class MappingCache(object):
+    """
+    Process level cache of mappings by ID. Entries expire after CTABLE_MAPPING_CACHE_TIMEOUT
+    seconds and are replaced whenever a mapping is saved in this process so changes made by
+    other processes are picked up within the timeout. An entry is never replaced by an older
+    revision of the same mapping.
+
+    The cache keeps its own copy of each mapping. Cached mappings are shared so they must not be
+    modified. Use CachedMapping.copy.
+    """
+
+    def __init__(self, timeout=None):
+        self._timeout = timeout
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        if self._timeout is not None:
+            return self._timeout
+        return getattr(settings, 'CTABLE_MAPPING_CACHE_TIMEOUT', 60)
+
+    def get(self, mapping_id, load):
+        """
+        :param load: function called with the mapping ID to load the mapping if it isn't cached
+        :return: CachedMapping
+        """
+        entry = self.entries.get(mapping_id)
+        if entry is None or entry.expires <= time.time():
+            entry = self._store(load(mapping_id))
+        return entry
+
+    def set(self, mapping):
+        """
+        Cache a copy of the mapping so that later changes to `mapping` don't affect the cache
+        """
+        return self._store(_copy_mapping(mapping))
+
+    def _store(self, mapping):
+        entry = CachedMapping(mapping, time.time() + self.timeout)
+        if self.timeout <= 0:
+            return entry
+
+        with self.lock:
+            current = self.entries.get(mapping._id)
+            if current is not None and current.rev != entry.rev:
+                current_number, new_number = _rev_number(current.rev), _rev_number(entry.rev)
+                if current_number and new_number and current_number > new_number:
+                    return current
+            self.entries[mapping._id] = entry
+        return entry
+
+    def refresh(self, mapping):
+        """
+        Replace the cached entry for a mapping that has been saved. Mappings that
+        aren't cached are ignored.
+        """
+        if mapping._id in self.entries:
+            self.set(mapping)
+
+    def invalidate(self, mapping_id):
+        with self.lock:
+            self.entries.pop(mapping_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+mapping_cache = MappingCache()
@@ -0,0 +1,119 @@
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from dimagi.ext.couchdbkit import DateTimeProperty
+from django.conf import settings
+
+_ISO_DATE = r'(\d{4})-(\d{2})-(\d{2})'
+_ISO_TIME = r'(\d{2}):(\d{2}):(\d{2})'
+
+# regular expressions for common formats which are much faster than strptime
+FAST_FORMATS = {
+    '%Y-%m-%d': re.compile(r'^%s\Z' % _ISO_DATE),
+    '%Y-%m-%dT%H:%M:%S': re.compile(r'^%sT%s\Z' % (_ISO_DATE, _ISO_TIME)),
+    '%Y-%m-%d %H:%M:%S': re.compile(r'^%s %s\Z' % (_ISO_DATE, _ISO_TIME)),
+    '%Y-%m-%dT%H:%M:%SZ': re.compile(r'^%sT%sZ\Z' % (_ISO_DATE, _ISO_TIME)),
+    '%Y-%m-%dT%H:%M:%S.%fZ': re.compile(r'^%sT%s\.(\d{1,6})Z\Z' % (_ISO_DATE, _ISO_TIME)),
+}
+
+_INVALID = object()
+
+_converters = {}
+_converters_lock = threading.Lock()
+
+
+def get_date_converter(date_format=None):
+    """
+    Get the shared DateConverter for the format so that the cache is shared by all columns
+    using the same format.
+    """
+    converter = _converters.get(date_format)
+    if converter is None:
+        with _converters_lock:
+            converter = _converters.setdefault(date_format, DateConverter(date_format))
+    return converter
+
+
+def date_converter_stats():
+    return dict((date_format, converter.stats) for date_format, converter in _converters.items())
+
+
+def _strptime(date_format):
+    regex = FAST_FORMATS.get(date_format)
+    strptime = datetime.strptime
+
+    def parse(value):
+        match = regex.match(value) if regex else None
+        if match:
+            parts = match.groups()
+            if len(parts) == 7:
+                microsecond = int(parts[6].ljust(6, '0'))
+                return datetime(*[int(p) for p in parts[:6]], microsecond=microsecond)
+            return datetime(*[int(p) for p in parts])
+        return strptime(value, date_format)
+
+    return parse
+
+
+class DateConverter(object):
+    """
+    Convert date strings to datetimes using a format or the same parsing as DateTimeProperty if
+    there is no format. Results (including invalid values) are kept in a bounded LRU cache
+    since the same dates appear in many rows.
+    """
+
+    def __init__(self, date_format=None, cache_size=None):
+        self.date_format = date_format
+        self.cache_size = cache_size or getattr(settings, 'CTABLE_DATE_CACHE_SIZE', 10000)
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if date_format:
+            self.parse = _strptime(date_format)
+        else:
+            # I'd normally use iso_string_to_datetime,
+            # but that's in corehq which isn't shared by this repo
+            self.parse = DateTimeProperty().wrap
+
+    def __call__(self, value):
+        if not isinstance(value, basestring):
+            return self.parse(value)
+
+        with self.lock:
+            result = self.cache.pop(value, None)
+            if result is not None:
+                self.cache[value] = result
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if result is None:
+            try:
+                result = self.parse(value)
+            except ValueError:
+                self._add(value, _INVALID)
+                raise
+            self._add(value, result)
+
+        if result is _INVALID:
+            raise ValueError('Invalid date: %r' % value)
+        return result
+
+    def _add(self, value, result):
+        with self.lock:
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+            self.cache[value] = result
+
+    @property
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total else 0,
+            'size': len(self.cache),
+        }
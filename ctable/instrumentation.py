@@ -0,0 +1,292 @@
+import logging
+import os
+import re
+import socket
+import threading
+import time
+from collections import deque
+from django.conf import settings
+from django.core.cache import caches
+from dimagi.utils.modules import to_function
+
+logger = logging.getLogger(__name__)
+
+_instrumentation = None
+_instrumentation_lock = threading.Lock()
+
+
+def get_instrumentation():
+    """
+    Get the instrumentation configured by CTABLE_INSTRUMENTATION (the dotted path to a class).
+    Defaults to NullInstrumentation.
+    """
+    global _instrumentation
+    if _instrumentation is None:
+        with _instrumentation_lock:
+            if _instrumentation is None:
+                path = getattr(settings, 'CTABLE_INSTRUMENTATION', None)
+                cls = to_function(path, failhard=True) if path else NullInstrumentation
+                _instrumentation = cls()
+    return _instrumentation
+
+
+def set_instrumentation(instrumentation):
+    """
+    Replace the instrumentation e.g. in tests. Passing None reloads it from settings.
+    """
+    global _instrumentation
+    _instrumentation = instrumentation
+
+
+class _Timer(object):
+    __slots__ = ('instrumentation', 'name', 'labels', 'start')
+
+    def __init__(self, instrumentation, name, labels):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.instrumentation.timing(self.name, time.time() - self.start, **self.labels)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+
+class NullInstrumentation(object):
+    """
+    Instrumentation interface. Events are ignored.
+
+    Timings are in seconds. Labels are used to split the metrics e.g. by view or table name.
+    """
+    enabled = False
+
+    def timing(self, name, seconds, **labels):
+        pass
+
+    def count(self, name, value=1, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        """
+        Context manager which records the time spent in the block
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+
+class _Summary(object):
+    def __init__(self, sample_size):
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=sample_size)
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+
+    def percentile(self, q):
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        index = min(int(q * len(samples)), len(samples) - 1)
+        return samples[index]
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, **extra):
+    items = list(labels) + sorted(extra.items())
+    if not items:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in items
+    )
+
+
+def _metric_name(name):
+    return 'ctable_%s' % re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+class AggregatingInstrumentation(NullInstrumentation):
+    """
+    Keep the counters and the latest CTABLE_INSTRUMENTATION_SAMPLE_SIZE timings for each metric
+    in memory. The metrics for this process can be exported in the Prometheus text format. Use
+    CacheInstrumentation to export the metrics of all the processes.
+    """
+    enabled = True
+    quantiles = (0.5, 0.9, 0.99)
+
+    def __init__(self, sample_size=None):
+        self.sample_size = sample_size or getattr(settings, 'CTABLE_INSTRUMENTATION_SAMPLE_SIZE', 1000)
+        self.timings = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def timing(self, name, seconds, **labels):
+        key = (name, _labels_key(labels))
+        with self.lock:
+            summary = self.timings.get(key)
+            if summary is None:
+                summary = self.timings[key] = _Summary(self.sample_size)
+            summary.add(seconds)
+
+    def count(self, name, value=1, **labels):
+        key = (name, _labels_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def percentile(self, name, q, **labels):
+        summary = self.timings.get((name, _labels_key(labels)))
+        return summary.percentile(q) if summary else None
+
+    def render(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        with self.lock:
+            return _render(self.timings, self.counters, self.quantiles)
+
+
+def _render(timings, counters, quantiles):
+    lines = []
+    declared = set()
+    for (name, labels), summary in sorted(timings.items()):
+        metric = '%s_seconds' % _metric_name(name)
+        if metric not in declared:
+            declared.add(metric)
+            lines.append('# TYPE %s summary' % metric)
+        for q in quantiles:
+            lines.append('%s%s %r' % (metric, _format_labels(labels, quantile=q), summary.percentile(q)))
+        lines.append('%s_sum%s %r' % (metric, _format_labels(labels), summary.sum))
+        lines.append('%s_count%s %d' % (metric, _format_labels(labels), summary.count))
+
+    for (name, labels), value in sorted(counters.items()):
+        metric = '%s_total' % _metric_name(name)
+        if metric not in declared:
+            declared.add(metric)
+            lines.append('# TYPE %s counter' % metric)
+        lines.append('%s%s %s' % (metric, _format_labels(labels), value))
+
+    return '\n'.join(lines) + '\n'
+
+
+class CacheInstrumentation(AggregatingInstrumentation):
+    """
+    AggregatingInstrumentation which shares the metrics of each process through the Django cache
+    given by CTABLE_INSTRUMENTATION_CACHE so that `render` exports the metrics of all the processes
+    e.g. the celery workers running extracts and the pillows processing Fluff diffs as well as the
+    web worker serving the metrics. The cache must be shared between the processes e.g. memcached
+    or redis.
+
+    Each process writes its metrics to the cache every CTABLE_INSTRUMENTATION_FLUSH_INTERVAL
+    seconds. The metrics of processes which stop writing them are dropped after
+    CTABLE_INSTRUMENTATION_TIMEOUT seconds.
+    """
+    registry_key = 'ctable_instrumentation_processes'
+
+    def __init__(self, sample_size=None, cache=None, interval=None, timeout=None, process_id=None):
+        super(CacheInstrumentation, self).__init__(sample_size=sample_size)
+        self.cache = cache or caches[getattr(settings, 'CTABLE_INSTRUMENTATION_CACHE', 'default')]
+        self.interval = interval or getattr(settings, 'CTABLE_INSTRUMENTATION_FLUSH_INTERVAL', 10)
+        self.timeout = timeout or getattr(settings, 'CTABLE_INSTRUMENTATION_TIMEOUT', 600)
+        self._process_id = process_id
+        self.pid = None
+        self.flusher_lock = threading.Lock()
+
+    @property
+    def process_id(self):
+        return self._process_id or '%s:%d' % (socket.gethostname(), os.getpid())
+
+    @property
+    def cache_key(self):
+        return 'ctable_instrumentation:%s' % self.process_id
+
+    def timing(self, name, seconds, **labels):
+        self._start_flusher()
+        super(CacheInstrumentation, self).timing(name, seconds, **labels)
+
+    def count(self, name, value=1, **labels):
+        self._start_flusher()
+        super(CacheInstrumentation, self).count(name, value, **labels)
+
+    def _start_flusher(self):
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+
+        with self.flusher_lock:
+            if self.pid == pid:
+                return
+            if self.pid is not None:
+                # this is a forked process and the metrics so far belong to the parent
+                with self.lock:
+                    self.timings = {}
+                    self.counters = {}
+            self.pid = pid
+            thread = threading.Thread(target=self._flush_periodically, name='ctable-instrumentation')
+            thread.daemon = True
+            thread.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Unable to write the metrics to the cache")
+
+    def flush(self):
+        """
+        Write the metrics of this process to the cache
+        """
+        with self.lock:
+            snapshot = {
+                'timings': [(key, s.count, s.sum, list(s.samples)) for key, s in self.timings.items()],
+                'counters': list(self.counters.items()),
+            }
+        self.cache.set(self.cache_key, snapshot, self.timeout)
+
+        # processes that update the registry at the same time may drop each other's keys but
+        # they are added back the next time the processes flush
+        now = time.time()
+        registry = self.cache.get(self.registry_key) or {}
+        registry = dict((key, seen) for key, seen in registry.items() if now - seen < self.timeout)
+        registry[self.cache_key] = now
+        self.cache.set(self.registry_key, registry, self.timeout)
+
+    def render(self):
+        """
+        :return: the metrics of all the processes in the Prometheus text exposition format
+        """
+        self.flush()
+        registry = self.cache.get(self.registry_key) or {}
+        timings = {}
+        counters = {}
+        for snapshot in self.cache.get_many(list(registry)).values():
+            for key, count, total, samples in snapshot['timings']:
+                summary = timings.get(key)
+                if summary is None:
+                    summary = timings[key] = _Summary(None)
+                summary.count += count
+                summary.sum += total
+                summary.samples.extend(samples)
+            for key, value in snapshot['counters']:
+                counters[key] = counters.get(key, 0) + value
+        return _render(timings, counters, self.quantiles)
@@ -1,19 +1,23 @@
 import json
-from couchdbkit import BadValueError
+from couchdbkit import BadValueError, ResourceNotFound
 from dimagi.ext.couchdbkit import (
     BooleanProperty,
     DateTimeProperty,
     DictProperty,
     Document,
     DocumentSchema,
+    FloatProperty,
     IntegerProperty,
     ListProperty,
+    Property,
     SchemaListProperty,
     StringListProperty,
     StringProperty,
 )
 from django.conf import settings
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
+from .cache import mapping_cache
+from .converters import get_date_converter
 import sqlalchemy
 import re
 
@@ -25,6 +29,14 @@ MATCH_OPS_FUNC = {
     NOT_EQUAL: lambda input, reference: input != reference,
 }
 
+RUN_SUCCESS = 'success'
+RUN_FAILED = 'failed'
+
+LOAD_MODE_UPSERT = 'upsert'
+LOAD_MODE_COPY = 'copy'
+LOAD_MODES = [LOAD_MODE_UPSERT, LOAD_MODE_COPY]
+
+
 def validate_name(value, search=re.compile(r'[^a-zA-Z0-9_]').search):
     if not value or bool(search(value)):
         raise BadValueError("Only a-z, 0-9 and '_' characters allowed")
@@ -110,12 +122,7 @@ class ColumnDef(DocumentSchema):
 
         try:
             if self.data_type == "date" or self.data_type == "datetime":
-                if self.date_format:
-                    converted = datetime.strptime(value, self.date_format)
-                else:
-                    # I'd normally use iso_string_to_datetime,
-                    # but that's in corehq which isn't shared by this repo
-                    converted = DateTimeProperty().wrap(value)
+                converted = get_date_converter(self.date_format)(value)
                 return converted.date() if self.data_type == "date" else converted
             elif self.data_type == "integer":
                 return int(value)
@@ -168,6 +175,7 @@ class ColumnDef(DocumentSchema):
 
 
 SCHEDULE_VIEW = "ctable/schedule"
+RUNS_VIEW = "ctable/runs_by_mapping"
 
 
 class SqlExtractMapping(Document):
@@ -180,6 +188,14 @@ class SqlExtractMapping(Document):
     columns = SchemaListProperty(ColumnDef, required=True)
     active = BooleanProperty(default=False)
     auto_generated = BooleanProperty(default=False)
+    load_mode = StringProperty(choices=LOAD_MODES, default=LOAD_MODE_UPSERT)
+    """How rows are written to SQL: 'upsert' row batches or 'copy' into a staging table and merge"""
+    incremental = BooleanProperty(default=False)
+    """Scheduled runs only re-extract the view keys affected by documents that changed since the
+    last run. Requires changes_key_function."""
+    changes_key_function = StringProperty()
+    """Dotted path to a function which is called with the mapping and a row from the _changes feed
+    (including the doc) and returns a list of view key prefixes to re-extract"""
 
     schedule_type = StringProperty(choices=['hourly', 'daily', 'weekly', 'monthly'], default='daily')
     schedule_hour = IntegerProperty(default=8)
@@ -210,12 +226,37 @@ class SqlExtractMapping(Document):
     def key_columns(self):
         return [c.name for c in self.columns if c.is_key_column]
 
+    @property
+    def couch_key_ordered(self):
+        """
+        True if the view rows for each SQL row are consecutive in view key order i.e. the key
+        columns (and the key prefix) are taken from the leading elements of the view key.
+        """
+        key_columns = [c for c in self.columns if c.is_key_column]
+        if not key_columns or any(c.value_source != 'key' or c.value_index is None for c in key_columns):
+            return False
+
+        positions = set(range(len(self.couch_key_prefix or [])))
+        positions.update(c.value_index for c in key_columns)
+        return positions == set(range(len(positions)))
+
     def validate(self, required=True):
         super(SqlExtractMapping, self).validate(required)
 
         if self.couch_group_level is not None and self.couch_group_level < 0:
                 raise BadValueError('Couch Group Level must be >= 0')
 
+        if self.incremental and not self.changes_key_function:
+            raise BadValueError('Incremental mappings must specify a changes_key_function')
+
+    def save(self, *args, **kwargs):
+        super(SqlExtractMapping, self).save(*args, **kwargs)
+        mapping_cache.refresh(self)
+
+    def delete(self):
+        mapping_cache.invalidate(self._id)
+        super(SqlExtractMapping, self).delete()
+
     @classmethod
     def all(cls):
         return cls.view('ctable/by_name',
@@ -278,4 +319,118 @@ class SqlExtractMapping(Document):
         return 'active' if active else 'inactive'
 
 
+class ExtractState(Document):
+    mapping_id = StringProperty(required=True)
+    changes_seq = Property()
+    """Sequence of the _changes feed up to which incremental extracts have processed changes"""
+    average_runtime = FloatProperty()
+    """Moving average of the scheduled extract runtime in seconds"""
+    resume_key = Property()
+    """View key group up to which the rows of a failed extract were committed"""
+    resume_run = StringProperty()
+    """ID of the task run that resume_key belongs to. Only retries of that run resume from it."""
+
+    def record_runtime(self, seconds, weight=0.3):
+        if self.average_runtime is None:
+            self.average_runtime = float(seconds)
+        else:
+            self.average_runtime = (1 - weight) * self.average_runtime + weight * seconds
+
+    @classmethod
+    def for_mapping(cls, mapping):
+        state_id = 'CtableExtractState_%s' % mapping._id
+        try:
+            return cls.get(state_id)
+        except ResourceNotFound:
+            return cls(_id=state_id, mapping_id=mapping._id)
+
+    @classmethod
+    def average_runtimes(cls, mapping_ids):
+        """
+        :return: dict of mapping ID to average runtime for the mappings that have one
+        """
+        if not mapping_ids:
+            return {}
+        rows = cls.get_db().view('_all_docs',
+                                 keys=['CtableExtractState_%s' % id for id in mapping_ids],
+                                 include_docs=True)
+        return dict((row['doc']['mapping_id'], row['doc']['average_runtime']) for row in rows
+                    if row.get('doc') and row['doc'].get('average_runtime') is not None)
+
+
+
+class ExtractRun(Document):
+    """
+    Statistics for a single run of an extract. See ctable.stats.ExtractStats
+    """
+    mapping_id = StringProperty(required=True)
+    started = DateTimeProperty()
+    duration = FloatProperty()
+    """Seconds"""
+    status = StringProperty(choices=[RUN_SUCCESS, RUN_FAILED])
+    error = StringProperty()
+    incremental = BooleanProperty(default=False)
+    rebuild = BooleanProperty(default=False)
+    rows_read = IntegerProperty(default=0)
+    """Number of rows read from CouchDB"""
+    rows_written = IntegerProperty(default=0)
+    """Number of rows written to SQL"""
+    timings = DictProperty()
+    """Seconds spent in each stage: fetch, convert, combine, write"""
+    peak_batch_sizes = DictProperty()
+    """Largest number of rows fetched from CouchDB in a single request"""
+
+    @property
+    def throughput(self):
+        """Rows read per second"""
+        if not self.duration:
+            return None
+        return self.rows_read / self.duration
+
+    @classmethod
+    def from_stats(cls, mapping, stats, error=None, **kwargs):
+        return cls(
+            mapping_id=mapping._id,
+            started=stats.started,
+            duration=stats.duration,
+            status=RUN_FAILED if error else RUN_SUCCESS,
+            error=error,
+            rows_read=stats.rows_read,
+            rows_written=stats.rows_written,
+            timings=stats.timings,
+            peak_batch_sizes=stats.peak_batch_sizes,
+            **kwargs
+        )
+
+    @classmethod
+    def by_mapping(cls, mapping_id, limit=100):
+        """
+        :return: the most recent runs for the mapping, newest first
+        """
+        return cls.view(RUNS_VIEW,
+                        startkey=[mapping_id, {}],
+                        endkey=[mapping_id],
+                        descending=True,
+                        include_docs=True,
+                        reduce=False,
+                        limit=limit).all()
+
+    @classmethod
+    def prune(cls, mapping_id, retention_days=None):
+        """
+        Delete the runs for the mapping that are older than CTABLE_STATS_RETENTION_DAYS
+        """
+        if retention_days is None:
+            retention_days = getattr(settings, 'CTABLE_STATS_RETENTION_DAYS', 90)
+        cutoff = datetime.utcnow() - timedelta(days=retention_days)
+        db = cls.get_db()
+        rows = db.view(RUNS_VIEW,
+                       startkey=[mapping_id],
+                       endkey=[mapping_id, cutoff.isoformat()],
+                       reduce=False).all()
+        if rows:
+            db.bulk_delete([{'_id': row['id'], '_rev': row['value']} for row in rows])
+        return len(rows)
+
+
 from . import signals
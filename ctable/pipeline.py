@@ -0,0 +1,132 @@
+import sys
+import threading
+from Queue import Queue, Empty, Full
+from dimagi.utils.chunked import chunked
+
+_DONE = object()
+_POLL_INTERVAL = 0.1
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class _Failure(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+    def reraise(self):
+        raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+
+def read_ahead(iterable, maxsize=10, chunksize=100):
+    """
+    Iterate over `iterable` in a background thread. Items are passed to the caller in
+    chunks through a bounded queue so that the reader blocks when it gets more than
+    `maxsize` chunks ahead of the caller.
+
+    Errors raised by the reader are raised again in the caller.
+    """
+    queue = Queue(maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for chunk in chunked(iterable, chunksize):
+                if not put(chunk):
+                    return
+            put(_DONE)
+        except Exception:
+            put(_Failure(sys.exc_info()))
+
+    reader = threading.Thread(target=read, name='ctable-reader')
+    reader.daemon = True
+    reader.start()
+
+    try:
+        while True:
+            item = queue.get()
+            if item is _DONE:
+                break
+            elif isinstance(item, _Failure):
+                item.reraise()
+
+            for row in item:
+                yield row
+    finally:
+        stopped.set()
+
+
+def write_behind(write, iterable, maxsize=10, chunksize=100):
+    """
+    Pass the items in `iterable` to `write` which is called in a background thread.
+    `write` receives an iterator over the items which are passed to it in chunks through
+    a bounded queue so that the caller blocks when it gets more than `maxsize` chunks
+    ahead of the writer.
+
+    Errors raised by the writer stop the caller and are raised again once the writer
+    thread has finished. If iterating over `iterable` fails the writer is aborted with
+    a PipelineAborted error so that it doesn't commit a partial batch.
+    """
+    queue = Queue(maxsize)
+    failures = []
+
+    def rows():
+        while True:
+            item = queue.get()
+            if item is _DONE:
+                return
+            elif isinstance(item, _Failure):
+                raise PipelineAborted()
+            for row in item:
+                yield row
+
+    def run():
+        try:
+            write(rows())
+        except Exception:
+            failures.append(_Failure(sys.exc_info()))
+        finally:
+            # unblock the caller if the writer stopped early
+            while True:
+                try:
+                    queue.get_nowait()
+                except Empty:
+                    break
+
+    writer = threading.Thread(target=run, name='ctable-writer')
+    writer.daemon = True
+    writer.start()
+
+    def put(item):
+        while writer.is_alive():
+            try:
+                queue.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    try:
+        for chunk in chunked(iterable, chunksize):
+            if not put(chunk):
+                break
+    except Exception:
+        failure = _Failure(sys.exc_info())
+        put(failure)
+        writer.join()
+        failure.reraise()
+
+    put(_DONE)
+    writer.join()
+    if failures:
+        failures[0].reraise()
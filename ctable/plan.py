@@ -0,0 +1,254 @@
+import itertools
+import json
+import threading
+from collections import OrderedDict
+from operator import itemgetter
+from .converters import get_date_converter
+from .models import MATCH_OPS_FUNC, EQUAL
+
+_plan_cache = {}
+_plan_cache_lock = threading.Lock()
+_PLAN_CACHE_SIZE = 100
+
+
+def get_plan(mapping):
+    """
+    Get the compiled MappingPlan for the mapping. Plans for saved mappings are cached by
+    document revision so changes to a mapping must be saved before they are picked up.
+    """
+    rev = getattr(mapping, '_rev', None)
+    if not rev:
+        return MappingPlan(mapping)
+
+    cache_key = (mapping._id, rev)
+    plan = _plan_cache.get(cache_key)
+    if plan is None:
+        plan = MappingPlan(mapping)
+        with _plan_cache_lock:
+            if len(_plan_cache) >= _PLAN_CACHE_SIZE:
+                _plan_cache.clear()
+            _plan_cache[cache_key] = plan
+    return plan
+
+
+def compile_matcher(key_matcher):
+    """
+    :return: function taking a view key and returning True if the KeyMatcher matches it
+    """
+    op = MATCH_OPS_FUNC.get(key_matcher.operator)
+    index = key_matcher.index
+    string_reference = key_matcher.value
+    try:
+        json_reference = json.loads(key_matcher.value)
+    except ValueError:
+        json_reference = key_matcher.value
+    except TypeError:
+        # no reference value so fall back to the matcher to get the same behaviour
+        return lambda key: key_matcher.matches(key, None)
+
+    def matches(key):
+        try:
+            key_value = key[index]
+        except IndexError:
+            return False
+
+        if isinstance(key_value, basestring):
+            return op(key_value, string_reference)
+        return op(key_value, json_reference)
+
+    return matches
+
+
+def compile_getter(column):
+    """
+    :return: function taking a view key and value and returning the raw value for the column
+    """
+    source = column.value_source
+    index = column.value_index
+    attribute = column.value_attribute
+
+    if source == 'key' and index is not None:
+        def get_raw(key, value):
+            try:
+                return key[index]
+            except IndexError:
+                raise IndexError('Value index out of range: %s[%s]' % (source, index))
+            except KeyError:
+                raise KeyError('Value attribute error: %s[%s]' % (source, attribute))
+    elif source == 'value' and (index is not None or attribute is not None):
+        accessor = index if index is not None else attribute
+
+        def get_raw(key, value):
+            try:
+                return value[accessor]
+            except IndexError:
+                raise IndexError('Value index out of range: %s[%s]' % (source, index))
+            except KeyError:
+                raise KeyError('Value attribute error: %s[%s]' % (source, attribute))
+    else:
+        def get_raw(key, value):
+            return value
+
+    return get_raw
+
+
+def compile_converter(column):
+    """
+    :return: function that converts a raw value to the column's type. See ColumnDef.convert_type
+    """
+    data_type = column.data_type
+    date_format = column.date_format
+    is_key_column = column.is_key_column
+    placeholder = column.null_value_placeholder
+    default_placeholder = column.default_null_value_placeholder
+    fallback = placeholder or default_placeholder
+
+    if data_type in ('date', 'datetime'):
+        parse = get_date_converter(date_format)
+        if data_type == 'date':
+            typed = lambda value: parse(value).date()
+        else:
+            typed = parse
+    elif data_type == 'integer':
+        typed = int
+    else:
+        typed = None
+
+    def convert(value):
+        if value is None:
+            if not is_key_column:
+                return value
+            elif placeholder:
+                value = placeholder
+            else:
+                return default_placeholder
+
+        if typed is None:
+            return value
+        try:
+            return typed(value)
+        except ValueError:
+            return fallback
+
+    return convert
+
+
+def _tag(key_value):
+    """
+    KeyMatchers compare string key values with the raw reference and other values with
+    the JSON decoded reference so the lookup keys are tagged with the type of comparison.
+    """
+    if isinstance(key_value, basestring):
+        return 's', key_value
+    return 'j', key_value
+
+
+class ColumnPlan(object):
+    __slots__ = ('name', 'matchers', 'get_raw', 'convert', 'equal_references')
+
+    def __init__(self, column):
+        self.name = column.name
+        self.matchers = tuple(compile_matcher(m) for m in column.match_keys)
+        self.get_raw = compile_getter(column)
+        self.convert = compile_converter(column)
+
+        # (index, tagged references) for each '==' matcher, None if they can't be hashed
+        references = []
+        for matcher in column.match_keys:
+            if matcher.operator == EQUAL:
+                try:
+                    json_reference = json.loads(matcher.value)
+                    hash(json_reference)
+                except ValueError:
+                    json_reference = matcher.value
+                except TypeError:
+                    references = None
+                    break
+                references.append((matcher.index, (('s', matcher.value), ('j', json_reference))))
+        self.equal_references = tuple(references) if references else None
+
+    def matches(self, key):
+        for matcher in self.matchers:
+            if not matcher(key):
+                return False
+        return True
+
+    def get_value(self, key, value):
+        return self.convert(self.get_raw(key, value))
+
+
+class DispatchIndex(object):
+    """
+    Hash index of columns by the key values required by their '==' matchers so that each row
+    only has to be checked against the columns it can match. Columns are grouped by the key
+    positions of their '==' matchers. Columns without any '==' matchers or with references that
+    can't be hashed are checked for every row.
+    """
+
+    def __init__(self, columns):
+        self.groups = OrderedDict()
+        self.residual = []
+        for order, column in enumerate(columns):
+            if not column.equal_references:
+                self.residual.append((order, column))
+                continue
+
+            positions = tuple(index for index, _ in column.equal_references)
+            table = self.groups.setdefault(positions, {})
+            for lookup in itertools.product(*[tagged for _, tagged in column.equal_references]):
+                table.setdefault(lookup, []).append((order, column))
+
+    def candidates(self, key):
+        """
+        :return: columns that may match the key in mapping column order
+        """
+        found = list(self.residual)
+        for positions, table in self.groups.iteritems():
+            try:
+                lookup = tuple(_tag(key[index]) for index in positions)
+            except IndexError:
+                continue
+
+            try:
+                found.extend(table.get(lookup, ()))
+            except TypeError:
+                # unhashable key values (lists, dicts) can't equal any of the indexed references
+                continue
+
+        if len(found) > 1:
+            found.sort(key=itemgetter(0))
+        return [column for _, column in found]
+
+
+class MappingPlan(object):
+    """
+    Precompiled version of a SqlExtractMapping's columns used to convert view rows into SQL rows.
+    Matcher references are parsed once and each column gets a specialised accessor and converter.
+    """
+
+    def __init__(self, mapping):
+        columns = [ColumnPlan(c) for c in mapping.columns]
+        self.key_columns = tuple(c for c, column in zip(columns, mapping.columns) if column.is_key_column)
+        self.value_columns = tuple(c for c, column in zip(columns, mapping.columns) if not column.is_key_column)
+        self.dispatch = DispatchIndex(self.value_columns)
+
+    def convert_row(self, key, value):
+        """
+        Convert a view row into a SQL row. Returns None if none of the non-key columns match
+        the row. Mappings with only key columns match every row.
+
+        See CtableExtractor.couch_rows_to_sql_rows
+        """
+        matched = None
+        if self.value_columns:
+            matched = [c for c in self.dispatch.candidates(key) if c.matches(key)]
+            if not matched:
+                return None
+
+        sql_row = {}
+        for column in self.key_columns:
+            sql_row[column.name] = column.get_value(key, value)
+        if matched:
+            for column in matched:
+                sql_row[column.name] = column.get_value(key, value)
+        return sql_row
@@ -0,0 +1,111 @@
+from timeit import default_timer
+from django.conf import settings
+
+FETCHING = 'fetching'
+CONVERTING = 'converting'
+WRITING = 'writing'
+DONE = 'done'
+
+
+class ProgressReporter(object):
+    """
+    Report the progress of an extract to `callback` at most once every `interval` seconds
+    (CTABLE_PROGRESS_INTERVAL) no matter how many rows there are. Stage changes and the
+    end of the extract are always reported.
+
+    The callback is called with a dict of:
+
+    * current: number of view rows processed
+    * total: number of view rows or None if it isn't known
+    * stage: 'fetching', 'converting', 'writing' or 'done'
+    * rate: rows per second since the first row was processed
+    * eta: estimated number of seconds remaining or None
+    * elapsed: seconds since the extract started
+    """
+
+    def __init__(self, callback, total=None, interval=None, clock=default_timer):
+        self.callback = callback
+        self.total = total
+        if interval is None:
+            interval = getattr(settings, 'CTABLE_PROGRESS_INTERVAL', 2)
+        self.interval = interval
+        self.clock = clock
+        self.started = clock()
+        self.rows_started = None
+        self.last_report = None
+        self.stage = FETCHING
+        self.current = 0
+
+    def set_total(self, total):
+        self.total = total
+
+    def set_stage(self, stage):
+        if stage != self.stage:
+            self.stage = stage
+            self.report()
+
+    def update(self, current):
+        """
+        Record the number of rows processed and report it if the interval has passed
+        """
+        now = self.clock()
+        self.current = current
+        if self.rows_started is None:
+            self.rows_started = now
+            if self.stage == FETCHING:
+                self.stage = CONVERTING
+            self.report(now)
+        elif now - self.last_report >= self.interval:
+            self.report(now)
+
+    def track(self, rows, stage):
+        """
+        Move on to `stage` when the first row is taken from `rows`. Rows stream through all the
+        stages so the stage reported is the latest one to have started.
+        """
+        for i, row in enumerate(rows):
+            if not i:
+                self.set_stage(stage)
+            yield row
+
+    def finish(self):
+        self.stage = DONE
+        self.report()
+
+    @property
+    def rate(self):
+        if self.rows_started is None:
+            return None
+        elapsed = self.clock() - self.rows_started
+        return self.current / elapsed if elapsed > 0 else None
+
+    @property
+    def eta(self):
+        rate = self.rate
+        if self.stage == DONE:
+            return 0
+        if not rate or self.total is None:
+            return None
+        return max(self.total - self.current, 0) / rate
+
+    def report(self, now=None):
+        now = now or self.clock()
+        self.last_report = now
+        self.callback({
+            'current': self.current,
+            'total': self.total,
+            'stage': self.stage,
+            'rate': self.rate,
+            'eta': self.eta,
+            'elapsed': now - self.started,
+        })
+
+
+def as_reporter(status_callback):
+    """
+    :param status_callback: ProgressReporter or a function taking the total and current
+                            number of rows
+    """
+    if status_callback is None or isinstance(status_callback, ProgressReporter):
+        return status_callback
+    return ProgressReporter(lambda progress: status_callback(progress['total'], progress['current']))
@@ -0,0 +1,80 @@
+import hashlib
+from collections import namedtuple
+from django.conf import settings
+
+ScheduledExtract = namedtuple('ScheduledExtract', 'mapping_id database backend runtime')
+
+
+def _hash(mapping_id):
+    return int(hashlib.md5(mapping_id).hexdigest()[:8], 16)
+
+
+def _ceil(seconds, gap):
+    return -(-seconds // gap) * gap
+
+
+class ExtractScheduler(object):
+    """
+    Assign start times to the extracts that are due so that:
+
+    * no more than `database_limit` extracts read from the same CouchDB database at once
+    * no more than `backend_limit` extracts write to the same backend at once
+    * at most one extract per database starts in each slot of `gap` seconds
+
+    Extracts are placed greedily, longest first, at the earliest slot where the limits allow
+    so the big extracts start first and the small ones fill in around them. Extracts with the
+    same runtime (e.g. those without any history) are ordered by a hash of their ID and each
+    start is offset within its slot by the hash so they don't all start on the same second.
+
+    Runtimes are estimates and the start times are only countdowns so the limits are not
+    guaranteed if extracts run for longer than expected.
+    """
+
+    def __init__(self, gap=None, database_limit=None, backend_limit=None, default_runtime=None):
+        self.gap = gap if gap is not None else getattr(settings, 'CTABLE_TASK_STAGGER_GAP', 10)
+        self.database_limit = database_limit or getattr(settings, 'CTABLE_SCHEDULE_DATABASE_CONCURRENCY', 2)
+        self.backend_limit = backend_limit or getattr(settings, 'CTABLE_SCHEDULE_BACKEND_CONCURRENCY', 4)
+        self.default_runtime = default_runtime or getattr(settings, 'CTABLE_SCHEDULE_DEFAULT_RUNTIME', 60)
+
+    def schedule(self, extracts):
+        """
+        :param extracts: list of ScheduledExtract. Runtime may be None if it isn't known.
+        :return: list of (mapping_id, countdown) in order of countdown
+        """
+        gap = max(self.gap, 1)
+        placed = []  # (start, end, extract)
+        starts = set()  # (slot start, database)
+
+        ordered = sorted(extracts, key=lambda e: (-self._runtime(e), _hash(e.mapping_id), e.mapping_id))
+        for extract in ordered:
+            start = self._earliest_start(extract, placed, starts, gap)
+            placed.append((start, start + self._runtime(extract), extract))
+            starts.add((start, extract.database))
+
+        countdowns = [
+            (extract.mapping_id, start + (_hash(extract.mapping_id) % gap if self.gap else 0))
+            for start, end, extract in placed
+        ]
+        return sorted(countdowns, key=lambda c: c[1])
+
+    def _runtime(self, extract):
+        return extract.runtime if extract.runtime is not None else self.default_runtime
+
+    def _earliest_start(self, extract, placed, starts, gap):
+        start = 0
+        while True:
+            running = [(end, other) for other_start, end, other in placed if other_start <= start < end]
+            same_database = [end for end, other in running if other.database == extract.database]
+            same_backend = [end for end, other in running if other.backend == extract.backend]
+
+            next_start = start
+            if len(same_database) >= self.database_limit:
+                next_start = max(next_start, _ceil(min(same_database), gap))
+            if len(same_backend) >= self.backend_limit:
+                next_start = max(next_start, _ceil(min(same_backend), gap))
+            if next_start == start and (start, extract.database) in starts:
+                next_start = start + gap
+
+            if next_start == start:
+                return start
+            start = next_start
@@ -0,0 +1,132 @@
+import time
+from datetime import datetime
+
+FETCH = 'fetch'
+CONVERT = 'convert'
+COMBINE = 'combine'
+WRITE = 'write'
+STAGES = (FETCH, CONVERT, COMBINE, WRITE)
+
+
+class ExtractStats(object):
+    """
+    Collect the row counts and the time spent in each stage of an extract. The stages are
+    chained generators so the time for each stage is the time spent getting rows from it
+    less the time spent waiting on the stage before it.
+
+    When the extract is pipelined the fetch and write stages run in background threads and
+    their times are the time the other stages spent waiting on them.
+    """
+
+    def __init__(self, started=None):
+        """
+        :param started: timestamp of the start of the extract if it started before the stats were created
+        """
+        self._start = started or time.time()
+        self.started = datetime.utcfromtimestamp(self._start)
+        self.duration = None
+        self.rows_read = 0
+        self.rows_written = 0
+        self.peak_batch_sizes = {}
+        self._cumulative = dict.fromkeys(STAGES, 0.0)
+        self._setup = dict.fromkeys(STAGES, 0.0)
+        self._upstream = {}
+
+    def timed(self, stage, rows, upstream=None):
+        """
+        Time getting the rows from `rows`.
+
+        :param upstream: the stage that `rows` consumes
+        """
+        self._upstream[stage] = upstream
+        cumulative = self._cumulative
+        iterator = iter(rows)
+        while True:
+            start = time.time()
+            try:
+                row = next(iterator)
+            except StopIteration:
+                cumulative[stage] += time.time() - start
+                return
+            cumulative[stage] += time.time() - start
+            yield row
+
+    def timed_call(self, stage, upstream, func, *args, **kwargs):
+        """
+        Time a function which consumes the rows from the `upstream` stage e.g. writing to SQL
+        """
+        self._upstream[stage] = upstream
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._cumulative[stage] += time.time() - start
+
+    def timed_setup(self, stage, func, *args, **kwargs):
+        """
+        Time a function called before the rows of `stage` are iterated over e.g. the initial view
+        request. The time counts towards `stage` but isn't taken off the stages downstream of it
+        since they aren't waiting on `stage` at the time.
+        """
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._setup[stage] += time.time() - start
+
+    def count_written(self, rows):
+        for row in rows:
+            self.rows_written += 1
+            yield row
+
+    def record_batch(self, stage, size):
+        self.peak_batch_sizes[stage] = max(self.peak_batch_sizes.get(stage, 0), size)
+
+    def to_json(self):
+        """
+        :return: the counts and stage times in a form that can be passed between tasks and added
+                 to other stats with `add`
+        """
+        return {
+            'rows_read': self.rows_read,
+            'rows_written': self.rows_written,
+            'peak_batch_sizes': dict(self.peak_batch_sizes),
+            'cumulative': dict(self._cumulative),
+            'setup': dict(self._setup),
+            'upstream': dict(self._upstream),
+        }
+
+    def add(self, data):
+        """
+        Add the counts and stage times from `to_json` of another extract e.g. one shard of this extract
+        """
+        self.rows_read += data['rows_read']
+        self.rows_written += data['rows_written']
+        for stage, size in data['peak_batch_sizes'].items():
+            self.record_batch(stage, size)
+        for stage, seconds in data['cumulative'].items():
+            self._cumulative[stage] += seconds
+        for stage, seconds in data['setup'].items():
+            self._setup[stage] += seconds
+        self._upstream.update(data['upstream'])
+
+    def finish(self):
+        self.duration = time.time() - self._start
+
+    @property
+    def timings(self):
+        """
+        :return: dict of stage to seconds spent in that stage
+        """
+        timings = {}
+        for stage in STAGES:
+            upstream = self._upstream.get(stage)
+            own = self._cumulative[stage] - (self._cumulative[upstream] if upstream else 0)
+            timings[stage] = max(own, 0) + self._setup[stage]
+        return timings
+
+    @property
+    def throughput(self):
+        if not self.duration:
+            return None
+        return self.rows_read / self.duration
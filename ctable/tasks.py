@@ -1,24 +1,175 @@
+import logging
+import socket
+import sqlalchemy
+import time
 from celery.schedules import crontab
 from django.conf import settings
+from restkit.errors import RequestError, RequestFailed, RequestTimeout
 from celery.task import periodic_task, task
-from celery import current_task
+from celery import chord, current_task
+from ctable.base import KeyRange
 from ctable.util import get_extractor
-from .models import SqlExtractMapping
+from .models import SqlExtractMapping, ExtractState, ExtractRun
+from .scheduler import ExtractScheduler, ScheduledExtract
+from .progress import ProgressReporter
+from .stats import ExtractStats
+
+logger = logging.getLogger(__name__)
+
+TRANSIENT_ERRORS = (
+    socket.error,
+    RequestError,
+    RequestTimeout,
+    sqlalchemy.exc.OperationalError,
+    sqlalchemy.exc.DisconnectionError,
+)
+
+
+def is_transient(error):
+    """
+    True for errors connecting to CouchDB or SQL which may succeed if the extract is retried
+    """
+    if isinstance(error, RequestFailed):
+        return getattr(error, 'status_int', 0) >= 500
+    return isinstance(error, TRANSIENT_ERRORS)
 
 
 @task
-def process_extract(extract_id, limit=None, date_range=None):
-    def update_status(total, current):
-        meta = {'current': current, 'total': total}
-        current_task.update_state(state='PROGRESS', meta=meta)
+def process_extract(extract_id, limit=None, date_range=None, rebuild=False):
+    def update_status(progress):
+        current_task.update_state(state='PROGRESS', meta=progress)
 
     mapping = SqlExtractMapping.get(extract_id)
-    get_extractor(mapping.backend).extract(
-        mapping,
-        limit=limit,
-        date_range=date_range,
-        status_callback=update_status
-    )
+    extractor = get_extractor(mapping.backend)
+    incremental = mapping.incremental and not (limit or date_range or rebuild)
+    shards = getattr(settings, 'CTABLE_EXTRACT_SHARDS', 1)
+    sharded = shards > 1 and not (incremental or limit or rebuild)
+    resumable = not (sharded or incremental or limit or date_range or rebuild) and \
+        extractor.supports_checkpoints(mapping)
+    stats = ExtractStats()
+    progress = ProgressReporter(update_status)
+    error = None
+
+    run_id = current_task.request.id
+    resume_key = None
+    checkpoint = None
+    if resumable:
+        state = ExtractState.for_mapping(mapping)
+        if run_id and state.resume_run == run_id:
+            resume_key = state.resume_key
+
+        def checkpoint(key):
+            state.resume_key = key
+            state.resume_run = run_id
+            state.save()
+
+    try:
+        if incremental:
+            extractor.extract_incremental(mapping, status_callback=progress, stats=stats)
+        elif sharded:
+            # the run is recorded by finish_sharded_extract once all the shards have been extracted
+            start_sharded_extract(mapping, extractor, shards, date_range=date_range)
+            return
+        else:
+            extractor.extract(
+                mapping,
+                limit=limit,
+                date_range=date_range,
+                status_callback=progress,
+                rebuild=rebuild,
+                stats=stats,
+                resume_key=resume_key,
+                checkpoint=checkpoint if run_id else None
+            )
+    except Exception as e:
+        error = '%s: %s' % (e.__class__.__name__, e)
+        if not limit and is_transient(e):
+            # retries of a resumable extract carry on from the last checkpoint
+            raise process_extract.retry(
+                exc=e,
+                countdown=getattr(settings, 'CTABLE_EXTRACT_RETRY_DELAY', 60),
+                max_retries=getattr(settings, 'CTABLE_EXTRACT_MAX_RETRIES', 3)
+            )
+        raise
+    finally:
+        stats.finish()
+        if error or not sharded:
+            record_run(mapping, stats, error=error, incremental=incremental, rebuild=rebuild)
+
+    if not (limit or date_range):
+        state = ExtractState.for_mapping(mapping)
+        if resume_key is None:
+            # the runtime of a resumed extract doesn't include the rows extracted before it failed
+            state.record_runtime(stats.duration)
+        state.resume_key = None
+        state.resume_run = None
+        state.save()
+
+
+def start_sharded_extract(mapping, extractor, shards, date_range=None):
+    """
+    Split the mapping's key space into shards (see CtableExtractor.get_shards) and extract each
+    shard in an extract_shard task so that the shards are spread over the celery workers.
+    """
+    key_ranges = extractor.get_shards(mapping, shards, date_range=date_range)
+    logger.info("Extracting %s in %d shards", mapping.name, len(key_ranges))
+
+    # create the table up front so that the shards don't race to create it
+    with extractor.backend:
+        extractor.backend.init_mapping(mapping)
+
+    header = [extract_shard.s(mapping._id, list(key_range)) for key_range in key_ranges]
+    chord(header)(finish_sharded_extract.s(mapping._id, time.time(), date_range=date_range))
+
+
+@task
+def extract_shard(extract_id, key_range):
+    """
+    Extract the rows of a mapping in a single KeyRange.
+
+    :return: the stats for the shard (ExtractStats.to_json)
+    """
+    mapping = SqlExtractMapping.get(extract_id)
+    stats = ExtractStats()
+    try:
+        get_extractor(mapping.backend).extract(mapping, key_range=KeyRange(*key_range), stats=stats)
+    except Exception as e:
+        if is_transient(e):
+            raise extract_shard.retry(
+                exc=e,
+                countdown=getattr(settings, 'CTABLE_EXTRACT_RETRY_DELAY', 60),
+                max_retries=getattr(settings, 'CTABLE_EXTRACT_MAX_RETRIES', 3)
+            )
+        stats.finish()
+        record_run(mapping, stats, error='%s: %s' % (e.__class__.__name__, e))
+        raise
+    return stats.to_json()
+
+
+@task
+def finish_sharded_extract(shard_stats, extract_id, started, date_range=None):
+    """
+    Record the run of a sharded extract once all of its shards have been extracted.
+    """
+    mapping = SqlExtractMapping.get(extract_id)
+    stats = ExtractStats(started=started)
+    for data in shard_stats:
+        stats.add(data)
+    stats.finish()
+    record_run(mapping, stats)
+
+    if not date_range:
+        state = ExtractState.for_mapping(mapping)
+        state.record_runtime(stats.duration)
+        state.save()
+
+
+def record_run(mapping, stats, **kwargs):
+    try:
+        ExtractRun.from_stats(mapping, stats, **kwargs).save()
+        ExtractRun.prune(mapping._id)
+    except Exception:
+        logger.exception("Unable to save the stats for the extract run of %s", mapping.name)
 
 
 @periodic_task(
@@ -31,6 +182,16 @@ def ctable_extract_schedule():
 
     logger.info("ctable_extract_schedule: processing %s extracts" % len(exps))
 
-    stagger_gap = getattr(settings, 'CTABLE_TASK_STAGGER_GAP', 10)
-    for i, exp in enumerate(exps):
-        process_extract.apply_async(args=[exp['id']], countdown=stagger_gap * i)
+    runtimes = ExtractState.average_runtimes([exp['id'] for exp in exps])
+    extracts = []
+    for exp in exps:
+        # the value is a list rather than a dict so that couchdbkit doesn't wrap the row as a mapping
+        database, backend = exp.get('value') or (None, None)
+        extracts.append(ScheduledExtract(
+            mapping_id=exp['id'],
+            database=database,
+            backend=backend,
+            runtime=runtimes.get(exp['id'])
+        ))
+    for mapping_id, countdown in ExtractScheduler().schedule(extracts):
+        process_extract.apply_async(args=[mapping_id], countdown=countdown)
@@ -24,9 +24,17 @@ class TestBase(TestCase):
 
 try:
     from ctable.tests.test_backends import *
+    from ctable.tests.test_converters import *
     from ctable.tests.test_extract import *
+    from ctable.tests.test_instrumentation import *
     from ctable.tests.test_models import *
+    from ctable.tests.test_pipeline import *
+    from ctable.tests.test_plan import *
+    from ctable.tests.test_progress import *
+    from ctable.tests.test_scheduler import *
     from ctable.tests.test_signals import *
+    from ctable.tests.test_stats import *
+    from ctable.tests.test_tasks import *
     from ctable.tests.test_util import *
     from ctable.tests.test_views import *
 except ImportError, e:
@@ -1,14 +1,41 @@
+import csv
 import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
 import sqlalchemy
+from unittest import skipUnless
+from mock import patch, PropertyMock
 from sqlalchemy.exc import ProgrammingError
-from ctable.backends import SqlBackend, ColumnTypeException
+from ctable.backends import (
+    SqlBackend, ColumnTypeException, TransactionBatch, InMemoryBackend, FileBackend, DuckDbBackend, duckdb
+)
 from ctable.tests import TestBase
 from django.conf import settings
 from ctable.models import ColumnDef, KeyMatcher, SqlExtractMapping
 
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 TABLE = "{0}_test_table".format(settings.CTABLE_PREFIX)
 
 
+def get_upsert_mapping():
+    return SqlExtractMapping(domains=['test'], name='table', couch_view="c/view", columns=[
+        ColumnDef(name="user_id", data_type="string", value_source="key", value_index=0),
+        ColumnDef(name="date", data_type="date", value_source="key", value_index=1),
+        ColumnDef(name="indicator_a", data_type="integer", value_source="value",
+                  match_keys=[KeyMatcher(index=2, value="a")]),
+        ColumnDef(name="indicator_b", data_type="integer", value_source="value",
+                  match_keys=[KeyMatcher(index=2, value="b")]),
+    ])
+
+
 class BackendBase(TestBase):
     def setUp(self):
         super(BackendBase, self).setUp()
@@ -187,6 +214,202 @@ class TestBackends(BackendBase):
             self.backend.write_rows(rows, extract)
             self.backend.write_rows(rows, extract)
 
+    def test_bulk_upsert(self):
+        extract = get_upsert_mapping()
+        rows = [{'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_a': 1},
+                {'user_id': 'u2', 'date': datetime.date(2013, 8, 2), 'indicator_a': 2, 'indicator_b': 3}]
+        with self.backend:
+            self.assertTrue(self.backend.supports_bulk_upsert)
+            self.backend.write_rows(rows, extract)
+
+        rows = [{'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_b': 4},
+                {'user_id': 'u2', 'date': datetime.date(2013, 8, 2), 'indicator_a': 5},
+                {'user_id': 'u2', 'date': datetime.date(2013, 8, 2), 'indicator_b': 6},
+                {'user_id': 'u3', 'date': datetime.date(2013, 8, 2)}]
+        with self.backend:
+            self.backend.write_rows(rows, extract)
+
+        self.assertEqual(self._get_upsert_results(), {
+            'u1': (1, 4),
+            'u2': (5, 6),
+            'u3': (None, None),
+        })
+
+    def test_upsert_row_by_row(self):
+        extract = get_upsert_mapping()
+        rows = [{'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_a': 1},
+                {'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_b': 2}]
+        with patch.object(SqlBackend, 'supports_bulk_upsert', new_callable=PropertyMock, return_value=False):
+            with patch.object(SqlBackend, 'bulk_upsert') as bulk_upsert:
+                with self.backend:
+                    self.backend.write_rows(rows, extract)
+
+        self.assertFalse(bulk_upsert.called)
+        self.assertEqual(self._get_upsert_results(), {'u1': (1, 2)})
+
+    def test_copy_rows(self):
+        extract = get_upsert_mapping()
+        rows = [{'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_a': 1, 'indicator_b': 2}]
+        with self.backend:
+            self.backend.write_rows(rows, extract)
+
+        rows = [{'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_a': 3},
+                {'user_id': u'u"2', 'date': datetime.date(2013, 8, 2), 'indicator_a': 4},
+                {'user_id': u'u"2', 'date': datetime.date(2013, 8, 2), 'indicator_a': 5, 'indicator_b': 6},
+                {'user_id': 'u3', 'date': datetime.date(2013, 8, 2)}]
+        with self.backend:
+            self.backend.copy_rows(rows, extract)
+
+        self.assertEqual(self._get_upsert_results(), {
+            'u1': (3, 2),
+            'u"2': (5, 6),
+            'u3': (None, None),
+        })
+
+    def test_rebuild_rows(self):
+        extract = get_upsert_mapping()
+        rows = [{'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_a': 1, 'indicator_b': 2}]
+        with self.backend:
+            self.backend.write_rows(rows, extract)
+
+        rows = [{'user_id': 'u2', 'date': datetime.date(2013, 8, 2), 'indicator_a': 3},
+                {'user_id': 'u2', 'date': datetime.date(2013, 8, 2), 'indicator_b': 4}]
+        with self.backend:
+            self.backend.rebuild_rows(rows, extract)
+
+        self.assertEqual(self._get_upsert_results(), {'u2': (3, 4)})
+        self.assertNotIn('%s__new' % TABLE, self.metadata.tables)
+        self.assertEqual([c.name for c in self.table(TABLE).primary_key.columns], ['user_id', 'date'])
+
+        # rebuild again to make sure the primary key name doesn't clash
+        with self.backend:
+            self.backend.rebuild_rows(rows[:1], extract)
+            self.backend.write_rows([{'user_id': 'u2', 'date': datetime.date(2013, 8, 2), 'indicator_a': 5}], extract)
+
+        self.assertEqual(self._get_upsert_results(), {'u2': (5, None)})
+
+    def test_rebuild_rows_row_by_row(self):
+        extract = get_upsert_mapping()
+        rows = [{'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_a': 1, 'indicator_b': 2}]
+        with self.backend:
+            self.backend.write_rows(rows, extract)
+
+        rows = [{'user_id': 'u2', 'date': datetime.date(2013, 8, 2), 'indicator_a': 3},
+                {'user_id': 'u2', 'date': datetime.date(2013, 8, 2), 'indicator_b': 4}]
+        with patch.object(SqlBackend, 'supports_bulk_upsert', new_callable=PropertyMock, return_value=False):
+            with self.backend:
+                self.backend.rebuild_rows(rows, extract)
+
+        self.assertEqual(self._get_upsert_results(), {'u2': (3, 4)})
+        self.assertNotIn('%s__new' % TABLE, self.metadata.tables)
+
+    def test_bad_row_skipped(self):
+        extract = get_upsert_mapping()
+        rows = [{'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_a': 1},
+                {'user_id': 'u' * 300, 'date': datetime.date(2013, 8, 2), 'indicator_a': 2},
+                {'user_id': 'u3', 'date': datetime.date(2013, 8, 2), 'indicator_a': 3}]
+        with self.backend:
+            self.backend.write_rows(rows, extract)
+
+        self.assertEqual(self._get_upsert_results(), {'u1': (1, None), 'u3': (3, None)})
+
+    def test_bad_row_skipped_row_by_row(self):
+        extract = get_upsert_mapping()
+        rows = [{'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_a': 1},
+                {'user_id': 'u' * 300, 'date': datetime.date(2013, 8, 2), 'indicator_a': 2},
+                {'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_b': 3}]
+        with patch.object(SqlBackend, 'supports_bulk_upsert', new_callable=PropertyMock, return_value=False):
+            with self.backend:
+                self.backend.write_rows(rows, extract)
+
+        self.assertEqual(self._get_upsert_results(), {'u1': (1, 3)})
+
+    def test_commit_every(self):
+        extract = get_upsert_mapping()
+        rows = [{'user_id': 'u%s' % i, 'date': datetime.date(2013, 8, 2), 'indicator_a': i} for i in range(5)]
+        backend = SqlBackend(self.connection, batch_size=1, commit_every=2)
+        with patch.object(TransactionBatch, 'begin', autospec=True, side_effect=TransactionBatch.begin) as begin:
+            with backend:
+                backend.write_rows(rows, extract)
+
+        self.assertEqual(begin.call_count, 3)
+        self.assertEqual(len(self._get_upsert_results()), 5)
+
+    def test_nested_context(self):
+        with self.backend:
+            connection = self.backend.connection
+            with self.backend:
+                self.assertIs(self.backend.connection, connection)
+            self.assertIs(self.backend.connection, connection)
+            self.assertFalse(connection.closed)
+
+        self.assertTrue(connection.closed)
+        with self.assertRaises(Exception):
+            self.backend.connection
+
+    def test_threaded_writes(self):
+        extract = get_upsert_mapping()
+        backend = SqlBackend(self.engine)
+        errors = []
+
+        def write(user_ids):
+            try:
+                rows = [{'user_id': u, 'date': datetime.date(2013, 8, 2), 'indicator_a': 1} for u in user_ids]
+                with backend:
+                    connection = backend.connection
+                    backend.write_rows(rows, extract)
+                    assert backend.connection is connection
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(['u%s_%s' % (i, j) for j in range(20)],))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self._get_upsert_results()), 80)
+
+    def test_table_cache(self):
+        extract = get_upsert_mapping()
+        rows = [{'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_a': 1}]
+        with patch.object(SqlBackend, 'table', autospec=True, side_effect=SqlBackend.table) as table:
+            with self.backend:
+                self.backend.write_rows(rows, extract)
+                self.backend.write_rows(rows, extract)
+            self.assertEqual(table.call_count, 1)
+
+            extract.columns.append(ColumnDef(name="indicator_c", data_type="integer", value_source="value",
+                                             match_keys=[KeyMatcher(index=2, value="c")]))
+            with self.backend:
+                self.backend.write_rows(rows, extract)
+                self.assertIn('indicator_c', self.backend.get_table(extract).c)
+
+            table.reset_mock()
+            with self.backend:
+                self.backend.clear_all_data(extract)
+                self.backend.write_rows(rows, extract)
+            self.assertEqual(table.call_count, 1)
+
+    def test_table_cache_table_dropped(self):
+        extract = get_upsert_mapping()
+        rows = [{'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_a': 1}]
+        with self.backend:
+            self.backend.write_rows(rows, extract)
+
+        # e.g. another process rebuilding the table
+        self.connection.execute('DROP TABLE "%s"' % extract.table_name)
+
+        with self.backend:
+            self.backend.write_rows(rows, extract)
+        self.assertEqual(self._get_upsert_results(), {'u1': (1, None)})
+
+    def _get_upsert_results(self):
+        return dict([(row.user_id, (row.indicator_a, row.indicator_b)) for row in
+                     self.connection.execute('SELECT * FROM "%s"' % TABLE)])
+
 
 class TestBackendsMultiUser(BackendBase):
     def setUp(self):
@@ -258,3 +481,258 @@ class TestBackendsMultiUser(BackendBase):
             self.backend2.clear_all_data(Mapping)
 
             self.assertNotIn(TABLE, self.metadata.tables)
+
+
+class TestInMemoryBackend(TestBase):
+    def test_upsert(self):
+        backend = InMemoryBackend()
+        extract = self._get_mapping()
+        backend.write_rows([
+            {'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_a': 1},
+            {'user_id': 'u2', 'date': datetime.date(2013, 8, 2), 'indicator_a': 2},
+            {'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_b': 3},
+        ], extract)
+
+        self.assertEqual(backend.data['table_name'], extract.table_name)
+        self.assertEqual(backend.data['columns'], ['user_id', 'date', 'indicator_a', 'indicator_b'])
+        self.assertEqual(backend.data['rows'], [
+            ['u1', datetime.date(2013, 8, 2), 1, 3],
+            ['u2', datetime.date(2013, 8, 2), 2, None],
+        ])
+
+    def test_instance_scoped(self):
+        InMemoryBackend().write_rows([{'user_id': 'u1', 'date': datetime.date(2013, 8, 2)}], self._get_mapping())
+        self.assertEqual(InMemoryBackend().data, {})
+
+    def test_max_rows(self):
+        backend = InMemoryBackend(max_rows=2)
+        backend.write_rows(self._get_rows(4), self._get_mapping())
+        self.assertEqual([row[0] for row in backend.data['rows']], ['u0', 'u1'])
+        self.assertEqual(backend.data['dropped'], 2)
+
+    def test_ring(self):
+        backend = InMemoryBackend(max_rows=3, ring=True)
+        backend.write_rows(self._get_rows(5), self._get_mapping())
+        self.assertEqual([row[0] for row in backend.data['rows']], ['u2', 'u3', 'u4'])
+
+        # rows which are still kept are updated in place
+        backend.write_rows([{'user_id': 'u3', 'date': datetime.date(2013, 8, 2), 'indicator_a': 10}],
+                           self._get_mapping())
+        self.assertEqual(backend.data['rows'][1], ['u3', datetime.date(2013, 8, 2), 10, None])
+
+    def test_rejected_row(self):
+        backend = InMemoryBackend()
+        backend.write_rows([
+            {'user_id': 'u' * 256, 'date': datetime.date(2013, 8, 2)},
+            {'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_a': 2 ** 40},
+            {'user_id': 'u2', 'date': datetime.date(2013, 8, 2), 'indicator_a': 1},
+        ], self._get_mapping())
+        self.assertEqual(backend.data['rows'], [['u2', datetime.date(2013, 8, 2), 1, None]])
+        self.assertEqual(backend.data['rejected'], 2)
+
+    def _get_rows(self, count):
+        return [{'user_id': 'u%d' % i, 'date': datetime.date(2013, 8, 2), 'indicator_a': i} for i in range(count)]
+
+    def _get_mapping(self):
+        return get_upsert_mapping()
+
+
+class TestFileBackend(TestBase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.mapping = get_upsert_mapping()
+        self.rows = [
+            {'user_id': u'u\xe91', 'date': datetime.date(2013, 8, 2), 'indicator_a': 1},
+            {'user_id': 'u2', 'date': datetime.date(2013, 8, 3), 'indicator_b': 2},
+            {'user_id': 'u3', 'date': datetime.date(2013, 8, 4), 'indicator_a': 3, 'indicator_b': 4},
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_csv(self):
+        backend = FileBackend(self.directory, max_rows=2)
+        with backend:
+            backend.write_rows(iter(self.rows), self.mapping)
+
+        manifest = self._get_manifest()
+        self.assertEqual(manifest['key_columns'], ['user_id', 'date'])
+        self.assertEqual(manifest['columns'][0], {'name': 'user_id', 'type': 'VARCHAR(255)', 'nullable': False})
+        self.assertEqual(manifest['columns'][2], {'name': 'indicator_a', 'type': 'INTEGER', 'nullable': True})
+        self.assertFalse(manifest['replace'])
+        self.assertEqual(manifest['rows'], 3)
+        self.assertEqual([f['rows'] for f in manifest['files']], [2, 1])
+
+        rows = []
+        for f in manifest['files']:
+            with gzip.open(os.path.join(backend.table_dir(self.mapping), f['path'])) as csv_file:
+                reader = csv.reader(csv_file)
+                self.assertEqual(next(reader), ['user_id', 'date', 'indicator_a', 'indicator_b'])
+                rows.extend(reader)
+        self.assertEqual(rows, [
+            ['u\xc3\xa91', '2013-08-02', '1', ''],
+            ['u2', '2013-08-03', '', '2'],
+            ['u3', '2013-08-04', '3', '4'],
+        ])
+
+    def test_check_and_init_mapping(self):
+        # called by the view when a forced run is started
+        backend = FileBackend(self.directory)
+        with backend:
+            self.assertEqual(backend.check_mapping(self.mapping), {'errors': [], 'warnings': []})
+            backend.init_mapping(self.mapping)
+
+    def test_rebuild(self):
+        backend = FileBackend(self.directory)
+        backend.rebuild_rows(self.rows, self.mapping)
+        self.assertTrue(self._get_manifest()['replace'])
+
+    def test_failed_export(self):
+        def rows():
+            yield self.rows[0]
+            raise ValueError()
+
+        backend = FileBackend(self.directory)
+        with self.assertRaises(ValueError):
+            backend.write_rows(rows(), self.mapping)
+        self.assertEqual(os.listdir(backend.table_dir(self.mapping)), [])
+
+    def test_clear_all_data(self):
+        backend = FileBackend(self.directory)
+        backend.write_rows(self.rows, self.mapping)
+        backend.clear_all_data(self.mapping)
+        self.assertFalse(os.path.exists(backend.table_dir(self.mapping)))
+
+    @skipUnless(pyarrow, 'pyarrow is not installed')
+    def test_parquet(self):
+        backend = FileBackend(self.directory, format='parquet', row_group_size=2)
+        backend.write_rows(self.rows, self.mapping)
+
+        manifest = self._get_manifest()
+        self.assertEqual(manifest['format'], 'parquet')
+        table = pyarrow.parquet.read_table(
+            os.path.join(backend.table_dir(self.mapping), manifest['files'][0]['path']))
+        self.assertEqual(table.num_rows, 3)
+        self.assertEqual(table.column('indicator_b').to_pylist(), [None, 2, 4])
+
+    def _get_manifest(self):
+        table_dir = os.path.join(self.directory, self.mapping.table_name)
+        manifests = [name for name in os.listdir(table_dir) if name.endswith('.manifest.json')]
+        self.assertEqual(len(manifests), 1)
+        with open(os.path.join(table_dir, manifests[0])) as f:
+            return json.load(f)
+
+
+@skipUnless(duckdb, 'duckdb is not installed')
+class TestDuckDbBackend(TestBase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = DuckDbBackend(os.path.join(self.directory, 'test.duckdb'), batch_size=2)
+        self.mapping = get_upsert_mapping()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_upsert(self):
+        self.backend.write_rows([
+            {'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_a': 1},
+            {'user_id': 'u2', 'date': datetime.date(2013, 8, 2), 'indicator_a': 2, 'indicator_b': 3},
+        ], self.mapping)
+        self.backend.write_rows([
+            {'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_b': 4},
+            {'user_id': 'u2', 'date': datetime.date(2013, 8, 2), 'indicator_a': 5},
+            {'user_id': 'u2', 'date': datetime.date(2013, 8, 2), 'indicator_b': 6},
+            {'user_id': 'u3', 'date': datetime.date(2013, 8, 2)},
+        ], self.mapping)
+
+        self.assertEqual(self._get_results(), {
+            'u1': (1, 4),
+            'u2': (5, 6),
+            'u3': (None, None),
+        })
+
+    def test_add_column(self):
+        self.mapping.columns.pop()
+        self.backend.write_rows([{'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_a': 1}],
+                                self.mapping)
+
+        mapping = get_upsert_mapping()
+        self.backend.write_rows([{'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_b': 2}], mapping)
+        self.assertEqual(self._get_results(), {'u1': (1, 2)})
+
+    def test_check_mapping(self):
+        self.backend.write_rows([], self.mapping)
+        self.assertEqual(self.backend.check_mapping(self.mapping), {'errors': [], 'warnings': []})
+
+        mapping = get_upsert_mapping()
+        mapping.columns[2].data_type = 'string'
+        mapping.columns.pop()
+        checks = self.backend.check_mapping(mapping)
+        self.assertEqual(checks['errors'], ['Column types do not match: indicator_a'])
+        self.assertEqual(checks['warnings'], ['Column exists in table but not in mapping: indicator_b'])
+
+        with self.assertRaises(ColumnTypeException):
+            self.backend.write_rows([], mapping)
+
+    def test_threads(self):
+        errors = []
+
+        def write():
+            try:
+                self.backend.write_rows(
+                    [{'user_id': 'u%d' % i, 'date': datetime.date(2013, 8, 2), 'indicator_a': i} for i in range(20)],
+                    self.mapping
+                )
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        with self.backend:
+            self.backend.connection.execute('SELECT COUNT(*) FROM "%s"' % self.mapping.table_name)
+            self.assertEqual(self.backend.connection.fetchone()[0], 20)
+
+    def test_check_mapping_no_database(self):
+        self.assertEqual(self.backend.check_mapping(self.mapping), {'errors': [], 'warnings': []})
+        self.assertFalse(os.path.exists(self.backend.path))
+
+    def test_database_closed(self):
+        with self.backend:
+            self.backend.write_rows([], self.mapping)
+            self.assertIsNotNone(self.backend.database)
+            self.assertEqual(self.backend.check_mapping(self.mapping), {'errors': [], 'warnings': []})
+        self.assertIsNone(self.backend.database)
+
+        # the file isn't locked once the backend is closed
+        database = duckdb.connect(self.backend.path)
+        database.close()
+
+    def test_rebuild_rows(self):
+        self.backend.write_rows([{'user_id': 'u1', 'date': datetime.date(2013, 8, 2), 'indicator_a': 1}],
+                                self.mapping)
+        self.backend.rebuild_rows([{'user_id': 'u2', 'date': datetime.date(2013, 8, 2), 'indicator_a': 2}],
+                                  self.mapping)
+        self.assertEqual(self._get_results(), {'u2': (2, None)})
+
+    def test_commit_every(self):
+        self.backend.batch_size = 1
+        self.backend.commit_every = 2
+        commits = []
+        self.backend.write_rows(
+            [{'user_id': 'u%d' % i, 'date': datetime.date(2013, 8, 2)} for i in range(5)],
+            self.mapping,
+            on_commit=lambda: commits.append(len(self._get_results()))
+        )
+        self.assertEqual(commits, [2, 4])
+
+    def _get_results(self):
+        with self.backend:
+            self.backend.connection.execute(
+                'SELECT user_id, indicator_a, indicator_b FROM "%s"' % self.mapping.table_name)
+            rows = self.backend.connection.fetchall()
+        return dict([(user_id, (a, b)) for user_id, a, b in rows])
@@ -0,0 +1,49 @@
+from datetime import datetime
+from django.test import SimpleTestCase
+from ctable.converters import DateConverter, FAST_FORMATS
+
+
+class TestConverters(SimpleTestCase):
+
+    def test_fast_formats(self):
+        values = {
+            '%Y-%m-%d': ['2013-03-01', '2013-3-1', '2013-02-30', '2013-03-01 '],
+            '%Y-%m-%dT%H:%M:%S': ['2013-03-01T12:01:02', '2013-03-01T25:01:02'],
+            '%Y-%m-%d %H:%M:%S': ['2013-03-01 12:01:02'],
+            '%Y-%m-%dT%H:%M:%SZ': ['2013-03-01T12:01:02Z', '2013-03-01T12:01:02'],
+            '%Y-%m-%dT%H:%M:%S.%fZ': ['2013-03-01T12:01:02.123Z', '2013-03-01T12:01:02.5Z',
+                                      '2013-03-01T12:01:02.123456Z', '2013-03-01T12:01:02Z'],
+        }
+        self.assertEqual(set(values), set(FAST_FORMATS))
+        for date_format, strings in values.items():
+            converter = DateConverter(date_format)
+            for value in strings:
+                try:
+                    expected = datetime.strptime(value, date_format)
+                except ValueError:
+                    with self.assertRaises(ValueError):
+                        converter(value)
+                else:
+                    self.assertEqual(converter(value), expected)
+
+    def test_cache(self):
+        converter = DateConverter('%Y-%m-%d', cache_size=2)
+        self.assertEqual(converter('2013-03-01'), datetime(2013, 3, 1))
+        self.assertEqual(converter('2013-03-01'), datetime(2013, 3, 1))
+        self.assertEqual((converter.hits, converter.misses), (1, 1))
+
+        with self.assertRaises(ValueError):
+            converter('bad')
+        with self.assertRaises(ValueError):
+            converter('bad')
+        self.assertEqual((converter.hits, converter.misses), (2, 2))
+
+        # least recently used value is evicted
+        converter('2013-03-01')
+        converter('2013-03-02')
+        self.assertEqual(list(converter.cache), ['2013-03-01', '2013-03-02'])
+        self.assertEqual(converter.stats['size'], 2)
+
+    def test_no_format(self):
+        converter = DateConverter()
+        self.assertEqual(converter('2013-03-01T12:00:00.000000Z'), datetime(2013, 3, 1, 12))
@@ -1,23 +1,35 @@
 from django.conf import settings
+from django.test.utils import override_settings
 import sqlalchemy
-from mock import patch
+import pickle
+import time
+from mock import patch, Mock
 from datetime import date, datetime, timedelta
 from ctable.tests import TestBase
 from ctable.backends import SqlBackend
-from ctable.base import CtableExtractor, fluff_view
-from ctable.models import SqlExtractMapping, ColumnDef, KeyMatcher
+from ctable.base import CtableExtractor, KeyRange, _extract_shard, fluff_view, get_grain_pool
+from ctable.cache import mapping_cache
+from ctable.stats import ExtractStats
+from ctable.progress import ProgressReporter
+from ctable.instrumentation import AggregatingInstrumentation, set_instrumentation
+from ctable.models import SqlExtractMapping, ColumnDef, KeyMatcher, ExtractState, LOAD_MODE_COPY
 
 DOMAIN = "test"
 MAPPING_NAME = "demo_extract"
 TABLE = "%s_%s_%s" % (settings.CTABLE_PREFIX, DOMAIN, MAPPING_NAME)
 
 
+def changed_keys(mapping, change):
+    return [[change['doc']['user']]]
+
+
 class TestCTable(TestBase):
 
     def setUp(self):
         self.connection = self.engine.connect()
         self.trans = self.connection.begin()
         self.db.reset()
+        mapping_cache.clear()
         self.ctable = CtableExtractor(self.db, SqlBackend(self.connection))
 
         self.p2 = patch("ctable.base.get_db", return_value=self.db)
@@ -70,6 +82,256 @@ class TestCTable(TestBase):
         self.assertEqual(result['2_2013-03-01']['rename_indicator_a'], 3)
         self.assertIsNone(result['2_2013-03-01']['indicator_b'])
 
+    def test_extract_stats(self):
+        self.db.add_view('c/view', [
+            (
+                {'reduce': True, 'group': True, 'startkey': [], 'endkey': [{}]},
+                [
+                    {"key": ["1", "indicator_a", "2013-03-01T12:00:00.000Z"], "value": {"sum": 1}},
+                    {"key": ["1", "indicator_b", "2013-03-01T12:00:00.000Z"], "value": {"sum": 2}},
+                    {"key": ["2", "indicator_a", "2013-03-01T12:00:00.000Z"], "value": {"sum": 3}},
+                ]
+            )
+        ])
+
+        extract = SqlExtractMapping(domains=[DOMAIN], name=MAPPING_NAME, couch_view="c/view", columns=[
+            ColumnDef(name="username", data_type="string", max_length=50, value_source="key", value_index=0),
+            ColumnDef(name="indicator_a", data_type="integer", value_source="value", value_attribute="sum",
+                      match_keys=[KeyMatcher(index=1, value="indicator_a")]),
+            ColumnDef(name="indicator_b", data_type="integer", value_source="value", value_attribute="sum",
+                      match_keys=[KeyMatcher(index=1, value="indicator_b")]),
+        ])
+
+        stats = ExtractStats()
+        self.ctable.extract(extract, stats=stats)
+        stats.finish()
+
+        self.assertEqual(stats.rows_read, 3)
+        self.assertEqual(stats.rows_written, 2)
+        self.assertEqual(stats.peak_batch_sizes, {'fetch': 3})
+        self.assertEqual(set(stats.timings), {'fetch', 'convert', 'combine', 'write'})
+        self.assertEqual(self.connection.execute('SELECT COUNT(*) FROM %s' % extract.table_name).scalar(), 2)
+
+    def test_extract_stats_slow_view_request(self):
+        self.db.add_view('c/view', [
+            (
+                {'reduce': True, 'group': True, 'startkey': [], 'endkey': [{}]},
+                [{"key": [str(i), "indicator_a"], "value": {"sum": i}} for i in range(5)]
+            )
+        ])
+        extract = SqlExtractMapping(domains=[DOMAIN], name=MAPPING_NAME, couch_view="c/view", columns=[
+            ColumnDef(name="username", data_type="string", max_length=50, value_source="key", value_index=0),
+            ColumnDef(name="indicator_a", data_type="integer", value_source="value", value_attribute="sum",
+                      match_keys=[KeyMatcher(index=1, value="indicator_a")]),
+        ])
+
+        class SlowResult(object):
+            def __init__(self, result):
+                self.result = result
+
+            @property
+            def total_rows(self):
+                time.sleep(0.2)
+                return self.result.total_rows
+
+            def __iter__(self):
+                return iter(self.result)
+
+        def slow_convert(rows, mapping, **kwargs):
+            for row in convert(rows, mapping, **kwargs):
+                time.sleep(0.02)
+                yield row
+
+        get_couch_rows = self.ctable.get_couch_rows
+        convert = self.ctable.couch_rows_to_sql_rows
+        stats = ExtractStats()
+        with patch.object(self.ctable, 'get_couch_rows', lambda *args, **kwargs: SlowResult(
+                get_couch_rows(*args, **kwargs))), \
+                patch.object(self.ctable, 'couch_rows_to_sql_rows', slow_convert):
+            self.ctable.extract(extract, stats=stats)
+
+        # the view request isn't taken off the conversion time
+        self.assertGreaterEqual(stats.timings['fetch'], 0.2)
+        self.assertAlmostEqual(stats.timings['convert'], 0.1, delta=0.05)
+
+    def test_instrumentation(self):
+        instrumentation = AggregatingInstrumentation()
+        set_instrumentation(instrumentation)
+        self.addCleanup(set_instrumentation, None)
+
+        self.db.add_view('c/view', [
+            (
+                {'reduce': True, 'group': True, 'startkey': [], 'endkey': [{}]},
+                [{"key": ["1", "indicator_a"], "value": {"sum": 1}}]
+            )
+        ])
+        extract = SqlExtractMapping(domains=[DOMAIN], name=MAPPING_NAME, couch_view="c/view", columns=[
+            ColumnDef(name="username", data_type="string", max_length=50, value_source="key", value_index=0),
+            ColumnDef(name="indicator_a", data_type="integer", value_source="value", value_attribute="sum",
+                      match_keys=[KeyMatcher(index=1, value="indicator_a")]),
+        ])
+        self.ctable.extract(extract)
+
+        metrics = instrumentation.render()
+        self.assertIn('ctable_view_request_seconds_count{view="c/view"} 1', metrics)
+        self.assertIn('ctable_extract_seconds_count{table="%s"} 1' % TABLE, metrics)
+        self.assertIn('ctable_ddl_seconds_count{op="create_table",table="%s"} 1' % TABLE, metrics)
+        self.assertIn('ctable_lock_wait_seconds_count{table="%s"} 1' % TABLE, metrics)
+        self.assertIn('ctable_rows_read_total{table="%s"} 1' % TABLE, metrics)
+
+    def test_extract_progress(self):
+        self.db.add_view('c/view', [
+            (
+                {'reduce': True, 'group': True, 'startkey': [], 'endkey': [{}]},
+                [{"key": [str(i), "indicator_a"], "value": {"sum": i}} for i in range(250)]
+            )
+        ])
+        extract = SqlExtractMapping(domains=[DOMAIN], name=MAPPING_NAME, couch_view="c/view", columns=[
+            ColumnDef(name="username", data_type="string", max_length=50, value_source="key", value_index=0),
+            ColumnDef(name="indicator_a", data_type="integer", value_source="value", value_attribute="sum",
+                      match_keys=[KeyMatcher(index=1, value="indicator_a")]),
+        ])
+
+        reports = []
+        self.ctable.extract(extract, status_callback=ProgressReporter(reports.append, interval=60))
+
+        self.assertEqual([r['stage'] for r in reports], ['fetching', 'converting', 'writing', 'done'])
+        # rows are written while the rest are still being converted
+        self.assertLess(reports[2]['current'], 250)
+        self.assertEqual(reports[-1]['current'], 250)
+        self.assertEqual(reports[-1]['total'], 250)
+
+    def test_pipelined(self):
+        self.db.add_view('c/view', [
+            (
+                {'reduce': True, 'group': True, 'startkey': [], 'endkey': [{}]},
+                [
+                    {"key": ["1", "indicator_a", "2013-03-01T12:00:00.000Z"], "value": 1},
+                    {"key": ["1", "indicator_b", "2013-03-01T12:00:00.000Z"], "value": 2},
+                    {"key": ["2", "indicator_a", "2013-03-01T12:00:00.000Z"], "value": 3},
+                ]
+            )
+        ])
+
+        extract = SqlExtractMapping(domains=[DOMAIN], name=MAPPING_NAME, couch_view="c/view", columns=[
+            ColumnDef(name="username", data_type="string", max_length=50, value_source="key", value_index=0),
+            ColumnDef(name="date", data_type="date", date_format="%Y-%m-%dT%H:%M:%S.%fZ",
+                      value_source="key", value_index=2),
+            ColumnDef(name="indicator_a", data_type="integer", value_source="value",
+                      match_keys=[KeyMatcher(index=1, value="indicator_a")]),
+            ColumnDef(name="indicator_b", data_type="integer", value_source="value",
+                      match_keys=[KeyMatcher(index=1, value="indicator_b")]),
+        ])
+
+        self.ctable.extract(extract, pipelined=True)
+
+        result = dict(
+            [(row.username + "_" + self.format_date(row.date), row) for row in
+             self.connection.execute('SELECT * FROM %s' % extract.table_name)])
+        self.assertEqual(result['1_2013-03-01']['indicator_a'], 1)
+        self.assertEqual(result['1_2013-03-01']['indicator_b'], 2)
+        self.assertEqual(result['2_2013-03-01']['indicator_a'], 3)
+        self.assertIsNone(result['2_2013-03-01']['indicator_b'])
+
+    def test_paged(self):
+        rows = [
+            {"key": ["1", "indicator_a", "2013-03-01T12:00:00.000Z"], "value": 1},
+            {"key": ["1", "indicator_b", "2013-03-01T12:00:00.000Z"], "value": 2},
+            {"key": ["2", "indicator_a", "2013-03-01T12:00:00.000Z"], "value": 3},
+        ]
+        self.db.add_view('c/view', [
+            (
+                {'reduce': True, 'group': True, 'startkey': [], 'endkey': [{}], 'limit': 3},
+                rows
+            ),
+            (
+                {'reduce': True, 'group': True, 'startkey': rows[2]['key'], 'endkey': [{}], 'limit': 3},
+                rows[2:]
+            ),
+        ])
+
+        extract = SqlExtractMapping(domains=[DOMAIN], name=MAPPING_NAME, couch_view="c/view", columns=[
+            ColumnDef(name="username", data_type="string", max_length=50, value_source="key", value_index=0),
+            ColumnDef(name="date", data_type="date", date_format="%Y-%m-%dT%H:%M:%S.%fZ",
+                      value_source="key", value_index=2),
+            ColumnDef(name="indicator_a", data_type="integer", value_source="value",
+                      match_keys=[KeyMatcher(index=1, value="indicator_a")]),
+            ColumnDef(name="indicator_b", data_type="integer", value_source="value",
+                      match_keys=[KeyMatcher(index=1, value="indicator_b")]),
+        ])
+
+        self.assertEqual(self.ctable.extract(extract, page_size=2), (3, 0))
+
+        result = dict(
+            [(row.username, row) for row in
+             self.connection.execute('SELECT * FROM %s' % extract.table_name)])
+        self.assertEqual(result['1']['indicator_a'], 1)
+        self.assertEqual(result['1']['indicator_b'], 2)
+        self.assertEqual(result['2']['indicator_a'], 3)
+
+    def test_iter_couch_rows(self):
+        rows = [{"id": "doc%d" % i, "key": ["a"], "value": i} for i in range(5)]
+        self.db.add_view('c/view', [
+            (
+                {'reduce': False, 'startkey': ['a'], 'endkey': ['a', {}], 'limit': 3},
+                rows[:3]
+            ),
+            (
+                {'reduce': False, 'startkey': ['a'], 'startkey_docid': 'doc2', 'endkey': ['a', {}], 'limit': 3},
+                rows[2:5]
+            ),
+            (
+                {'reduce': False, 'startkey': ['a'], 'startkey_docid': 'doc4', 'endkey': ['a', {}], 'limit': 3},
+                rows[4:]
+            ),
+            (
+                {'reduce': False, 'startkey': ['a'], 'startkey_docid': 'doc2', 'endkey': ['a', {}], 'limit': 2},
+                rows[2:4]
+            ),
+        ])
+
+        for prefetch in (False, True):
+            result = self.ctable.iter_couch_rows('c/view', ['a'], ['a', {}], 2, reduce=False, prefetch=prefetch)
+            self.assertEqual(list(result), rows)
+
+        result = self.ctable.iter_couch_rows('c/view', ['a'], ['a', {}], 2, reduce=False, limit=3)
+        self.assertEqual(list(result), rows[:3])
+
+    def test_copy_load_mode(self):
+        self.db.add_view('c/view', [
+            (
+                {'reduce': True, 'group': True, 'startkey': [], 'endkey': [{}]},
+                [
+                    {"key": ["1", "indicator_a", "2013-03-01T12:00:00.000Z"], "value": 1},
+                    {"key": ["1", "indicator_b", "2013-03-01T12:00:00.000Z"], "value": 2},
+                    {"key": ["2", "indicator_a", "2013-03-01T12:00:00.000Z"], "value": 3},
+                ]
+            )
+        ])
+
+        extract = SqlExtractMapping(domains=[DOMAIN], name=MAPPING_NAME, couch_view="c/view",
+                                    load_mode=LOAD_MODE_COPY, columns=[
+            ColumnDef(name="username", data_type="string", max_length=50, value_source="key", value_index=0),
+            ColumnDef(name="date", data_type="date", date_format="%Y-%m-%dT%H:%M:%S.%fZ",
+                      value_source="key", value_index=2),
+            ColumnDef(name="indicator_a", data_type="integer", value_source="value",
+                      match_keys=[KeyMatcher(index=1, value="indicator_a")]),
+            ColumnDef(name="indicator_b", data_type="integer", value_source="value",
+                      match_keys=[KeyMatcher(index=1, value="indicator_b")]),
+        ])
+
+        with patch.object(SqlBackend, 'write_rows') as write_rows:
+            self.ctable.extract(extract)
+        self.assertFalse(write_rows.called)
+
+        result = dict(
+            [(row.username + "_" + self.format_date(row.date), row) for row in
+             self.connection.execute('SELECT * FROM %s' % extract.table_name)])
+        self.assertEqual(result['1_2013-03-01']['indicator_a'], 1)
+        self.assertEqual(result['1_2013-03-01']['indicator_b'], 2)
+        self.assertEqual(result['2_2013-03-01']['indicator_a'], 3)
+        self.assertIsNone(result['2_2013-03-01']['indicator_b'])
+
     def test_extra_query_params(self):
         self.db.add_view('c/view', [
             (
@@ -277,6 +539,65 @@ class TestCTable(TestBase):
         self.assertTrue(any(x for x in columns if x['name'] == 'visits_week_null_emitter'))
         self.assertTrue(any(x for x in columns if x['name'] == 'visits_week_all_visits'))
 
+    def test_fluff_extract_mapping_cached(self):
+        diff = self._get_fluff_diff()
+        em = self.ctable.get_fluff_extract_mapping(diff, 'SQL')
+
+        # the second diff shouldn't query CouchDB or save the mapping again
+        self.db.reset()
+        cached = self.ctable.get_fluff_extract_mapping(diff, 'SQL')
+        self.assertEqual(cached._rev, em._rev)
+        self.assertEqual([c.name for c in cached.columns], [c.name for c in em.columns])
+        self.assertEqual(self.db.mock_docs, {})
+
+    def test_fluff_extract_mapping_cache_not_shared(self):
+        em = self.ctable.get_fluff_extract_mapping(self._get_fluff_diff(), 'SQL')
+        em.columns.append(ColumnDef(name='extra', data_type='integer', value_source='value'))
+
+        cached = self.ctable.get_fluff_extract_mapping(self._get_fluff_diff(), 'SQL')
+        self.assertNotIn('extra', [c.name for c in cached.columns])
+        # mappings that don't need updating aren't copied
+        self.assertIs(cached, mapping_cache.entries['CtableFluffMapping_MockIndicators'].mapping)
+
+    def test_fluff_extract_mapping_cache_new_indicator(self):
+        diff = self._get_fluff_diff()
+        all_indicators = diff['all_indicators']
+        diff['all_indicators'] = [i for i in all_indicators if i['emitter'] == 'all_visits']
+        em = self.ctable.get_fluff_extract_mapping(diff, 'SQL')
+        self.assertEqual(len(em.columns), 3)
+
+        diff['all_indicators'] = all_indicators
+        updated = self.ctable.get_fluff_extract_mapping(diff, 'SQL')
+        self.assertEqual(len(updated.columns), 4)
+        self.assertNotEqual(updated._rev, em._rev)
+        self.assertEqual(len(em.columns), 3)
+
+        entry = mapping_cache.entries['CtableFluffMapping_MockIndicators']
+        self.assertEqual(entry.rev, updated._rev)
+        self.assertIn('visits_week_null_emitter', entry.column_names)
+        self.assertEqual(self.db.mock_docs['CtableFluffMapping_MockIndicators']['_rev'], updated._rev)
+
+    def test_fluff_extract_mapping_cache_refreshed_on_save(self):
+        em = self.ctable.get_fluff_extract_mapping(self._get_fluff_diff(), 'SQL')
+
+        edited = SqlExtractMapping.get(em._id)
+        edited.active = True
+        edited.save()
+
+        self.db.reset()
+        cached = self.ctable.get_fluff_extract_mapping(self._get_fluff_diff(), 'SQL')
+        self.assertTrue(cached.active)
+        self.assertEqual(cached._rev, edited._rev)
+
+    def test_fluff_extract_mapping_cache_disabled(self):
+        with self.settings(CTABLE_MAPPING_CACHE_TIMEOUT=0):
+            self.ctable.get_fluff_extract_mapping(self._get_fluff_diff(), 'SQL')
+            self.assertEqual(mapping_cache.entries, {})
+
+            self.db.reset()
+            self.ctable.get_fluff_extract_mapping(self._get_fluff_diff(), 'SQL')
+            self.assertIn('CtableFluffMapping_MockIndicators', self.db.mock_docs)
+
     def test_get_rows_for_grains(self):
         r1 = {"key": ['a', 'b', None], "value": 3}
         r2 = {"key": ['a', 'b', '2013-01-03'], "value": 2}
@@ -300,6 +621,114 @@ class TestCTable(TestBase):
         self.assertEqual(rows[0], r1)
         self.assertEqual(rows[1], r2)
 
+    def test_extract_incremental(self):
+        self.db.add_view('c/view', [
+            (
+                {'reduce': True, 'group': True, 'startkey': [], 'endkey': [{}]},
+                [
+                    {"key": ["1", "indicator_a", "2013-03-01T12:00:00.000Z"], "value": 1},
+                    {"key": ["2", "indicator_a", "2013-03-01T12:00:00.000Z"], "value": 2},
+                ]
+            ),
+            (
+                {'reduce': True, 'group': True, 'startkey': ["2"], 'endkey': ["2", {}]},
+                [
+                    {"key": ["2", "indicator_a", "2013-03-01T12:00:00.000Z"], "value": 3},
+                    {"key": ["2", "indicator_b", "2013-03-01T12:00:00.000Z"], "value": 4},
+                ]
+            ),
+        ])
+
+        extract = SqlExtractMapping(_id='incremental_mapping', domains=[DOMAIN], name=MAPPING_NAME,
+                                    couch_view="c/view", incremental=True,
+                                    changes_key_function='ctable.tests.test_extract.changed_keys', columns=[
+            ColumnDef(name="username", data_type="string", max_length=50, value_source="key", value_index=0),
+            ColumnDef(name="date", data_type="date", date_format="%Y-%m-%dT%H:%M:%S.%fZ",
+                      value_source="key", value_index=2),
+            ColumnDef(name="indicator_a", data_type="integer", value_source="value",
+                      match_keys=[KeyMatcher(index=1, value="indicator_a")]),
+            ColumnDef(name="indicator_b", data_type="integer", value_source="value",
+                      match_keys=[KeyMatcher(index=1, value="indicator_b")]),
+        ])
+
+        # first run is a full extract
+        with patch.object(self.db, 'info', create=True, return_value={'update_seq': 5}):
+            self.assertEqual(self.ctable.extract_incremental(extract), (2, 0))
+        self.assertEqual(ExtractState.for_mapping(extract).changes_seq, 5)
+
+        changes = [
+            {'seq': 6, 'id': 'doc1', 'doc': {'user': '2'}},
+            {'seq': 7, 'id': 'doc2', 'doc': {'user': '2'}},
+        ]
+        with patch.object(CtableExtractor, 'get_changes', return_value=changes) as get_changes:
+            self.assertEqual(self.ctable.extract_incremental(extract), (2, 0))
+        get_changes.assert_called_once_with(self.db, 5)
+        self.assertEqual(ExtractState.for_mapping(extract).changes_seq, 7)
+
+        result = dict(
+            [(row.username, row) for row in
+             self.connection.execute('SELECT * FROM %s' % extract.table_name)])
+        self.assertEqual(result['1']['indicator_a'], 1)
+        self.assertEqual(result['2']['indicator_a'], 3)
+        self.assertEqual(result['2']['indicator_b'], 4)
+
+    @override_settings(CTABLE_CHANGES_BATCH_SIZE=2)
+    def test_get_changes(self):
+        changes = [{'seq': seq, 'id': 'doc%d' % seq} for seq in range(1, 5)]
+        batches = {
+            3: {'results': changes[:2], 'last_seq': 5},
+            5: {'results': changes[2:], 'last_seq': 8},
+            8: {'results': [], 'last_seq': 8},
+        }
+        consumer = Mock()
+        consumer.fetch.side_effect = lambda since, **kwargs: batches[since]
+
+        with patch('ctable.base.Consumer', return_value=consumer) as consumer_class:
+            self.assertEqual(list(self.ctable.get_changes(self.db, 3)), changes)
+
+        consumer_class.assert_called_once_with(self.db)
+        self.assertEqual([call[1] for call in consumer.fetch.call_args_list], [
+            {'since': since, 'limit': 2, 'include_docs': True} for since in (3, 5, 8)
+        ])
+
+    @override_settings(CTABLE_CHANGES_BATCH_SIZE=2)
+    def test_get_changes_partial_batch(self):
+        consumer = Mock()
+        consumer.fetch.side_effect = [
+            {'results': [{'seq': 4}, {'seq': 5}], 'last_seq': 5},
+            {'results': [{'seq': 6}], 'last_seq': 6},
+        ]
+        with patch('ctable.base.Consumer', return_value=consumer):
+            self.assertEqual([c['seq'] for c in self.ctable.get_changes(self.db, 3)], [4, 5, 6])
+        self.assertEqual(consumer.fetch.call_count, 2)
+
+    def test_get_rows_for_grains_concurrent(self):
+        grains = [['a', 'b', '2013-01-%02d' % i] for i in range(1, 10)]
+        grains.append(grains[0])
+        self.db.add_view(fluff_view, [
+            (
+                {'reduce': True, 'group': True, 'startkey': grain, 'endkey': grain + [{}]},
+                [{"key": grain, "value": i}, {"key": grain + ['x'], "value": i}]
+            ) for i, grain in enumerate(grains[:-1])
+        ])
+
+        with self.settings(CTABLE_GRAIN_CONCURRENCY=1):
+            expected = self.ctable.recalculate_grains(grains, 'fluff')
+        with self.settings(CTABLE_GRAIN_CONCURRENCY=3):
+            rows = self.ctable.recalculate_grains(grains, 'fluff')
+        self.assertEqual(len(rows), 20)
+        self.assertEqual(rows, expected)
+        self.assertEqual(rows[-2:], rows[:2])
+
+    def test_grain_pool_shared(self):
+        pool = get_grain_pool(3)
+        self.assertIs(get_grain_pool(3), pool)
+        self.assertIsNot(get_grain_pool(2), pool)
+
+        with patch('ctable.base.get_grain_pool') as get_pool:
+            self.ctable.recalculate_grains([], 'fluff')
+        self.assertFalse(get_pool.called)
+
     def test_extract_fluff_diff(self):
         rows = [{"key": ['MockIndicators', '123', 'visits_week', 'null_emitter', None], "value": {'count': 3}},
                 {"key": ['MockIndicators', '123', 'visits_week', 'all_visits', '2012-02-24'], "value": {'count': 2}},
@@ -341,6 +770,190 @@ class TestCTable(TestBase):
         self.assertEqual(startkey, ['a', start.strftime(format)])
         self.assertEqual(endkey, ['a', end.strftime(format), {}])
 
+    def test_rebuild_ignores_date_range(self):
+        self.db.add_view('c/view', [
+            (
+                {'reduce': True, 'group': True, 'startkey': [], 'endkey': [{}]},
+                [{"key": ["1", "indicator_a"], "value": 1}]
+            )
+        ])
+        extract = self._get_key_ordered_mapping()
+        extract.couch_date_range = 10
+        extract.couch_date_format = '%Y-%m-%d'
+
+        with patch.object(self.ctable, 'write_rows_to_sql') as write_rows_to_sql:
+            self.ctable.extract(extract, date_range=5, rebuild=True)
+        self.assertEqual(list(write_rows_to_sql.call_args[0][0]), [{'username': '1', 'indicator_a': 1}])
+
+    def test_rebuild_with_limit(self):
+        with self.assertRaises(ValueError):
+            self.ctable.extract(self._get_key_ordered_mapping(), limit=10, rebuild=True)
+
+    def test_get_shards_with_dates(self):
+        format = '%Y-%m-%d'
+        mapping = SqlExtractMapping(couch_key_prefix=['a'], couch_date_range=10, couch_date_format=format,
+                                    columns=[
+            ColumnDef(name="date", data_type="date", date_format=format, value_source="key", value_index=1),
+        ])
+        startkey, endkey = self.ctable.get_couch_keys(mapping)
+        shards = self.ctable.get_shards(mapping, 3)
+
+        self.assertEqual(len(shards), 3)
+        self.assertEqual(shards[0].startkey, startkey)
+        self.assertEqual(shards[-1].endkey, endkey)
+        self.assertEqual([s.inclusive_end for s in shards], [False, False, True])
+        for shard, next_shard in zip(shards, shards[1:]):
+            self.assertEqual(shard.endkey, next_shard.startkey)
+
+    def test_get_shards_not_key_column(self):
+        mapping = SqlExtractMapping(couch_key_prefix=['a'], couch_date_range=10, columns=[
+            ColumnDef(name="date", data_type="date", value_source="key", value_index=1,
+                      match_keys=[KeyMatcher(index=2, value="indicator_a")]),
+        ])
+        self.assertEqual(len(self.ctable.get_shards(mapping, 3)), 1)
+
+    def test_extract_sharded(self):
+        rows = [
+            {"key": ["1", "indicator_a", "2013-03-01T12:00:00.000Z"], "value": 1},
+            {"key": ["1", "indicator_b", "2013-03-01T12:00:00.000Z"], "value": 2},
+            {"key": ["2", "indicator_a", "2013-03-01T12:00:00.000Z"], "value": 3},
+            {"key": ["3", "indicator_b", "2013-03-01T12:00:00.000Z"], "value": 4},
+        ]
+        self.db.add_view('c/view', [
+            (
+                {'reduce': True, 'group': True, 'group_level': 1, 'startkey': [], 'endkey': [{}]},
+                [{"key": ["1"], "value": 3}, {"key": ["2"], "value": 3}, {"key": ["3"], "value": 4}]
+            ),
+            (
+                {'reduce': True, 'group': True, 'startkey': [], 'endkey': ['2'], 'inclusive_end': False},
+                rows[:2]
+            ),
+            (
+                {'reduce': True, 'group': True, 'startkey': ['2'], 'endkey': ['3'], 'inclusive_end': False},
+                rows[2:3]
+            ),
+            (
+                {'reduce': True, 'group': True, 'startkey': ['3'], 'endkey': [{}]},
+                rows[3:]
+            ),
+        ])
+
+        extract = SqlExtractMapping(domains=[DOMAIN], name=MAPPING_NAME, couch_view="c/view", columns=[
+            ColumnDef(name="username", data_type="string", max_length=50, value_source="key", value_index=0),
+            ColumnDef(name="date", data_type="date", date_format="%Y-%m-%dT%H:%M:%S.%fZ",
+                      value_source="key", value_index=2),
+            ColumnDef(name="indicator_a", data_type="integer", value_source="value",
+                      match_keys=[KeyMatcher(index=1, value="indicator_a")]),
+            ColumnDef(name="indicator_b", data_type="integer", value_source="value",
+                      match_keys=[KeyMatcher(index=1, value="indicator_b")]),
+        ])
+
+        self.assertEqual(self.ctable.extract_sharded(extract, 3, processes=1), (4, 0))
+
+        result = dict(
+            [(row.username, row) for row in
+             self.connection.execute('SELECT * FROM %s' % extract.table_name)])
+        self.assertEqual(result['1']['indicator_a'], 1)
+        self.assertEqual(result['1']['indicator_b'], 2)
+        self.assertEqual(result['2']['indicator_a'], 3)
+        self.assertEqual(result['3']['indicator_b'], 4)
+
+    def test_extract_checkpoints(self):
+        self.db.add_view('c/view', [
+            (
+                {'reduce': True, 'group': True, 'startkey': [], 'endkey': [{}]},
+                [
+                    {"key": ["1", "indicator_a"], "value": 1},
+                    {"key": ["1", "indicator_b"], "value": 2},
+                    {"key": ["2", "indicator_a"], "value": 3},
+                    {"key": ["3", "indicator_b"], "value": 4},
+                ]
+            )
+        ])
+        extract = self._get_key_ordered_mapping()
+        self.ctable.backend = SqlBackend(self.connection, batch_size=1, commit_every=1)
+
+        checkpoints = []
+        self.ctable.extract(extract, checkpoint=checkpoints.append)
+
+        # the last group is only committed when the extract finishes
+        self.assertEqual(checkpoints, [['1'], ['2']])
+        self.assertEqual(self.connection.execute('SELECT COUNT(*) FROM %s' % extract.table_name).scalar(), 3)
+
+    def test_extract_resume(self):
+        self.db.add_view('c/view', [
+            (
+                {'reduce': True, 'group': True, 'startkey': ['1', {}], 'endkey': [{}]},
+                [
+                    {"key": ["2", "indicator_a"], "value": 3},
+                    {"key": ["3", "indicator_b"], "value": 4},
+                ]
+            )
+        ])
+        extract = self._get_key_ordered_mapping()
+
+        self.ctable.extract(extract, resume_key=['1'])
+
+        result = dict(
+            [(row.username, row) for row in
+             self.connection.execute('SELECT * FROM %s' % extract.table_name)])
+        self.assertEqual(sorted(result), ['2', '3'])
+        self.assertEqual(result['2']['indicator_a'], 3)
+        self.assertEqual(result['3']['indicator_b'], 4)
+
+    def test_checkpoints_not_supported(self):
+        extract = self._get_key_ordered_mapping()
+        self.assertTrue(self.ctable.supports_checkpoints(extract))
+        self.assertFalse(self.ctable.supports_checkpoints(extract, rebuild=True))
+        self.assertFalse(self.ctable.supports_checkpoints(extract, load_mode=LOAD_MODE_COPY))
+
+        extract.columns.append(ColumnDef(name="date", data_type="date", date_format="%Y-%m-%dT%H:%M:%S.%fZ",
+                                         value_source="key", value_index=2))
+        self.assertFalse(self.ctable.supports_checkpoints(extract))
+
+    def _get_key_ordered_mapping(self):
+        return SqlExtractMapping(domains=[DOMAIN], name=MAPPING_NAME, couch_view="c/view", columns=[
+            ColumnDef(name="username", data_type="string", max_length=50, value_source="key", value_index=0),
+            ColumnDef(name="indicator_a", data_type="integer", value_source="value",
+                      match_keys=[KeyMatcher(index=1, value="indicator_a")]),
+            ColumnDef(name="indicator_b", data_type="integer", value_source="value",
+                      match_keys=[KeyMatcher(index=1, value="indicator_b")]),
+        ])
+
+    def test_extract_shard_worker(self):
+        self.db.add_view('c/view', [
+            (
+                {'reduce': True, 'group': True, 'startkey': ['2'], 'endkey': ['3'], 'inclusive_end': False},
+                [{"key": ["2", "indicator_a"], "value": 3}]
+            ),
+        ])
+        extract = self._get_key_ordered_mapping()
+        args = pickle.loads(pickle.dumps(
+            ('http://localhost:5984/test', extract.to_json(), KeyRange(['2'], ['3'], False), None)
+        ))
+
+        with patch('ctable.base.Database', return_value=self.db) as database, \
+                patch('ctable.util.create_backend', return_value=SqlBackend(self.connection)):
+            self.assertEqual(_extract_shard(args)[0], 1)
+
+        self.assertEqual(database.call_args[0][0], 'http://localhost:5984/test')
+        result = list(self.connection.execute('SELECT * FROM %s' % extract.table_name))
+        self.assertEqual([(row.username, row.indicator_a) for row in result], [('2', 3)])
+
+    def test_extract_sharded_daemonic(self):
+        extract = self._get_key_ordered_mapping()
+        key_ranges = [KeyRange([], ['2'], False), KeyRange(['2'], [{}], True)]
+        process = Mock(daemon=True)
+        with patch.object(self.ctable, 'get_shards', return_value=key_ranges), \
+                patch.object(self.ctable, 'db', Mock(uri='http://localhost:5984/test')), \
+                patch('ctable.base._extract_shard', return_value=(2, 1)) as extract_shard, \
+                patch('multiprocessing.current_process', return_value=process), \
+                patch('multiprocessing.Pool') as pool:
+            self.assertEqual(self.ctable.extract_sharded(extract, 2), (4, 2))
+
+        self.assertFalse(pool.called)
+        self.assertEqual(sorted(call[0][0][2] for call in extract_shard.call_args_list), sorted(key_ranges))
+
     def _get_fluff_diff(self, emitters=None, group_values=None, group_names=None, type_map=None):
         emitters = emitters or ['all_visits', 'null_emitter']
         group_values = group_values or ['123']
@@ -0,0 +1,94 @@
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase, RequestFactory
+from ctable.instrumentation import (
+    AggregatingInstrumentation,
+    CacheInstrumentation,
+    NullInstrumentation,
+    get_instrumentation,
+    set_instrumentation,
+)
+
+
+class TestInstrumentation(SimpleTestCase):
+
+    def tearDown(self):
+        set_instrumentation(None)
+
+    def test_default(self):
+        set_instrumentation(None)
+        instrumentation = get_instrumentation()
+        self.assertIsInstance(instrumentation, NullInstrumentation)
+        self.assertFalse(instrumentation.enabled)
+        with instrumentation.timer('extract', table='t'):
+            pass
+
+    def test_configured(self):
+        set_instrumentation(None)
+        with self.settings(CTABLE_INSTRUMENTATION='ctable.instrumentation.AggregatingInstrumentation'):
+            self.assertIsInstance(get_instrumentation(), AggregatingInstrumentation)
+
+    def test_percentiles(self):
+        instrumentation = AggregatingInstrumentation(sample_size=100)
+        for i in range(200):
+            instrumentation.timing('view_page', i, view='c/view')
+
+        # only the latest samples are kept
+        self.assertEqual(instrumentation.percentile('view_page', 0.5, view='c/view'), 150)
+        self.assertEqual(instrumentation.percentile('view_page', 0.99, view='c/view'), 199)
+        self.assertIsNone(instrumentation.percentile('view_page', 0.5, view='other'))
+
+    def test_timer(self):
+        instrumentation = AggregatingInstrumentation()
+        with instrumentation.timer('ddl', table='t', op='create_table'):
+            pass
+        self.assertIsNotNone(instrumentation.percentile('ddl', 0.5, table='t', op='create_table'))
+
+    def test_render(self):
+        instrumentation = AggregatingInstrumentation()
+        instrumentation.timing('extract', 2.0, table='a')
+        instrumentation.timing('extract', 4.0, table='a')
+        instrumentation.count('rows_read', 10, table='a')
+        instrumentation.count('rows_read', 5, table='a')
+        instrumentation.count('rows_read', 1, table='b"c')
+
+        lines = instrumentation.render().splitlines()
+        self.assertEqual(lines, [
+            '# TYPE ctable_extract_seconds summary',
+            'ctable_extract_seconds{table="a",quantile="0.5"} 4.0',
+            'ctable_extract_seconds{table="a",quantile="0.9"} 4.0',
+            'ctable_extract_seconds{table="a",quantile="0.99"} 4.0',
+            'ctable_extract_seconds_sum{table="a"} 6.0',
+            'ctable_extract_seconds_count{table="a"} 2',
+            '# TYPE ctable_rows_read_total counter',
+            'ctable_rows_read_total{table="a"} 15',
+            'ctable_rows_read_total{table="b\\"c"} 1',
+        ])
+
+    def test_cache_instrumentation(self):
+        cache = LocMemCache('ctable_instrumentation', {})
+        web = CacheInstrumentation(cache=cache, process_id='web')
+        worker = CacheInstrumentation(cache=cache, process_id='worker')
+        pillow = CacheInstrumentation(cache=cache, process_id='pillow')
+        worker.timing('extract', 2.0, table='a')
+        worker.count('rows_read', 10, table='a')
+        pillow.timing('extract', 4.0, table='a')
+        pillow.count('rows_read', 5, table='a')
+        worker.flush()
+        pillow.flush()
+
+        lines = web.render().splitlines()
+        self.assertIn('ctable_extract_seconds_sum{table="a"} 6.0', lines)
+        self.assertIn('ctable_extract_seconds_count{table="a"} 2', lines)
+        self.assertIn('ctable_rows_read_total{table="a"} 15', lines)
+
+        # processes that haven't written their metrics recently are dropped
+        cache.delete('ctable_instrumentation:pillow')
+        self.assertIn('ctable_rows_read_total{table="a"} 10', web.render().splitlines())
+
+    def test_metrics_token(self):
+        from ctable_view.views import _metrics_token_valid
+        factory = RequestFactory()
+        with self.settings(CTABLE_METRICS_TOKEN='secret'):
+            self.assertTrue(_metrics_token_valid(factory.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')))
+            self.assertFalse(_metrics_token_valid(factory.get('/metrics', HTTP_AUTHORIZATION='Bearer other')))
+            self.assertFalse(_metrics_token_valid(factory.get('/metrics', {'token': 'secret'})))
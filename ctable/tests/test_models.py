@@ -18,6 +18,16 @@ class TestModels(TestBase):
         e = SqlExtractMapping(name="demo_name", domains=["test"])
         self.assertEqual("{0}_test_demo_name".format(settings.CTABLE_PREFIX), e.table_name)
 
+    def test_sql_extract_validate_incremental(self):
+        e = SqlExtractMapping(name="demo_name", domains=["test"], couch_view="c/view", incremental=True, columns=[
+            ColumnDef(name="a", data_type="string", value_source="key", value_index=0)
+        ])
+        with self.assertRaises(BadValueError):
+            e.validate()
+
+        e.changes_key_function = 'myapp.ctable.changed_keys'
+        e.validate()
+
     def test_column_validate_key_index(self):
         col = ColumnDef(name="a", data_type="string", value_source="key", value_index=1)
         col.validate()
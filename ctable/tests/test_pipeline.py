@@ -0,0 +1,65 @@
+import threading
+from django.test import SimpleTestCase
+from ctable.pipeline import read_ahead, write_behind, PipelineAborted
+
+
+class TestPipeline(SimpleTestCase):
+
+    def test_read_ahead(self):
+        self.assertEqual(list(read_ahead(xrange(1000), maxsize=2, chunksize=7)), range(1000))
+
+    def test_read_ahead_reader_thread(self):
+        threads = []
+
+        def rows():
+            threads.append(threading.current_thread())
+            yield 1
+
+        self.assertEqual(list(read_ahead(rows())), [1])
+        self.assertNotEqual(threads[0], threading.current_thread())
+
+    def test_read_ahead_error(self):
+        def rows():
+            yield 1
+            raise ValueError('bad row')
+
+        with self.assertRaisesRegexp(ValueError, 'bad row'):
+            list(read_ahead(rows()))
+
+    def test_write_behind(self):
+        written = []
+        threads = []
+
+        def write(rows):
+            threads.append(threading.current_thread())
+            written.extend(rows)
+
+        write_behind(write, xrange(1000), maxsize=2, chunksize=7)
+        self.assertEqual(written, range(1000))
+        self.assertNotEqual(threads[0], threading.current_thread())
+
+    def test_write_behind_writer_error(self):
+        def write(rows):
+            next(rows)
+            raise ValueError('write failed')
+
+        with self.assertRaisesRegexp(ValueError, 'write failed'):
+            write_behind(write, xrange(1000), maxsize=1, chunksize=1)
+
+    def test_write_behind_reader_error(self):
+        errors = []
+
+        def write(rows):
+            try:
+                list(rows)
+            except PipelineAborted as e:
+                errors.append(e)
+                raise
+
+        def rows():
+            yield 1
+            raise ValueError('bad row')
+
+        with self.assertRaisesRegexp(ValueError, 'bad row'):
+            write_behind(write, rows())
+        self.assertEqual(len(errors), 1)
@@ -0,0 +1,97 @@
+from datetime import date
+from django.test import SimpleTestCase
+from ctable.models import SqlExtractMapping, ColumnDef, KeyMatcher, NOT_EQUAL
+from ctable.plan import ColumnPlan, MappingPlan, get_plan
+
+ROWS = [
+    {"key": ["1", "indicator_a", "2013-03-01T12:00:00.000Z"], "value": {"sum": 1, "count": 3}},
+    {"key": ["2", "indicator_b", "2013-03-02T12:00:00.000Z"], "value": {"sum": "2", "count": 2}},
+    {"key": [3, {}, "2013-03-02T12:00:00.000Z"], "value": {"sum": "bad", "count": 5}},
+    {"key": [None, None, None], "value": {"sum": None, "count": None}},
+    {"key": ["4"], "value": 7},
+]
+
+
+class TestPlan(SimpleTestCase):
+
+    def test_column_plan_matches_column_def(self):
+        columns = [
+            ColumnDef(name="user", data_type="string", value_source="key", value_index=0),
+            ColumnDef(name="user", data_type="string", value_source="key", value_index=0,
+                      null_value_placeholder="none"),
+            ColumnDef(name="date", data_type="date", date_format="%Y-%m-%dT%H:%M:%S.%fZ",
+                      value_source="key", value_index=2,
+                      match_keys=[KeyMatcher(index=1, value="indicator_a", operator=NOT_EQUAL)]),
+            ColumnDef(name="a", data_type="integer", value_source="value", value_attribute="sum",
+                      match_keys=[KeyMatcher(index=1, value="indicator_a")]),
+            ColumnDef(name="b", data_type="integer", value_source="value", value_attribute="sum",
+                      match_keys=[KeyMatcher(index=1, value="{}")]),
+            ColumnDef(name="c", data_type="integer", value_source="value", value_attribute="sum",
+                      match_keys=[KeyMatcher(index=0, value="3"), KeyMatcher(index=2, value="2013-03-02T12:00:00.000Z")]),
+            ColumnDef(name="d", data_type="integer", value_source="value",
+                      match_keys=[KeyMatcher(index=0, value="4")]),
+        ]
+        for column in columns:
+            plan = ColumnPlan(column)
+            for row in ROWS:
+                key, value = row['key'], row['value']
+                matches = column.matches(key, value)
+                self.assertEqual(plan.matches(key), matches)
+                if matches and key[0] != "4":
+                    self.assertEqual(plan.get_value(key, value), column.get_value(key, value))
+
+    def test_dispatch_index(self):
+        columns = [ColumnDef(name="user", data_type="string", value_source="key", value_index=0)]
+        references = ["indicator_a", "indicator_b", "{}", "[1]", "1", "true", "null", "3"]
+        for i, reference in enumerate(references):
+            columns.append(ColumnDef(name="eq_%d" % i, data_type="string", value_source="value",
+                                     match_keys=[KeyMatcher(index=1, value=reference)]))
+            columns.append(ColumnDef(name="multi_%d" % i, data_type="string", value_source="value",
+                                     match_keys=[KeyMatcher(index=0, value="3"), KeyMatcher(index=1, value=reference)]))
+            columns.append(ColumnDef(name="neq_%d" % i, data_type="string", value_source="value",
+                                     match_keys=[KeyMatcher(index=1, value=reference, operator=NOT_EQUAL)]))
+        mapping = SqlExtractMapping(columns=columns)
+        plan = MappingPlan(mapping)
+        self.assertEqual(len(plan.dispatch.residual), len(references) + 4)
+
+        keys = [
+            ["1", "indicator_a"], ["1", "indicator_b"], [3, {}], [3, [1]], ["1", 1], ["1", True],
+            ["1", None], [3, 3], [3, "3"], ["1"], [3, "1"],
+        ]
+        for key in keys:
+            expected = dict((c.name, c.get_value(key, 'v')) for c in columns if c.matches(key, 'v'))
+            if len(expected) == 1:
+                expected = None
+            self.assertEqual(plan.convert_row(key, 'v'), expected, key)
+
+    def test_index_error(self):
+        column = ColumnDef(name="date", data_type="date", value_source="key", value_index=2)
+        with self.assertRaisesRegexp(IndexError, 'Value index out of range: key\[2\]'):
+            ColumnPlan(column).get_value(["4"], 7)
+
+    def test_convert_row(self):
+        mapping = SqlExtractMapping(columns=[
+            ColumnDef(name="user", data_type="string", value_source="key", value_index=0),
+            ColumnDef(name="date", data_type="date", date_format="%Y-%m-%dT%H:%M:%S.%fZ",
+                      value_source="key", value_index=2),
+            ColumnDef(name="a", data_type="integer", value_source="value", value_attribute="sum",
+                      match_keys=[KeyMatcher(index=1, value="indicator_a")]),
+        ])
+        plan = MappingPlan(mapping)
+        self.assertEqual(plan.convert_row(ROWS[0]['key'], ROWS[0]['value']),
+                         {'user': '1', 'date': date(2013, 3, 1), 'a': 1})
+        self.assertIsNone(plan.convert_row(ROWS[1]['key'], ROWS[1]['value']))
+        # no match so the key columns aren't evaluated
+        self.assertIsNone(plan.convert_row(ROWS[4]['key'], ROWS[4]['value']))
+
+    def test_get_plan_cached_by_rev(self):
+        mapping = SqlExtractMapping(_id='plan_mapping', _rev='1-a', columns=[
+            ColumnDef(name="user", data_type="string", value_source="key", value_index=0),
+        ])
+        plan = get_plan(mapping)
+        self.assertIs(get_plan(mapping), plan)
+
+        mapping._rev = '2-b'
+        self.assertIsNot(get_plan(mapping), plan)
+        self.assertIsNot(get_plan(SqlExtractMapping(columns=mapping.columns)),
+                         get_plan(SqlExtractMapping(columns=mapping.columns)))
@@ -0,0 +1,73 @@
+from django.test import SimpleTestCase
+from ctable.progress import ProgressReporter, as_reporter, FETCHING, CONVERTING, WRITING, DONE
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestProgressReporter(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.reports = []
+        self.progress = ProgressReporter(self.reports.append, total=1000, interval=2, clock=self.clock)
+
+    def test_throttled(self):
+        for current in range(0, 1000, 10):
+            self.clock.now += 0.1
+            self.progress.update(current)
+
+        # 10 seconds of updates is reported every 2 seconds
+        self.assertEqual(len(self.reports), 5)
+        self.assertEqual(self.reports[0]['stage'], CONVERTING)
+
+    def test_rate_and_eta(self):
+        self.progress.update(0)
+        self.clock.now = 4
+        self.progress.update(400)
+
+        report = self.reports[-1]
+        self.assertEqual(report['current'], 400)
+        self.assertEqual(report['total'], 1000)
+        self.assertEqual(report['rate'], 100)
+        self.assertEqual(report['eta'], 6)
+        self.assertEqual(report['elapsed'], 4)
+
+    def test_stages(self):
+        self.progress.report()
+        self.progress.update(100)
+        rows = self.progress.track(range(3), WRITING)
+        self.assertEqual(next(rows), 0)
+        self.assertEqual(self.progress.stage, WRITING)
+        self.assertEqual(list(rows), [1, 2])
+        self.progress.finish()
+
+        self.assertEqual([r['stage'] for r in self.reports], [FETCHING, CONVERTING, WRITING, DONE])
+        self.assertEqual(self.reports[-1]['eta'], 0)
+
+    def test_track_no_rows(self):
+        self.progress.update(0)
+        self.assertEqual(list(self.progress.track([], WRITING)), [])
+        self.assertEqual(self.progress.stage, CONVERTING)
+
+    def test_unknown_total(self):
+        self.progress.set_total(None)
+        self.progress.update(0)
+        self.clock.now = 2
+        self.progress.update(100)
+        self.assertIsNone(self.reports[-1]['eta'])
+        self.assertEqual(self.reports[-1]['rate'], 50)
+
+    def test_legacy_callback(self):
+        calls = []
+        progress = as_reporter(lambda total, current: calls.append((total, current)))
+        progress.set_total(10)
+        progress.update(5)
+        self.assertEqual(calls, [(10, 5)])
+        self.assertIs(as_reporter(progress), progress)
+        self.assertIsNone(as_reporter(None))
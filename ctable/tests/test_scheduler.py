@@ -0,0 +1,58 @@
+from django.test import SimpleTestCase
+from ctable.models import ExtractState
+from ctable.scheduler import ExtractScheduler, ScheduledExtract
+
+
+class TestScheduler(SimpleTestCase):
+
+    def _schedule(self, extracts, **kwargs):
+        kwargs.setdefault('gap', 10)
+        kwargs.setdefault('database_limit', 2)
+        kwargs.setdefault('backend_limit', 4)
+        kwargs.setdefault('default_runtime', 60)
+        return dict(ExtractScheduler(**kwargs).schedule(extracts))
+
+    def test_longest_first(self):
+        countdowns = self._schedule([
+            ScheduledExtract('small', 'db1', 'SQL', 5),
+            ScheduledExtract('big', 'db1', 'SQL', 600),
+            ScheduledExtract('medium', 'db1', 'SQL', 100),
+        ])
+        self.assertLess(countdowns['big'], 10)
+        self.assertTrue(10 <= countdowns['medium'] < 20)
+        # both slots for db1 are used until 'medium' finishes
+        self.assertTrue(110 <= countdowns['small'] < 120)
+
+    def test_database_limit(self):
+        countdowns = self._schedule([
+            ScheduledExtract('a', 'db1', 'SQL', 100),
+            ScheduledExtract('b', 'db1', 'SQL', 100),
+            ScheduledExtract('c', 'db1', 'SQL', 100),
+            ScheduledExtract('d', 'db2', 'SQL', 100),
+        ], database_limit=2)
+        starts = sorted(countdowns[id] // 10 * 10 for id in 'abc')
+        self.assertEqual(starts, [0, 10, 100])
+        self.assertLess(countdowns['d'], 10)
+
+    def test_backend_limit(self):
+        countdowns = self._schedule([
+            ScheduledExtract(str(i), 'db%s' % i, 'SQL', 50) for i in range(3)
+        ], backend_limit=2)
+        starts = sorted(c // 10 * 10 for c in countdowns.values())
+        self.assertEqual(starts, [0, 0, 50])
+
+    def test_unknown_runtime_spread_by_hash(self):
+        extracts = [ScheduledExtract('mapping%s' % i, 'db%s' % i, 'SQL', None) for i in range(20)]
+        countdowns = self._schedule(extracts, backend_limit=100)
+        self.assertTrue(all(c < 10 for c in countdowns.values()))
+        self.assertGreater(len(set(countdowns.values())), 1)
+
+        # the schedule is stable
+        self.assertEqual(countdowns, self._schedule(list(reversed(extracts)), backend_limit=100))
+
+    def test_record_runtime(self):
+        state = ExtractState(mapping_id='123')
+        state.record_runtime(100)
+        self.assertEqual(state.average_runtime, 100)
+        state.record_runtime(200, weight=0.5)
+        self.assertEqual(state.average_runtime, 150)
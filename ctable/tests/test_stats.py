@@ -0,0 +1,95 @@
+from datetime import datetime
+import json
+import time
+from django.test import SimpleTestCase
+from mock import patch
+from ctable.models import ExtractRun, SqlExtractMapping, RUNS_VIEW, RUN_FAILED, RUN_SUCCESS
+from ctable.stats import ExtractStats, FETCH, CONVERT, COMBINE, WRITE
+from ctable.tests import TestBase
+
+
+def slow(rows, delay):
+    for row in rows:
+        time.sleep(delay)
+        yield row
+
+
+class TestExtractStats(SimpleTestCase):
+
+    def test_stage_timings(self):
+        stats = ExtractStats()
+        rows = stats.timed(FETCH, slow(range(5), 0.01))
+        rows = stats.timed(CONVERT, slow(rows, 0.002), upstream=FETCH)
+        rows = stats.count_written(stats.timed(COMBINE, rows, upstream=CONVERT))
+        stats.timed_call(WRITE, COMBINE, lambda: list(slow(rows, 0.004)))
+        stats.finish()
+
+        timings = stats.timings
+        self.assertAlmostEqual(timings[FETCH], 0.05, delta=0.02)
+        self.assertAlmostEqual(timings[CONVERT], 0.01, delta=0.01)
+        self.assertAlmostEqual(timings[WRITE], 0.02, delta=0.01)
+        self.assertLess(timings[COMBINE], 0.01)
+        self.assertEqual(stats.rows_written, 5)
+        self.assertGreaterEqual(stats.duration, 0.08)
+
+    def test_peak_batch(self):
+        stats = ExtractStats()
+        for size in [10, 30, 20]:
+            stats.record_batch(FETCH, size)
+        self.assertEqual(stats.peak_batch_sizes, {FETCH: 30})
+
+    def test_add(self):
+        shards = []
+        for rows in (3, 5):
+            shard = ExtractStats()
+            rows = shard.timed(CONVERT, shard.timed(FETCH, slow(range(rows), 0.01)), upstream=FETCH)
+            shard.rows_read = len(list(shard.count_written(rows)))
+            shard.record_batch(FETCH, shard.rows_read)
+            shards.append(json.loads(json.dumps(shard.to_json())))
+
+        stats = ExtractStats(started=time.time() - 10)
+        for shard in shards:
+            stats.add(shard)
+        stats.finish()
+
+        self.assertEqual((stats.rows_read, stats.rows_written), (8, 8))
+        self.assertEqual(stats.peak_batch_sizes, {FETCH: 5})
+        self.assertAlmostEqual(stats.timings[FETCH], 0.08, delta=0.02)
+        self.assertLess(stats.timings[CONVERT], 0.01)
+        self.assertGreaterEqual(stats.duration, 10)
+
+    def test_run_from_stats(self):
+        mapping = SqlExtractMapping(_id='abc', domains=['test'], name='test', couch_view='c/view')
+        stats = ExtractStats()
+        stats.rows_read = 100
+        stats.finish()
+        stats.duration = 4
+
+        run = ExtractRun.from_stats(mapping, stats, incremental=True)
+        self.assertEqual(run.mapping_id, 'abc')
+        self.assertEqual(run.status, RUN_SUCCESS)
+        self.assertTrue(run.incremental)
+        self.assertEqual(run.throughput, 25)
+        self.assertEqual(set(run.timings), {FETCH, CONVERT, COMBINE, WRITE})
+
+        run = ExtractRun.from_stats(mapping, stats, error='boom')
+        self.assertEqual(run.status, RUN_FAILED)
+
+
+class TestExtractRuns(TestBase):
+
+    def setUp(self):
+        self.db.reset()
+
+    @patch('ctable.models.datetime')
+    def test_prune(self, mock_datetime):
+        mock_datetime.utcnow.return_value = datetime(2014, 4, 11)
+        self.db.add_view(RUNS_VIEW, [
+            (
+                {'startkey': ['abc'], 'endkey': ['abc', '2014-04-01T00:00:00'], 'reduce': False},
+                [{'id': 'run1', 'key': ['abc', '2014-03-01T00:00:00Z'], 'value': '1-a'}]
+            )
+        ])
+        with patch.object(self.db, 'bulk_delete', create=True) as bulk_delete:
+            self.assertEqual(ExtractRun.prune('abc', retention_days=10), 1)
+        bulk_delete.assert_called_once_with([{'_id': 'run1', '_rev': '1-a'}])
@@ -0,0 +1,150 @@
+import sqlalchemy
+from couchdbkit.client import ViewResults
+from django.test.utils import override_settings
+from mock import patch, Mock, MagicMock
+from ctable.models import SqlExtractMapping, ColumnDef, KeyMatcher, ExtractState, SCHEDULE_VIEW
+from ctable.tasks import process_extract, ctable_extract_schedule, extract_shard
+from ctable.base import KeyRange
+from ctable.backends import ColumnTypeException
+from ctable.tests import TestBase
+
+
+class TestTasks(TestBase):
+    def setUp(self):
+        self.db.reset()
+        # other tests set the database for SqlExtractMapping directly
+        self.p_db = patch.object(SqlExtractMapping, '_db', self.db, create=True)
+        self.p_db.start()
+        self.mapping = SqlExtractMapping(_id='tasks_mapping', domains=['test'], name='tasks', couch_view="c/view", columns=[
+            ColumnDef(name="username", data_type="string", value_source="key", value_index=0),
+            ColumnDef(name="indicator_a", data_type="integer", value_source="value",
+                      match_keys=[KeyMatcher(index=1, value="indicator_a")]),
+        ])
+        self.mapping.save()
+        self.extractor = MagicMock()
+        self.extractor.supports_checkpoints.return_value = False
+        self.p_extractor = patch('ctable.tasks.get_extractor', return_value=self.extractor)
+        self.p_extractor.start()
+        self.p_record = patch('ctable.tasks.record_run')
+        self.record_run = self.p_record.start()
+
+    def tearDown(self):
+        self.p_extractor.stop()
+        self.p_record.stop()
+        self.p_db.stop()
+
+    @override_settings(CTABLE_EXTRACT_SHARDS=3)
+    def test_sharded(self):
+        key_ranges = [KeyRange(['a'], ['b'], False), KeyRange(['b'], ['c'], True)]
+        self.extractor.get_shards.return_value = key_ranges
+
+        def extract(mapping, key_range=None, stats=None):
+            stats.rows_read = 2
+            stats.rows_written = 1
+            return 2, 0
+
+        self.extractor.extract.side_effect = extract
+        with patch.dict(process_extract.app.conf, {'CELERY_ALWAYS_EAGER': True}):
+            process_extract.apply(args=[self.mapping._id])
+
+        args, kwargs = self.extractor.get_shards.call_args
+        self.assertEqual(args[1:], (3,))
+        self.assertTrue(self.extractor.backend.init_mapping.called)
+        self.assertEqual([c[1]['key_range'] for c in self.extractor.extract.call_args_list], key_ranges)
+
+        self.assertEqual(self.record_run.call_count, 1)
+        stats = self.record_run.call_args[0][1]
+        self.assertEqual((stats.rows_read, stats.rows_written), (4, 2))
+        self.assertIsNotNone(ExtractState.for_mapping(self.mapping).average_runtime)
+
+    def test_shard_error_recorded(self):
+        self.extractor.extract.side_effect = ColumnTypeException('bad column')
+        result = extract_shard.apply(args=[self.mapping._id, [['a'], ['b'], True]])
+
+        self.assertEqual(result.state, 'FAILURE')
+        self.assertEqual(self.record_run.call_args[1]['error'], 'ColumnTypeException: bad column')
+
+    @override_settings(CTABLE_EXTRACT_SHARDS=3)
+    def test_sharded_not_used_for_rebuild(self):
+        process_extract.apply(args=[self.mapping._id], kwargs={'rebuild': True})
+
+        self.assertFalse(self.extractor.extract_sharded.called)
+        self.assertTrue(self.extractor.extract.call_args[1]['rebuild'])
+
+    def test_resume_after_transient_error(self):
+        self.extractor.supports_checkpoints.return_value = True
+
+        def extract(mapping, checkpoint=None, resume_key=None, **kwargs):
+            if self.extractor.extract.call_count == 1:
+                self.assertIsNone(resume_key)
+                checkpoint(['1'])
+                raise sqlalchemy.exc.OperationalError('INSERT', {}, Exception('connection lost'))
+
+            state = ExtractState.for_mapping(self.mapping)
+            self.assertEqual((state.resume_key, state.resume_run), (['1'], 'run1'))
+            self.assertEqual(resume_key, ['1'])
+            return 3, 0
+
+        self.extractor.extract.side_effect = extract
+        process_extract.apply(args=[self.mapping._id], task_id='run1')
+
+        self.assertEqual(self.extractor.extract.call_count, 2)
+        state = ExtractState.for_mapping(self.mapping)
+        self.assertIsNone(state.resume_key)
+        self.assertIsNone(state.resume_run)
+
+    def test_resume_key_from_other_run_ignored(self):
+        self.extractor.supports_checkpoints.return_value = True
+        self.extractor.extract.return_value = (3, 0)
+        state = ExtractState.for_mapping(self.mapping)
+        state.resume_key = ['1']
+        state.resume_run = 'run1'
+        state.save()
+
+        process_extract.apply(args=[self.mapping._id], task_id='run2')
+        self.assertIsNone(self.extractor.extract.call_args[1]['resume_key'])
+
+    @override_settings(CTABLE_EXTRACT_MAX_RETRIES=1)
+    def test_retries_limited(self):
+        self.extractor.extract.side_effect = sqlalchemy.exc.OperationalError('INSERT', {}, Exception())
+        result = process_extract.apply(args=[self.mapping._id], task_id='run1')
+
+        self.assertEqual(self.extractor.extract.call_count, 2)
+        self.assertEqual(result.state, 'FAILURE')
+        self.assertIsInstance(result.result, sqlalchemy.exc.OperationalError)
+
+    def test_error_not_retried(self):
+        self.extractor.extract.side_effect = ColumnTypeException("Column types don't match")
+        result = process_extract.apply(args=[self.mapping._id], task_id='run1')
+
+        self.assertEqual(self.extractor.extract.call_count, 1)
+        self.assertEqual(result.state, 'FAILURE')
+        self.assertIsInstance(result.result, ColumnTypeException)
+
+    def test_extract_schedule(self):
+        self.db.add_view(SCHEDULE_VIEW, [
+            (
+                {'startkey': ['active', 'hourly'], 'endkey': ['active', 'hourly', {}], 'wrap_doc': True},
+                [
+                    {'id': 'm1', 'key': ['active', 'hourly', None, None], 'value': ['db1', 'SQL']},
+                    {'id': 'm2', 'key': ['active', 'hourly', None, None], 'value': ['db1', 'SQL']},
+                    {'id': 'm3', 'key': ['active', 'hourly', None, None], 'value': [None, None]},
+                ]
+            ),
+        ])
+
+        fake_view = self.db.view
+
+        def couch_view(view_name, schema=None, wrapper=None, **params):
+            # wrap the rows the same way as couchdbkit.Database.view
+            fetch = lambda path, params: Mock(json_body={'rows': fake_view(view_name, **params).all()})
+            return ViewResults(fetch, view_name, wrapper, schema, params)
+
+        with patch.object(self.db, 'view', side_effect=couch_view), \
+                patch.object(process_extract, 'apply_async') as apply_async:
+            ctable_extract_schedule()
+
+        calls = dict((call[1]['args'][0], call[1]['countdown']) for call in apply_async.call_args_list)
+        self.assertEqual(sorted(calls), ['m1', 'm2', 'm3'])
+        # only one extract per database starts in each slot
+        self.assertNotEqual(calls['m1'] // 10, calls['m2'] // 10)
@@ -44,6 +44,40 @@ class TestUtil(TestBase):
                     dict(username="u1", date="d1", indicator_a="2", indicator_b="2")]
         self.assertEqual(list(munged), expected)
 
+    def test_combine_sorted_rows(self):
+        mapping = self.get_mapping()
+
+        rows = [dict(username="u1", date="d1", indicator_a="1"),
+                dict(username="u1", date="d1", indicator_b="1"),
+                dict(username="u1", date="d1", indicator_a="2"),
+                dict(username="u2", date="d1", indicator_b="2"),
+                dict(username="u1", date="d1", indicator_c="3")]
+        munged = util.combine_sorted_rows(rows, mapping)
+
+        expected = [dict(username="u1", date="d1", indicator_a="2", indicator_b="1"),
+                    dict(username="u2", date="d1", indicator_b="2"),
+                    dict(username="u1", date="d1", indicator_c="3")]
+        self.assertEqual(list(munged), expected)
+        self.assertEqual(list(util.combine_sorted_rows([], mapping)), [])
+
+    def test_couch_key_ordered(self):
+        mapping = self.get_mapping()
+        self.assertFalse(mapping.couch_key_ordered)
+
+        mapping.columns[1].value_index = 1
+        self.assertTrue(mapping.couch_key_ordered)
+
+        mapping.couch_key_prefix = ['a']
+        mapping.columns[0].value_index = 2
+        mapping.columns[1].value_index = 3
+        self.assertFalse(mapping.couch_key_ordered)
+
+        mapping.columns[1].value_index = 1
+        self.assertTrue(mapping.couch_key_ordered)
+
+        mapping.columns[0].value_source = 'value'
+        self.assertFalse(mapping.couch_key_ordered)
+
     def get_mapping(self):
         return SqlExtractMapping(domains=['test'], name='test', couch_view="c/view", columns=[
             ColumnDef(name="username", data_type="string", max_length=50, value_source="key", value_index=0),
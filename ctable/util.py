@@ -3,6 +3,7 @@ from ctable.backends import InMemoryBackend, SqlBackend
 from dimagi.utils.chunked import chunked
 from django.conf import settings
 from ctable.base import CtableExtractor
+from ctable.instrumentation import get_instrumentation
 from ctable.models import SqlExtractMapping
 from dimagi.utils.couch.database import get_db
 from dimagi.utils.decorators.memoized import memoized
@@ -24,6 +25,13 @@ def backends():
 
 @memoized
 def get_backend(backend_name):
+    return create_backend(backend_name)
+
+
+def create_backend(backend_name):
+    """
+    Create a new backend instance. Use get_backend to share a single instance per backend.
+    """
     if not backend_name:
         backend = SqlBackend()
     else:
@@ -39,18 +47,44 @@ def combine_rows(rows, extract_mapping, chunksize=250):
         Aim: reduce the number of times we have to hit the database
         """
         key_columns = extract_mapping.key_columns
+        instrumentation = get_instrumentation()
 
         for chunk in chunked(rows, chunksize):
-            rows_tmp = {}
-            for row_dict in chunk:
-                row_key = tuple([row_dict[k] for k in key_columns])
-                row_data = rows_tmp.setdefault(row_key, {})
-                row_data.update(row_dict)
+            with instrumentation.timer('combine_flush', table=extract_mapping.table_name):
+                rows_tmp = {}
+                for row_dict in chunk:
+                    row_key = tuple([row_dict[k] for k in key_columns])
+                    row_data = rows_tmp.setdefault(row_key, {})
+                    row_data.update(row_dict)
 
             for row in rows_tmp.values():
                 yield row
 
 
+def combine_sorted_rows(rows, extract_mapping):
+    """
+    Combine consecutive rows that have the same values for the key columns. Each combined row
+    is yielded as soon as the key changes so if the rows are ordered by key each SQL row is only
+    written once. See SqlExtractMapping.couch_key_ordered.
+    """
+    key_columns = extract_mapping.key_columns
+
+    current_key = None
+    current_row = None
+    for row_dict in rows:
+        row_key = tuple([row_dict[k] for k in key_columns])
+        if current_row is not None and row_key == current_key:
+            current_row.update(row_dict)
+        else:
+            if current_row is not None:
+                yield current_row
+            current_key = row_key
+            current_row = dict(row_dict)
+
+    if current_row is not None:
+        yield current_row
+
+
 @memoized
 def get_enabled_fluff_pillows():
     hardcoded = getattr(settings, 'FLUFF_PILLOW_TYPES_TO_SQL', {})
@@ -9,4 +9,6 @@ urlpatterns = patterns('ctable_view.views',
     url(r'^poll/(?P<job_id>[\w-]+)?$', 'poll_state', name='sql_mappings_poll'),
     url(r'^toggle_state/(?P<mapping_id>[\w-]+)?$', 'toggle', name='sql_mappings_toggle_state'),
     url(r'^delete/(?P<mapping_id>[\w-]+)?$', 'delete', name='sql_mappings_delete'),
+    url(r'^history/(?P<mapping_id>[\w-]+)$', 'history', name='sql_mappings_history'),
+    url(r'^metrics$', 'metrics', name='ctable_metrics'),
 )
\ No newline at end of file
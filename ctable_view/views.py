@@ -9,13 +9,16 @@ from dimagi.utils.web import json_response
 from django.utils.translation import ugettext as _
 
 from django.core.urlresolvers import reverse
-from django.http import Http404
+from django.http import Http404, HttpResponse
+from django.utils.crypto import constant_time_compare
 
-from ctable.models import SqlExtractMapping, ColumnDef
+from ctable.models import SqlExtractMapping, ColumnDef, ExtractRun
 from django.shortcuts import render, redirect
 from ctable.tasks import process_extract
 from ctable.util import get_extractor
 from django.contrib import messages
+from django.conf import settings
+from ctable.instrumentation import get_instrumentation
 
 logger = logging.getLogger(__name__)
 
@@ -188,15 +191,20 @@ def run(request, mapping_id, domain=None):
     elif date_range:
         date_range = int(date_range)
 
+    rebuild = False
     if request.GET.get('force') == 'true':
-        mapping = SqlExtractMapping.get(mapping_id)
-        backend = get_backend(mapping.backend)
-        with backend:
-            checks = backend.check_mapping(mapping)
-            if not checks['errors']:
-                backend.init_table(mapping.table_name, mapping.columns)
+        if not limit and date_range <= 0:
+            # full extract so build a new table and swap it in when it's done
+            rebuild = True
+        else:
+            mapping = SqlExtractMapping.get(mapping_id)
+            backend = get_backend(mapping.backend)
+            with backend:
+                checks = backend.check_mapping(mapping)
+                if not checks['errors']:
+                    backend.init_mapping(mapping)
 
-    job = process_extract.delay(mapping_id, limit=limit, date_range=date_range)
+    job = process_extract.delay(mapping_id, limit=limit, date_range=date_range, rebuild=rebuild)
 
     kwargs = {'domain': domain} if domain else {}
     kwargs['job_id'] = job.id
@@ -236,3 +244,70 @@ def delete(request, mapping_id, domain=None):
 
     kwargs = {'domain': domain} if domain else {}
     return redirect('sql_mappings_list', **kwargs)
+
+
+def _throughput_chart(runs, width=800, height=200):
+    """
+    Points for an SVG polyline of the throughput of the runs in the order they ran
+    """
+    runs = [run for run in reversed(runs) if run.throughput is not None]
+    if not runs:
+        return None
+
+    max_throughput = max(run.throughput for run in runs) or 1
+    step = float(width) / max(len(runs) - 1, 1)
+    points = [
+        (round(i * step, 1), round(height - run.throughput * height / max_throughput, 1), run)
+        for i, run in enumerate(runs)
+    ]
+    return {
+        'width': width,
+        'height': height,
+        'max_throughput': max_throughput,
+        'points': points,
+        'polyline': ' '.join('%s,%s' % (x, y) for x, y, _ in points),
+    }
+
+
+@require_superuser
+def history(request, mapping_id, domain=None, template='ctable/mapping_history.html'):
+    try:
+        mapping = SqlExtractMapping.get(mapping_id)
+    except ResourceNotFound:
+        raise Http404()
+
+    runs = ExtractRun.by_mapping(mapping_id)
+    return render(request, template, {
+        'domain': domain,
+        'mapping': mapping,
+        'runs': runs,
+        'chart': _throughput_chart(runs),
+    })
+
+
+def _metrics_token_valid(request):
+    token = getattr(settings, 'CTABLE_METRICS_TOKEN', None)
+    if not token:
+        return False
+    auth = request.META.get('HTTP_AUTHORIZATION', '')
+    return constant_time_compare(auth, 'Bearer %s' % token)
+
+
+def metrics(request, domain=None):
+    """
+    Metrics in the Prometheus text format. Requires CTABLE_INSTRUMENTATION to be set to
+    'ctable.instrumentation.CacheInstrumentation' for the metrics of all the processes or
+    'ctable.instrumentation.AggregatingInstrumentation' for only this process.
+
+    Scrapers can authenticate with CTABLE_METRICS_TOKEN as a bearer token.
+    """
+    if not _metrics_token_valid(request):
+        return require_superuser(_metrics)(request)
+    return _metrics(request)
+
+
+def _metrics(request):
+    instrumentation = get_instrumentation()
+    if not hasattr(instrumentation, 'render'):
+        raise Http404()
+    return HttpResponse(instrumentation.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -17,6 +17,107 @@ CTABLE_BACKENDS = {'SQL': 'ctable.backends.SqlBackend'}
 CTABLE_PREFIX = 'ctable'
 
 # This is the delay in seconds that will be used to stagger extract tasks. Defaults to 10s.
+# Scheduled extracts start in slots of this size (see ctable.scheduler).
 CTABLE_TASK_STAGGER_GAP = 10
 
 UNIT_TESTING = True
+
+# Number of rows to send in each multi-row INSERT ... ON CONFLICT statement. Only used with
+# PostgreSQL 9.5+, other databases fall back to upserting row by row. Defaults to 250.
+CTABLE_UPSERT_BATCH_SIZE = 250
+
+# Rows written by SqlBackend are grouped into transactions which are committed every
+# CTABLE_COMMIT_EVERY rows or every CTABLE_COMMIT_INTERVAL seconds, whichever comes first.
+# Larger values give better throughput at the cost of losing more work if an extract fails.
+CTABLE_COMMIT_EVERY = 10000
+CTABLE_COMMIT_INTERVAL = 30
+
+# Connection pool settings for SqlBackend. Each thread using the backend checks out its own
+# connection from the pool so the pool should be at least as big as the number of threads.
+CTABLE_SQL_POOL_SIZE = 5
+CTABLE_SQL_POOL_MAX_OVERFLOW = 10
+# Recycle connections after this many seconds
+CTABLE_SQL_POOL_RECYCLE = 3600
+
+# Read rows from CouchDB and write them to SQL in background threads so that fetching,
+# converting and writing overlap. CTABLE_PIPELINE_QUEUE_SIZE is the number of chunks of rows
+# that can be buffered between each stage.
+CTABLE_PIPELINED_EXTRACT = False
+CTABLE_PIPELINE_QUEUE_SIZE = 10
+
+# Split full extracts run by process_extract into up to CTABLE_EXTRACT_SHARDS key ranges which are
+# extracted in parallel by separate extract_shard tasks. The tasks are joined with a chord so a celery
+# result backend is required. 1 disables sharding.
+CTABLE_EXTRACT_SHARDS = 1
+
+# Number of changes to read from the _changes feed in each request for incremental mappings
+CTABLE_CHANGES_BATCH_SIZE = 1000
+
+# Read CouchDB views in pages of this many rows instead of in a single request so that memory
+# use doesn't depend on the size of the view. None reads the whole range in one request.
+CTABLE_VIEW_PAGE_SIZE = None
+
+# Maximum number of parsed date strings cached for each date format
+CTABLE_DATE_CACHE_SIZE = 10000
+
+# Maximum number of concurrent view requests made when recalculating the grains for a Fluff diff
+CTABLE_GRAIN_CONCURRENCY = 4
+
+# Number of seconds SqlExtractMappings used for Fluff diffs are cached in each process.
+# Mappings saved in the same process replace the cached copy immediately. 0 disables the cache.
+CTABLE_MAPPING_CACHE_TIMEOUT = 60
+
+# Limits on the number of scheduled extracts that run at once against the same CouchDB database
+# and the same backend. Extracts are scheduled longest first using their average runtime or
+# CTABLE_SCHEDULE_DEFAULT_RUNTIME seconds if they haven't run before.
+CTABLE_SCHEDULE_DATABASE_CONCURRENCY = 2
+CTABLE_SCHEDULE_BACKEND_CONCURRENCY = 4
+CTABLE_SCHEDULE_DEFAULT_RUNTIME = 60
+
+# Number of days to keep the statistics recorded for each extract run
+CTABLE_STATS_RETENTION_DAYS = 90
+
+# Dotted path to the class used to record timings and counters for extracts, Fluff diffs and SQL
+# writes. 'ctable.instrumentation.AggregatingInstrumentation' keeps the latest
+# CTABLE_INSTRUMENTATION_SAMPLE_SIZE timings of each metric in memory and exports them in the
+# Prometheus text format at the 'metrics' URL. It only has the metrics of the web worker serving
+# the URL. 'ctable.instrumentation.CacheInstrumentation' writes the metrics of each process to the
+# CTABLE_INSTRUMENTATION_CACHE Django cache every CTABLE_INSTRUMENTATION_FLUSH_INTERVAL seconds and
+# exports the metrics of all the processes that have written them in the last
+# CTABLE_INSTRUMENTATION_TIMEOUT seconds. Scrapers can authenticate by sending CTABLE_METRICS_TOKEN
+# as a bearer token.
+CTABLE_INSTRUMENTATION = None
+CTABLE_INSTRUMENTATION_SAMPLE_SIZE = 1000
+CTABLE_INSTRUMENTATION_CACHE = 'default'
+CTABLE_INSTRUMENTATION_FLUSH_INTERVAL = 10
+CTABLE_INSTRUMENTATION_TIMEOUT = 600
+CTABLE_METRICS_TOKEN = None
+
+# Minimum number of seconds between progress updates for running extracts. Each update is a
+# write to the Celery result backend.
+CTABLE_PROGRESS_INTERVAL = 2
+
+# Extracts which fail with connection errors are retried CTABLE_EXTRACT_MAX_RETRIES times after
+# CTABLE_EXTRACT_RETRY_DELAY seconds. Extracts of mappings whose key columns come from the start of
+# the view key are committed on key boundaries and retries resume after the last committed key.
+CTABLE_EXTRACT_RETRY_DELAY = 60
+CTABLE_EXTRACT_MAX_RETRIES = 3
+
+# Maximum number of rows kept for each table by InMemoryBackend e.g. when testing a mapping
+CTABLE_MEMORY_BACKEND_MAX_ROWS = 10000
+
+# ctable.backends.FileBackend writes each extract to gzipped CSV ('csv') or Parquet ('parquet',
+# requires pyarrow) files in CTABLE_FILE_BACKEND_DIR/<table name>/ with a JSON manifest. A new file
+# is started after CTABLE_FILE_BACKEND_MAX_ROWS rows or CTABLE_FILE_BACKEND_MAX_BYTES bytes. Parquet
+# row groups have CTABLE_FILE_BACKEND_ROW_GROUP_SIZE rows. Add it to CTABLE_BACKENDS to use it e.g.
+# CTABLE_BACKENDS = {'SQL': 'ctable.backends.SqlBackend', 'FILE': 'ctable.backends.FileBackend'}
+CTABLE_FILE_BACKEND_DIR = 'ctable_exports'
+CTABLE_FILE_BACKEND_FORMAT = 'csv'
+CTABLE_FILE_BACKEND_MAX_ROWS = 1000000
+CTABLE_FILE_BACKEND_MAX_BYTES = 256 * 1024 * 1024
+CTABLE_FILE_BACKEND_ROW_GROUP_SIZE = 10000
+
+# Path of the database file used by ctable.backends.DuckDbBackend (requires duckdb). Add it to
+# CTABLE_BACKENDS to use it e.g. {'DUCKDB': 'ctable.backends.DuckDbBackend'}. Only one process can
+# write to the file at a time so extracts to it must run in a single worker process.
+CTABLE_DUCKDB_PATH = 'ctable.duckdb'